@@ -0,0 +1,325 @@
+# Benchmarks.py
+# Reproducible benchmarks of the main entry points on synthetic data, with baselines for detecting performance regressions
+#
+# Run from the command line with e.g.
+#   python -m BabyDTools.Benchmarks --preset quick --baseline baseline.json             (compare against a stored baseline)
+#   python -m BabyDTools.Benchmarks --preset full --baseline baseline.json --save       (store a new baseline)
+
+import os
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# default location of the generated benchmark data, which is written once and reused by later runs
+DefaultDataDir = os.path.join(os.path.expanduser('~'), '.babyd', 'benchmarks')
+
+# data sizes of each preset: number of frames of a capture, number of steps of a parameter sweep
+Presets = {'quick': {'frames': (1000, 10000), 'steps': (16, 64)},
+           'full': {'frames': (1000, 10000, 100000, 1000000), 'steps': (16, 256, 4096)}}
+
+SweepCaptures = 100 # frames per step of the benchmark sweeps
+BenchmarkSeed = 0
+
+
+def capture_path(datadir, frames):
+    """Path of the first row-pair file of the benchmark capture of "frames" frames, generated with `SyntheticData.write_capture` if it does not exist yet."""
+    from BabyDTools import SyntheticData as SD
+
+    folderpath = os.path.join(datadir, f'capture{frames}')
+    paths = [os.path.join(folderpath, f'Row{row}to{row + 1}Data_BenchNumCaptures_{frames}_000000.npy') for row in SD.RowPairs]
+    if not all(os.path.exists(path) for path in paths):
+        SD.write_capture(folderpath, test_name = 'Bench', NumCaptures = frames, timestamp = '000000', seed = BenchmarkSeed, Photons = 1.0)
+    return paths[0]
+
+
+def sweep_path(datadir, steps):
+    """Folder of the benchmark VoutTH2 sweep of "steps" steps (one row pair, "SweepCaptures" frames per step), generated with `SyntheticData.write_sweep` if it does not exist yet."""
+    from BabyDTools import SyntheticData as SD
+
+    folderpath = os.path.join(datadir, f'sweep{steps}')
+    complete = os.path.join(folderpath, '.complete') # written last, as the time stamps in the file names are not known in advance
+    if not os.path.exists(complete):
+        SweepValues = np.unique(np.linspace(0, 4095, steps).astype(int))
+        SD.write_sweep(folderpath, SweptParameter = 'VoutTH2', SweepValues = SweepValues, NumCaptures = SweepCaptures, rows = (0,), seed = BenchmarkSeed, Photons = 1.0)
+        open(complete, 'w').close()
+    return folderpath
+
+
+# Each case takes the data directory and size and returns the function to time and the number of frames it processes.
+# The data is prepared (and for in memory cases, loaded) before timing starts.
+
+def _case_load_data(datadir, frames):
+    from BabyDTools import SPI_analysis as SPI
+    path = capture_path(datadir, frames)
+    return lambda: SPI.load_data(path), frames
+
+
+def _case_build_array(datadir, frames):
+    from BabyDTools import SPI_analysis as SPI
+    datastore = SPI.load_data(capture_path(datadir, frames))
+    return lambda: SPI.build_array(datastore), frames
+
+
+def _case_calc_ave(datadir, frames):
+    from BabyDTools import SPI_analysis as SPI
+    array = SPI.build_array(SPI.load_data(capture_path(datadir, frames)))
+    return lambda: SPI.calc_ave(array), frames
+
+
+def _case_calc_ave_lazy(datadir, frames):
+    from BabyDTools import SPI_analysis as SPI
+    path = capture_path(datadir, frames)
+    return lambda: SPI.calc_ave(SPI.build_array(SPI.load_data(path, mmap_mode = 'r'), lazy = True)), frames
+
+
+def _case_stream_statistics(datadir, frames):
+    from BabyDTools import SPI_analysis as SPI
+    from BabyDTools.StreamingStatistics import stream_statistics
+    path = capture_path(datadir, frames)
+    return lambda: stream_statistics(SPI.iter_frames(path)), frames
+
+
+def _case_histogram_array(datadir, frames):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from BabyDTools import SPI_analysis as SPI
+    from BabyDTools.ExamplePlots import histogram_array
+    array = SPI.build_array(SPI.load_data(capture_path(datadir, frames)))
+
+    def run():
+        histogram_array(array)
+        plt.close('all')
+    return run, frames
+
+
+def _case_Readout(datadir, frames):
+    from BabyDTools import ChargeCancellationModel as CCM
+    CurrentMagnitude = np.random.default_rng(BenchmarkSeed).integers(0, 4096, frames)
+    return lambda: CCM.Readout(CurrentMagnitude, 54), frames
+
+
+def _case_SimulateFrames(datadir, frames):
+    from BabyDTools import DetectorSimulation as DS
+    return lambda: DS.SimulateFrames(frames, seed = BenchmarkSeed), frames
+
+
+def _case_paramsweep_loaddata(datadir, steps):
+    from BabyDTools import SPI_analysis as SPI
+    folderpath = sweep_path(datadir, steps)
+    return lambda: SPI.paramsweep_loaddata(folderpath, pixel_select = 'all', row_select = 'all'), steps * SweepCaptures
+
+
+# name -> (size axis of the presets, case)
+Cases = {'load_data': ('frames', _case_load_data),
+         'build_array': ('frames', _case_build_array),
+         'calc_ave': ('frames', _case_calc_ave),
+         'calc_ave_lazy': ('frames', _case_calc_ave_lazy),
+         'stream_statistics': ('frames', _case_stream_statistics),
+         'histogram_array': ('frames', _case_histogram_array),
+         'Readout': ('frames', _case_Readout),
+         'SimulateFrames': ('frames', _case_SimulateFrames),
+         'paramsweep_loaddata': ('steps', _case_paramsweep_loaddata)}
+
+
+def _reset_peak_rss():
+    """Resets the peak RSS of this process where the OS allows it (Linux), so it only covers what follows."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    """Peak resident set size of this process in MB, None where it is not available.
+    On Linux this is "VmHWM", as "ru_maxrss" is inherited from the parent process and so can overstate the peak of a worker."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10 # kB
+    except OSError:
+        pass
+    try:
+        import resource # Unix only
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10 # bytes on macOS, kB elsewhere
+
+
+def run_case(name, size, datadir = DefaultDataDir, repeat = 3, min_time = 0.5):
+    """Runs one benchmark case at least "repeat" times, and for fast cases until "min_time" seconds have been spent, and records the fastest run.
+    The peak RSS is that of the process from the start of the timed runs (including any data the case loaded beforehand), so cases should be run in a fresh process
+    (as `run_benchmarks()` does) for it to belong to the case alone.
+
+    Args:
+        name (str): Name of the case, one of "Cases".
+        size (int): Number of frames or sweep steps, see "Presets".
+        datadir (str, optional): Directory of the benchmark data. Defaults to "~/.babyd/benchmarks".
+        repeat (int, optional): Least number of timed runs. Defaults to 3.
+        min_time (float, optional): Least total time of the timed runs in seconds, reduces the noise of the fastest run of short cases. Defaults to 0.5.
+
+    Returns:
+        result (dict): "name", "size", "frames", "wall" and "cpu" (seconds, of the fastest run), "frames_per_s" and "peak_rss_mb".
+    """
+    with contextlib.redirect_stdout(io.StringIO()): # the loaders report what they are doing with print
+        run, frames = Cases[name][1](datadir, size)
+        _reset_peak_rss()
+        timings = []
+        while len(timings) < repeat or (sum(wall for wall, _ in timings) < min_time and len(timings) < 1000):
+            wall, cpu = time.perf_counter(), time.process_time()
+            run()
+            timings += [(time.perf_counter() - wall, time.process_time() - cpu)]
+    wall, cpu = min(timings)
+    return {'name': name, 'size': size, 'frames': frames, 'wall': wall, 'cpu': cpu, 'frames_per_s': frames / wall if wall > 0 else float('inf'), 'peak_rss_mb': _peak_rss()}
+
+
+def result_key(result):
+    return f"{result['name']}[{result['size']}]"
+
+
+def run_benchmarks(preset = 'quick', names = None, datadir = DefaultDataDir, repeat = 3, isolate = True, verbose = True):
+    """Runs the benchmark cases for every size of a preset, generating the synthetic data first if needed.
+
+    Args:
+        preset (str, optional): Sizes to run, a key of "Presets". Defaults to "quick".
+        names (list, optional): Cases to run. Defaults to None (all of "Cases").
+        datadir (str, optional): Directory of the benchmark data. Defaults to "~/.babyd/benchmarks".
+        repeat (int, optional): Number of timed runs of each case. Defaults to 3.
+        isolate (bool, optional): Run each case in a fresh process, so its peak RSS and timings are not affected by the cases before it. Defaults to True.
+        verbose (bool, optional): Print each result as it is measured. Defaults to True.
+
+    Returns:
+        results (dict): Results of `run_case()`, keyed by "<name>[<size>]".
+    """
+    names = list(Cases) if names is None else names
+    for name in names:
+        assert name in Cases, f"Unknown benchmark {name}, expected one of {list(Cases)}."
+    os.makedirs(datadir, exist_ok = True)
+
+    results = {}
+    for name in names:
+        axis = Cases[name][0]
+        for size in Presets[preset][axis]:
+            # data is generated here rather than in the worker, so generation is never timed
+            with contextlib.redirect_stdout(io.StringIO()):
+                if axis == 'steps':
+                    sweep_path(datadir, size)
+                elif name not in ('Readout', 'SimulateFrames'): # cases which do not read a capture
+                    capture_path(datadir, size)
+            if isolate is True:
+                with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as executor:
+                    result = executor.submit(run_case, name, size, datadir, repeat).result()
+            else:
+                result = run_case(name, size, datadir = datadir, repeat = repeat)
+            results[result_key(result)] = result
+            if verbose is True:
+                print(format_result(result), flush = True)
+    return results
+
+
+def environment():
+    """Description of the machine and library versions, stored with a baseline as results are only comparable on the same setup."""
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def save_baseline(results, path):
+    """Saves benchmark results as a JSON baseline."""
+    with open(path, 'w') as f:
+        json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'environment': environment(), 'results': results}, f, indent = 2)
+
+
+def load_baseline(path):
+    """Loads a JSON baseline saved by `save_baseline()`, returning its results."""
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, threshold = 0.2, rss_threshold = None):
+    """Finds the cases which have become slower (or use more memory) than the baseline by more than the threshold.
+
+    Args:
+        results (dict): Results of `run_benchmarks()`.
+        baseline (dict): Baseline results, e.g. from `load_baseline()`. Cases missing from the baseline are skipped.
+        threshold (float, optional): Largest allowed fractional increase of the wall time. Defaults to 0.2 (20 %).
+        rss_threshold (float, optional): Largest allowed fractional increase of the peak RSS. Defaults to None (not checked).
+
+    Returns:
+        regressions (list): Dictionaries of "key", "metric", "baseline", "current" and "change" (fractional) of every regression.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        checks = [('wall', threshold)] + ([('peak_rss_mb', rss_threshold)] if rss_threshold is not None else [])
+        for metric, limit in checks:
+            before, after = baseline[key].get(metric), result.get(metric)
+            if before is None or after is None or before <= 0:
+                continue
+            change = after / before - 1
+            if change > limit:
+                regressions += [{'key': key, 'metric': metric, 'baseline': before, 'current': after, 'change': change}]
+    return regressions
+
+
+def format_result(result):
+    rss = 'n/a' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f} MB"
+    return f"{result_key(result):<32} {result['wall']:>10.4f} s {result['cpu']:>10.4f} s cpu {result['frames_per_s']:>14,.0f} frames/s   peak RSS {rss}"
+
+
+def format_report(results, regressions = (), baseline = None):
+    """Text summary of benchmark results, with the change from the baseline of each case and a list of the regressions."""
+    lines = []
+    for key, result in results.items():
+        line = format_result(result)
+        if baseline is not None and key in baseline and baseline[key]['wall'] > 0:
+            line += f"   {result['wall'] / baseline[key]['wall'] - 1:+.1%} vs baseline"
+        lines += [line]
+    if len(regressions) > 0:
+        lines += ['', f'{len(regressions)} regression(s):']
+        lines += [f"  {r['key']} {r['metric']}: {r['baseline']:.4g} -> {r['current']:.4g} ({r['change']:+.1%})" for r in regressions]
+    elif baseline is not None:
+        lines += ['', 'No regressions.']
+    return '\n'.join(lines)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the BabyDTools loaders, simulator, statistics and plotting on synthetic data.')
+    parser.add_argument('--preset', choices = list(Presets), default = 'quick', help = 'data sizes to run')
+    parser.add_argument('--cases', nargs = '+', choices = list(Cases), default = None, help = 'cases to run (default all)')
+    parser.add_argument('--datadir', default = DefaultDataDir, help = 'directory of the generated benchmark data')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'timed runs per case, the fastest is kept')
+    parser.add_argument('--baseline', default = None, help = 'JSON baseline to compare against (or to write with --save)')
+    parser.add_argument('--save', action = 'store_true', help = 'save the results as the baseline instead of comparing')
+    parser.add_argument('--threshold', type = float, default = 0.2, help = 'fractional slow down reported as a regression')
+    parser.add_argument('--rss-threshold', type = float, default = None, help = 'fractional peak RSS increase reported as a regression')
+    parser.add_argument('--no-isolate', action = 'store_true', help = 'run every case in this process')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(preset = args.preset, names = args.cases, datadir = args.datadir, repeat = args.repeat, isolate = not args.no_isolate)
+    if args.baseline is None:
+        return 0
+    if args.save is True:
+        save_baseline(results, args.baseline)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    regressions = compare(results, baseline, threshold = args.threshold, rss_threshold = args.rss_threshold)
+    print()
+    print(format_report(results, regressions, baseline = baseline))
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
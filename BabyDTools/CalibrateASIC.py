@@ -3,8 +3,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 
-import SPI_analysis as SPI 
-from ExamplePlots import histogram_pixel, CoarseFineCombinedPlot
+from BabyDTools import SPI_analysis as SPI
+from BabyDTools import Calibration as Cal
+from BabyDTools.ExamplePlots import histogram_pixel, CoarseFineCombinedPlot
 
 
 #* Test 1 - Fine Stage Threshold
@@ -16,6 +17,16 @@ plt.figure()
 plt.plot(OrderedParamSweeped, OrderedData[:,0,1])
 plt.show()
 
+# fit the threshold, gain and offset of every pixel in the sweep at once
+SweepValues, SweepData = SPI.paramsweep_loaddata(folderpath = test1folder, ParamSweepStep = 1, pixel_select = 'all', row_select = 'all', AverageData = False)
+Test1Fit = Cal.FitSweep(SweepValues, SweepData)
+print(f"{np.count_nonzero(Test1Fit['Bad'][...,1])} pixels with a bad fine stage fit")
+
+plt.figure()
+plt.imshow(np.ma.masked_array(Test1Fit['Threshold'][...,1], Test1Fit['Bad'][...,1]))
+plt.colorbar(label = 'Fine stage threshold crossing (DAC)')
+plt.show()
+
 #* Test 2 - Fine Stage Cancellation
 
 #* Test 3 - Coarse Stage Threshold
@@ -0,0 +1,135 @@
+# Calibration.py
+# Batched per-pixel calibration fits of parameter sweeps (e.g. the threshold and cancellation tests of CalibrateASIC.py), for every pixel and both stages at once
+
+import numpy as np
+
+from BabyDTools import ChargeCancellationModel as CCM
+from BabyDTools.PixelHistograms import CoarseBins, FineBins
+
+# bias settings which can be swept, and the stage (index into coarse [0] / fine [1]) each one belongs to
+SweptStage = {"VoutTH1": 0, "IDACCancel1": 0, "VoutTH2": 1, "IDACCancel2": 1}
+
+
+def _LineFit(x, y, weights):
+    """Weighted least squares straight line fit y = Offset + Gain * x of every column of "y" [steps,*P] at once, from the closed form normal equations."""
+    x = x.reshape((-1,) + (1,) * (y.ndim - 1))
+    xmean = x.mean() # centred for numerical stability with large DAC values
+    xc = x - xmean
+    w = weights.astype(float)
+
+    S0 = w.sum(axis = 0)
+    Sx = (w * xc).sum(axis = 0)
+    Sy = (w * y).sum(axis = 0)
+    Sxx = (w * xc ** 2).sum(axis = 0)
+    Sxy = (w * xc * y).sum(axis = 0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        Gain = (S0 * Sxy - Sx * Sy) / (S0 * Sxx - Sx ** 2)
+        Intercept = (Sy - Gain * Sx) / S0
+        Residual = np.sqrt((w * (y - Intercept - Gain * xc) ** 2).sum(axis = 0) / S0)
+    return Gain, Intercept - Gain * xmean, Residual
+
+
+def _Crossing(x, y, Level):
+    """Sweep value at which every column of "y" [steps,*P] first crosses "Level", linearly interpolated between steps (NaN if it never crosses),
+    and the number of times it crosses."""
+    Above = y >= Level
+    Change = Above[1:] != Above[:-1]
+    Crossings = Change.sum(axis = 0)
+    i = np.argmax(Change, axis = 0)[None]
+    y0, y1 = np.take_along_axis(y, i, axis = 0)[0], np.take_along_axis(y, i + 1, axis = 0)[0]
+    x0, x1 = x[i[0]], x[i[0] + 1]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        Threshold = x0 + (Level - y0) * (x1 - x0) / (y1 - y0)
+    Threshold[Crossings == 0] = np.nan
+    return Threshold, Crossings
+
+
+def FitSweep(SweepValues, SweepData, Reciprocal = False, Level = 0.5, MinPoints = 3, MaxResidual = 1.0):
+    """Fits the mean coarse and fine response of every pixel to a parameter sweep in one batched pass, rather than one fit per pixel.
+    The response (mean count across captures) is fitted with a straight line, Count = Offset + Gain * x, over the steps where the stage is counting
+    (mean count of at least "Level") and not saturated. The threshold is the sweep value where the response first crosses "Level".
+
+    Args:
+        SweepValues (list or NDArray): Values of the swept parameter, one per step, as returned by `SPI_analysis.paramsweep_loaddata`.
+        SweepData (NDArray): Sweep cube of shape [N_steps,N_captures,*P,3] from `SPI_analysis.paramsweep_loaddata`, e.g. [N_steps,N_captures,16,16,3] with "row_select" and "pixel_select" = "all".
+        Reciprocal (bool, optional): Fit against 1 / x rather than x, for cancellation current sweeps where the count goes as 1 / IDACCancel. Defaults to False.
+        Level (float, optional): Mean count above which a stage is considered to be counting. Defaults to 0.5.
+        MinPoints (int, optional): Fewest counting steps needed for a good fit. Defaults to 3.
+        MaxResidual (float, optional): Largest RMS fit residual (in counts) of a good fit, a noise-free staircase response has a residual of ~0.3. Defaults to 1.0.
+
+    Returns:
+        Fit (dict): Arrays of shape [*P,2] (coarse [0], fine [1]): "Threshold" (NaN if the response never crosses "Level"), "Crossings" (number of times the response crosses "Level"),
+                    "Gain" and "Offset" of the line fit, "Residual" (RMS, counts), "Points" (number of steps fitted) and "Bad" (True where the fit failed or is poor).
+    """
+    x = np.asarray(SweepValues, dtype = float)
+    Mean = np.asarray(SweepData[..., :2]).mean(axis = 1) # [N_steps,*P,2]
+    assert len(x) == len(Mean), f"{len(x)} sweep values given for {len(Mean)} sweep steps."
+
+    Saturation = np.array([CoarseBins - 1, FineBins - 1])
+    Counting = (Mean >= Level) & (Mean < Saturation)
+    Gain, Offset, Residual = _LineFit(1 / x if Reciprocal is True else x, Mean, Counting)
+    Threshold, Crossings = _Crossing(x, Mean, Level)
+    Points = Counting.sum(axis = 0)
+
+    Bad = (Points < MinPoints) | ~np.isfinite(Gain) | ~(Residual <= MaxResidual)
+    return {'Threshold': Threshold, 'Crossings': Crossings, 'Gain': Gain, 'Offset': Offset, 'Residual': Residual, 'Points': Points, 'Bad': Bad}
+
+
+def ModelSweep(SweepValues, SweptParameter, CurrentMagnitude, InjectionClocks, IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156):
+    """Predicts the readout of a parameter sweep with `ChargeCancellationModel.ReadoutVectorised()`, in the layout of `SPI_analysis.paramsweep_loaddata` for a single ideal pixel.
+
+    Args:
+        SweepValues (list or NDArray): Values of the swept parameter.
+        SweptParameter (str): Name of the swept argument of `ReadoutVectorised()`, e.g. "VoutTH2".
+        CurrentMagnitude (int): Test pulse current "IDACCal" DAC value used for the sweep.
+        InjectionClocks (int): Test pulse length used for the sweep, in 2 ns clocks.
+        Other arguments are the bias settings which were held fixed.
+
+    Returns:
+        SweepData (NDArray): Predicted sweep of shape [N_steps,1,3] (a single capture, overflow always 0).
+    """
+    Settings = {'CurrentMagnitude': CurrentMagnitude, 'InjectionClocks': InjectionClocks, 'IDACCancel1': IDACCancel1, 'VoutTH1': VoutTH1, 'IDACCancel2': IDACCancel2, 'VoutTH2': VoutTH2}
+    assert SweptParameter in Settings, f"Unknown swept parameter {SweptParameter}, expected one of {list(Settings)}."
+    Settings[SweptParameter] = np.asarray(SweepValues)
+    ReadoutArray = CCM.ReadoutVectorised(**Settings)
+    SweepData = np.zeros((len(SweepValues), 1, 3))
+    SweepData[:, 0, :2] = ReadoutArray.T
+    return SweepData
+
+
+def PixelModelParameters(Fit, SweepValues, SweptParameter, CurrentMagnitude, InjectionClocks, IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156, **FitOptions):
+    """Converts a calibration fit (from `FitSweep()`) into per-pixel bias settings of the charge cancellation model, by comparing each pixel to the model's prediction of the same sweep.
+    For a threshold sweep (VoutTH1 / VoutTH2) the difference between the predicted and measured threshold is the pixel's threshold offset (in DAC units) and the ratio of the gains
+    scales its cancellation current. For a cancellation sweep (IDACCancel1 / IDACCancel2) the ratio of the gains scales its cancellation current.
+    Bad fits keep the nominal settings.
+
+    Args:
+        Fit (dict): Output of `FitSweep()` for the sweep, "Reciprocal" must be "True" for cancellation sweeps.
+        SweepValues, SweptParameter, CurrentMagnitude, InjectionClocks: As `ModelSweep()`.
+        IDACCancel1, VoutTH1, IDACCancel2, VoutTH2 (int, optional): Nominal bias settings, those of the swept stage are corrected per pixel.
+        **FitOptions: Passed to `FitSweep()` for the model prediction e.g. "Level".
+
+    Returns:
+        Parameters (dict): "IDACCancel1", "VoutTH1", "IDACCancel2" and "VoutTH2" as arrays of the pixel shape [*P], which can be passed straight to `ReadoutVectorised()`
+                        (with test pulse arguments of shape [..., *P]) to model every pixel with its own settings.
+    """
+    Stage = SweptStage[SweptParameter]
+    StageNumber = str(Stage + 1)
+    Nominal = {'IDACCancel1': IDACCancel1, 'VoutTH1': VoutTH1, 'IDACCancel2': IDACCancel2, 'VoutTH2': VoutTH2}
+    Threshold = SweptParameter.startswith('VoutTH')
+
+    Model = FitSweep(SweepValues, ModelSweep(SweepValues, SweptParameter, CurrentMagnitude, InjectionClocks, **Nominal), Reciprocal = not Threshold, **FitOptions)
+    Good = ~Fit['Bad'][..., Stage]
+    Parameters = {name: np.full(Good.shape, value, dtype = float) for name, value in Nominal.items()}
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        Scale = Model['Gain'][Stage] / Fit['Gain'][..., Stage]
+    IDACName = f'IDACCancel{StageNumber}'
+    Parameters[IDACName] = np.where(Good & np.isfinite(Scale), Nominal[IDACName] * Scale, Nominal[IDACName])
+
+    if Threshold:
+        Shift = Model['Threshold'][Stage] - Fit['Threshold'][..., Stage]
+        VoutName = f'VoutTH{StageNumber}'
+        Parameters[VoutName] = np.where(Good & np.isfinite(Shift), Nominal[VoutName] + Shift, Nominal[VoutName])
+
+    return Parameters
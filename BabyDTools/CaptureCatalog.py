@@ -0,0 +1,188 @@
+# CaptureCatalog.py
+# Persistent index of the SPI data files in a directory tree, for exact lookup of captures and parameter sweeps
+
+import os
+import json
+
+from BabyDTools.SPI_analysis import parse_filename
+
+
+class CaptureCatalog:
+    """Index of the SPI data files (.npy files following the "Row0to1Data_<test_name>NumCaptures_<N>_<time>.npy" naming scheme) below a root directory.
+    Each file name is parsed once with `SPI_analysis.parse_filename` and the result is saved to an index file. On `refresh()` only directories whose modification time
+    has changed are listed again, so keeping the index up to date costs one stat per directory rather than a full walk of the tree.
+
+    Example:
+        catalog = CaptureCatalog(r"\\\\te0dfs01\\Datastores\\HEXITECdata-mhz\\BabyD")
+        DataStore = SPI.load_data(filepath, catalog = catalog)
+    """
+
+    def __init__(self, rootdir, indexpath = None, ParamSweepStep = 1, refresh = True):
+        """
+        Args:
+            rootdir (str): Directory containing the data files, searched recursively.
+            indexpath (str, optional): Path of the index file. Defaults to ".babyd_catalog.json" in "rootdir".
+            ParamSweepStep (int, optional): Step used in the sweep file names, see `SPI_analysis.parse_filename`. Defaults to 1.
+            refresh (bool, optional): Bring the index up to date on creation. Defaults to True.
+        """
+        self.rootdir = os.path.abspath(rootdir)
+        self.indexpath = indexpath if indexpath is not None else os.path.join(self.rootdir, '.babyd_catalog.json')
+        self.ParamSweepStep = ParamSweepStep
+        self.directories = {} # relative directory path -> {'mtime', 'subdirs', 'files': {name: fileinfo}}
+        self._folders = {} # absolute directory path -> parsed information of its files (see `entries()`), built from "directories" by `_build_lookups()`
+        self._captures = {} # (absolute directory path, test name, number of captures, timestamp) -> parsed information of the files of the capture
+        self._sweeps = {} # (absolute directory path, sweep name) -> parsed information of the files of the sweep
+
+        if os.path.exists(self.indexpath):
+            with open(self.indexpath) as f:
+                index = json.load(f)
+            if index.get('ParamSweepStep') == ParamSweepStep:
+                self.directories = index['directories']
+
+        if refresh is True:
+            self.refresh()
+        else:
+            self._build_lookups()
+
+    def refresh(self):
+        """Rescans the directories which have been added or modified since the last refresh and saves the index if anything changed.
+
+        Returns:
+            rescanned (int): Number of directories which were listed again.
+        """
+        directories = {}
+        rescanned = 0
+        pending = ['.']
+        while pending:
+            reldir = pending.pop()
+            absdir = os.path.normpath(os.path.join(self.rootdir, reldir))
+            try:
+                mtime = os.stat(absdir).st_mtime
+            except FileNotFoundError:
+                continue
+
+            cached = self.directories.get(reldir)
+            if cached is not None and cached['mtime'] == mtime:
+                entry = cached
+            else:
+                entry = {'mtime': mtime, 'subdirs': [], 'files': {}}
+                with os.scandir(absdir) as it:
+                    for item in it:
+                        if item.is_dir():
+                            entry['subdirs'] += [os.path.normpath(os.path.join(reldir, item.name))]
+                        elif item.name.endswith('.npy'):
+                            fileinfo = parse_filename(item.name, ParamSweepStep = self.ParamSweepStep)
+                            if fileinfo is not None:
+                                entry['files'][item.name] = fileinfo
+                rescanned += 1
+
+            directories[reldir] = entry
+            pending += entry['subdirs']
+
+        changed = rescanned > 0 or directories.keys() != self.directories.keys()
+        self.directories = directories
+        self._build_lookups()
+        if changed:
+            self.save()
+        return rescanned
+
+    def _build_lookups(self):
+        """Groups the indexed files by directory, by capture and by sweep, so lookups only touch the matching files however large the tree is."""
+        self._folders, self._captures, self._sweeps = {}, {}, {}
+        for reldir, entry in self.directories.items():
+            absdir = os.path.normpath(os.path.join(self.rootdir, reldir))
+            for name, fileinfo in entry['files'].items():
+                fileinfo = dict(fileinfo, path = os.path.join(absdir, name))
+                self._folders.setdefault(absdir, []).append(fileinfo)
+                self._captures.setdefault((absdir, fileinfo['test_name'], fileinfo['NumCaptures'], fileinfo['timestamp']), []).append(fileinfo)
+                if fileinfo['SweepName'] is not None:
+                    self._sweeps.setdefault((absdir, fileinfo['SweepName']), []).append(fileinfo)
+        for lookup in (self._folders, self._captures, self._sweeps):
+            for matches in lookup.values():
+                matches.sort(key = _sort_key)
+
+    def save(self):
+        """Writes the index file."""
+        created = not os.path.exists(self.indexpath)
+        self._write()
+
+        # creating the index file modifies the directory it is in, record the new mtime so the directory is not rescanned on the next refresh
+        reldir = os.path.relpath(os.path.dirname(os.path.abspath(self.indexpath)), self.rootdir)
+        if created and reldir in self.directories:
+            self.directories[reldir]['mtime'] = os.stat(os.path.dirname(os.path.abspath(self.indexpath))).st_mtime
+            self._write()
+
+    def _write(self):
+        # overwritten in place, replacing the file would modify the directory mtime on every save
+        with open(self.indexpath, 'w') as f:
+            json.dump({'ParamSweepStep': self.ParamSweepStep, 'directories': self.directories}, f)
+
+    def entries(self):
+        """Iterates over the parsed information of every indexed file, with the absolute file path added as "path"."""
+        for matches in self._folders.values():
+            yield from matches
+
+    def find(self, dirpath = None, **fields):
+        """Returns every indexed file whose parsed fields exactly equal those given, e.g. `find(test_name = 'Dark', NumCaptures = 1000)`.
+        With "dirpath" only the files of that directory are compared.
+
+        Args:
+            dirpath (str, optional): Only return files in this directory (not including subdirectories). Defaults to None.
+            **fields: Any of the fields returned by `SPI_analysis.parse_filename`.
+
+        Returns:
+            matches (list): Parsed information of the matching files (see `entries()`), sorted by sweep value, row and path.
+        """
+        if dirpath is not None and 'SweepName' in fields:
+            candidates = self._sweeps.get((os.path.normpath(os.path.abspath(dirpath)), fields['SweepName']), [])
+        elif dirpath is not None:
+            candidates = self._folders.get(os.path.normpath(os.path.abspath(dirpath)), [])
+        elif 'SweepName' in fields:
+            candidates = sorted((fileinfo for (_, name), matches in self._sweeps.items() if name == fields['SweepName'] for fileinfo in matches), key = _sort_key)
+        else:
+            candidates = sorted(self.entries(), key = _sort_key)
+        return [fileinfo for fileinfo in candidates if all(fileinfo[key] == value for key, value in fields.items())]
+
+    def capture_files(self, filepath):
+        """Returns the paths of all row-pair files of the capture "filepath" belongs to: files in the same directory with exactly the same test name, number of captures and timestamp.
+
+        Args:
+            filepath (str): Path of any one of the row-pair files of the capture.
+
+        Returns:
+            filepaths (list): Paths of the row-pair files, sorted by row.
+        """
+        fileinfo = parse_filename(filepath, ParamSweepStep = self.ParamSweepStep)
+        assert fileinfo is not None, f"{filepath} does not follow the SPI data file naming scheme."
+        matches = self._captures.get((os.path.dirname(os.path.abspath(filepath)), fileinfo['test_name'], fileinfo['NumCaptures'], fileinfo['timestamp']), [])
+        return [match['path'] for match in matches]
+
+    def sweeps(self):
+        """Returns the names of all of the indexed parameter sweeps (see "SweepName" in `SPI_analysis.parse_filename`), once per name even if it was recorded in several folders."""
+        return sorted({name for _, name in self._sweeps})
+
+    def sweep_folders(self, SweepName):
+        """Returns the folders containing a parameter sweep named "SweepName", sorted."""
+        return sorted(absdir for absdir, name in self._sweeps if name == SweepName)
+
+    def sweep_files(self, SweepName = None, folderpath = None):
+        """Returns the files of a parameter sweep, selected by sweep name, by folder, or both.
+
+        Args:
+            SweepName (str, optional): Name of the sweep as returned by `sweeps()`. Defaults to None.
+            folderpath (str, optional): Folder containing the sweep files, required if a sweep of the same name was recorded in more than one folder. Defaults to None.
+
+        Returns:
+            matches (list): Parsed information of the sweep files (see `entries()`), sorted by sweep value and row.
+        """
+        if SweepName is None:
+            matches = self.find(dirpath = folderpath)
+        else:
+            folders = self.sweep_folders(SweepName)
+            assert folderpath is not None or len(folders) <= 1, f"Sweep {SweepName} was recorded in {len(folders)} folders ({', '.join(folders)}), pass the folderpath of the one to load."
+            matches = self.find(dirpath = folderpath, SweepName = SweepName)
+        return [fileinfo for fileinfo in matches if fileinfo['SweepValue'] is not None]
+
+
+def _sort_key(fileinfo):
+    return (fileinfo['SweepValue'] if fileinfo['SweepValue'] is not None else 0, fileinfo['Row'], fileinfo['path'])
@@ -0,0 +1,232 @@
+# CaptureStore.py
+# Consolidated, chunked HDF5 storage of SPI frame captures and parameter sweeps
+
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+from BabyDTools import SPI_analysis as SPI
+
+# HDF5 files written by this module contain either a "frames" dataset of shape [frames,16,16,3] (single capture) or a "sweep" dataset of shape [steps,frames,16,16,3]
+# together with a "sweep_values" dataset (parameter sweep). Both are chunked by a block of frames from a single row pair, so reading a frame range or the time series of one
+# pixel only reads the chunks it needs and row pairs that were never written take up no space.
+
+
+class HDF5Row:
+    """Lazy [N,16,3] view of a single row of an HDF5 capture, with the same indexing as one row of the array returned by `SPI_analysis.build_array`.
+    Used as the row source of `SPI_analysis.LazyFrameArray` so only the requested part of the dataset is read.
+    """
+
+    def __init__(self, dataset, row, step = None):
+        self.dataset = dataset
+        self.row = row
+        self.step = step # index of the sweep step for "sweep" datasets
+        frames_axis = 0 if step is None else 1
+        self.shape = (dataset.shape[frames_axis], dataset.shape[frames_axis + 2], dataset.shape[frames_axis + 3])
+        self.dtype = dataset.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # h5py only supports integers and positive step slices efficiently, anything else is applied to the (smaller) read block afterwards
+        readkey, postkey = [], []
+        for k in key:
+            if isinstance(k, (int, np.integer)) or (isinstance(k, slice) and (k.step is None or k.step > 0)):
+                readkey += [k]
+                if not isinstance(k, (int, np.integer)):
+                    postkey += [slice(None)]
+            else:
+                readkey += [slice(None)]
+                postkey += [k]
+
+        if self.step is None:
+            block = self.dataset[(readkey[0], self.row) + tuple(readkey[1:])]
+        else:
+            block = self.dataset[(self.step, readkey[0], self.row) + tuple(readkey[1:])]
+        if all(isinstance(k, slice) and k == slice(None) for k in postkey):
+            return block
+        return block[tuple(postkey)]
+
+    def __array__(self, dtype = None, copy = None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+
+def _create_dataset(h5file, name, shape, dtype, chunk_frames, frames_axis, compression, compression_opts, shuffle):
+    chunks = list(shape)
+    chunks[:frames_axis] = [1] * frames_axis
+    chunks[frames_axis] = min(chunk_frames, shape[frames_axis])
+    chunks[frames_axis + 1] = 2 # one row pair per chunk
+    return h5file.create_dataset(name, shape = shape, dtype = dtype, chunks = tuple(chunks), compression = compression, compression_opts = compression_opts, shuffle = shuffle)
+
+
+def convert_capture(filepath, h5path = None, chunk_frames = 1024, compression = None, compression_opts = None, shuffle = False, bias_settings = None, catalog = None):
+    """Packs all row-pair .npy files of a capture into a single HDF5 file with a frame-chunked "frames" dataset of shape [frames,16,16,3].
+    Row-pair files are memory-mapped and copied one block of frames at a time, so the capture never has to fit in memory.
+
+    Args:
+        filepath (str): Path of any one of the row-pair .npy files of the capture, as for `SPI_analysis.load_data`.
+        h5path (str, optional): Path of the HDF5 file to write. Defaults to the capture folder path followed by "_<test_name>NumCaptures_<N>.h5", next to (not inside) the folder
+                                so the loaders of the row-pair files never pick it up.
+        chunk_frames (int, optional): Number of frames per chunk. Defaults to 1024.
+        compression (str, optional): Lossless compression filter passed to h5py, e.g. "gzip" or "lzf". Defaults to None.
+        compression_opts (int, optional): Compression level for "gzip" (0-9). Defaults to None.
+        shuffle (bool, optional): Apply the HDF5 shuffle filter before compression, usually improves the compression ratio. Defaults to False.
+        bias_settings (dict, optional): Bias settings of the capture (e.g. {"IDACCancel1": 1502, "VoutTH1": 1763}), stored as attributes of the dataset. Defaults to None.
+        catalog (CaptureCatalog, optional): Used to find the files of the capture, see `SPI_analysis.load_data`. Defaults to None.
+
+    Returns:
+        h5path (str): Path of the HDF5 file written.
+    """
+    import h5py
+
+    fileinfo = SPI.parse_filename(filepath)
+    datastore = SPI.load_data(filepath, framecapture = True, mmap_mode = 'r', catalog = catalog)
+    if h5path is None:
+        h5path = os.path.abspath(os.path.dirname(filepath)) + f"_{fileinfo['test_name']}NumCaptures_{fileinfo['NumCaptures']}.h5"
+
+    items = {int(key.split('Row')[1].split('to')[0]): item for key, item in datastore.items()}
+    first = next(iter(items.values()))
+    numframes = first.shape[1]
+
+    with h5py.File(h5path, 'w') as h5file:
+        dataset = _create_dataset(h5file, 'frames', (numframes, 16) + first.shape[2:], first.dtype, chunk_frames, 0, compression, compression_opts, shuffle)
+        for row, item in sorted(items.items()):
+            for start in range(0, numframes, chunk_frames):
+                stop = min(start + chunk_frames, numframes)
+                dataset[start:stop, row:row + 2] = np.asarray(item[:, start:stop]).transpose(1, 0, 2, 3)
+
+        dataset.attrs['test_name'] = fileinfo['test_name']
+        dataset.attrs['NumCaptures'] = fileinfo['NumCaptures']
+        dataset.attrs['RowPairs'] = sorted(items)
+        for name, value in (bias_settings or {}).items():
+            dataset.attrs[name] = value
+
+    return h5path
+
+
+def convert_sweep(folderpath, h5path = None, ParamSweepStep = 1, chunk_frames = 1024, compression = None, compression_opts = None, shuffle = False, bias_settings = None):
+    """Packs a parameter sweep folder into a single HDF5 file with a "sweep" dataset of shape [steps,frames,16,16,3] and the sweep values in "sweep_values".
+    All row pairs found in the folder are stored, steps are ordered by sweep value.
+
+    Args:
+        folderpath (str): Folder containing the sweep .npy files, as for `SPI_analysis.paramsweep_loaddata`.
+        h5path (str, optional): Path of the HDF5 file to write. Defaults to the folder path with a ".h5" extension.
+        ParamSweepStep (int, optional): Step used in the sweep file names. Defaults to 1.
+        Other arguments as `convert_capture()`.
+
+    Returns:
+        h5path (str): Path of the HDF5 file written.
+    """
+    import h5py
+
+    files = [(SPI.parse_filename(name, ParamSweepStep = ParamSweepStep), os.path.join(folderpath, name)) for name in sorted(os.listdir(folderpath)) if name.endswith('.npy')]
+    files = [(fileinfo, path) for fileinfo, path in files if fileinfo is not None and fileinfo['SweepValue'] is not None]
+    assert len(files) > 0, f"No sweep files found in {folderpath}."
+    if h5path is None:
+        h5path = os.path.normpath(folderpath) + '.h5'
+
+    SweepValues = sorted({fileinfo['SweepValue'] for fileinfo, _ in files})
+    RowPairs = sorted({fileinfo['Row'] for fileinfo, _ in files})
+    first = np.load(files[0][1], mmap_mode = 'r')
+    numframes = first.shape[1]
+
+    with h5py.File(h5path, 'w') as h5file:
+        dataset = _create_dataset(h5file, 'sweep', (len(SweepValues), numframes, 16) + first.shape[2:], first.dtype, chunk_frames, 1, compression, compression_opts, shuffle)
+        h5file.create_dataset('sweep_values', data = np.array(SweepValues))
+        for fileinfo, path in files:
+            step, row = SweepValues.index(fileinfo['SweepValue']), fileinfo['Row']
+            item = np.load(path, mmap_mode = 'r')
+            for start in range(0, numframes, chunk_frames):
+                stop = min(start + chunk_frames, numframes)
+                dataset[step, start:stop, row:row + 2] = np.asarray(item[:, start:stop]).transpose(1, 0, 2, 3)
+
+        fileinfo = files[0][0]
+        dataset.attrs['SweepName'] = fileinfo['SweepName']
+        dataset.attrs['SweepStart'] = fileinfo['SweepStart'] if fileinfo['SweepStart'] is not None else SweepValues[0]
+        dataset.attrs['SweepStop'] = fileinfo['SweepStop'] if fileinfo['SweepStop'] is not None else SweepValues[-1]
+        dataset.attrs['ParamSweepStep'] = ParamSweepStep
+        dataset.attrs['NumCaptures'] = numframes
+        dataset.attrs['RowPairs'] = RowPairs
+        for name, value in (bias_settings or {}).items():
+            dataset.attrs[name] = value
+
+    return h5path
+
+
+def is_hdf5(filepath):
+    """Checks if "filepath" is an HDF5 capture store (by extension)."""
+    return os.path.splitext(filepath)[1].lower() in ('.h5', '.hdf5')
+
+
+class HDF5Capture(dict):
+    """Row-pair dictionary of a capture loaded lazily by `load_capture()`, which holds the HDF5 file open while its row views are in use.
+    Close it with `close()`, or use it in a with statement: `with SPI_analysis.load_data(h5path, mmap_mode = 'r') as datastore: ...`.
+    """
+
+    def __init__(self, h5file):
+        super().__init__()
+        self.file = h5file
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_capture(h5path, lazy = True):
+    """Loads a capture written by `convert_capture()` in the dictionary format of `SPI_analysis.load_data`, keyed by "Row<r>to<r+1>Data" + test name.
+
+    Args:
+        h5path (str): Path of the HDF5 capture file.
+        lazy (bool, optional): If "True" each entry is a pair of `HDF5Row` views which read from the file on access, returned as an `HDF5Capture` which keeps the file open until it is closed,
+                            else each entry is a [2,N,16,3] numpy array read from the file and the file is closed. Defaults to True.
+
+    Returns:
+        datastore (dict): Row-pair data of the capture.
+    """
+    import h5py
+
+    if lazy is False:
+        with h5py.File(h5path, 'r') as h5file:
+            dataset = h5file['frames']
+            return {f'Row{row}to{row + 1}Data' + dataset.attrs['test_name']: dataset[:, row:row + 2].transpose(1, 0, 2, 3) for row in dataset.attrs['RowPairs']}
+
+    h5file = h5py.File(h5path, 'r')
+    dataset = h5file['frames']
+    datastore = HDF5Capture(h5file)
+    for row in dataset.attrs['RowPairs']:
+        datastore[f'Row{row}to{row + 1}Data' + dataset.attrs['test_name']] = [HDF5Row(dataset, row), HDF5Row(dataset, row + 1)]
+    return datastore
+
+
+@contextmanager
+def load_sweep(h5path):
+    """Opens a sweep written by `convert_sweep()` in a with statement, the file is closed when the block is left:
+    `with CaptureStore.load_sweep(h5path) as (SweepValues, dataset): ...`
+
+    Args:
+        h5path (str): Path of the HDF5 sweep file.
+
+    Yields:
+        SweepValues (NDArray): Values of the swept parameter, one per step.
+        dataset (h5py.Dataset): Lazy [steps,frames,16,16,3] dataset, slicing it only reads the chunks needed. Its attributes hold the sweep range and bias settings.
+    """
+    import h5py
+
+    with h5py.File(h5path, 'r') as h5file:
+        yield h5file['sweep_values'][:], h5file['sweep']
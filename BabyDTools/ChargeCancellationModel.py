@@ -1,4 +1,6 @@
 #%%
+from BabyDTools.Instrumentation import instrument_module
+
 def IDAC_to_Charge(CurrentMagnitude, InjectionClocks,  IDAC_ID = "IDACCal"):
     """Function to package the conversion from a DAC value to the associated amount of charge injected.
     This can be used from DAC values which represent either the magnitude of the current source applied or the 
@@ -99,9 +101,47 @@ def VDAC_to_voltage(VDAC, VrefAmp = False):
     voltage = (VDAC * 1/4096) + offset  # the 1 is indicate 1 V which is the maximum voltage that the VDACs can set
     return voltage
 
+def ModelConstants():
+    """Collects the constants of the model by evaluating each of the unit conversion functions at unit input. 
+    As all conversions are linear this fully describes the model, and is used to key cached results (see `ReadoutLUT`) so they are invalidated if any constant is changed.
+
+    Returns:
+        Constants (dict): Conversion factors of the model keyed by the function (and current source / stage) they belong to.
+    """
+    Constants = {f'IDAC_to_Charge_{IDAC_ID}': IDAC_to_Charge(1, 1, IDAC_ID = IDAC_ID) for IDAC_ID in ("IDACCal", "IDACCancel1", "IDACCancel2")}
+    Constants.update({f'Charge_to_CapacitorVoltage_{Stage}': Charge_to_CapacitorVoltage(1, Stage_Select = Stage) for Stage in ("1", "2")})
+    Constants['Charge_to_Energy'] = Charge_to_Energy(1)
+    Constants['VDAC_to_voltage'] = VDAC_to_voltage(1)
+    Constants['VrefAmp'] = VDAC_to_voltage(VDAC = 2268, VrefAmp = True)
+    Constants['ResidualAmplification'] = ResidualAmplification
+    return Constants
+
+### Residual voltage (above VrefAmp) is amplified by this factor in transfer from the coarse to the fine stage
+ResidualAmplification = 4
+
+def FinePerCoarse(IDACCancel1 = 1502, IDACCancel2 = 919):
+    """Number of fine counts equivalent to one coarse count for the given cancellation currents: the voltage cancelled by one coarse step, amplified into the fine stage, 
+    divided by the voltage cancelled by one fine step. Used to combine coarse and fine counts into a single value (e.g. 118.18 at the default settings).
+
+    Args:
+        IDACCancel1 (int or NDArray, optional): DAC setting of the 1st (Coarse) stage cancellation current. Defaults to 1502.
+        IDACCancel2 (int or NDArray, optional): DAC setting of the 2nd (Fine) stage cancellation current. Defaults to 919.
+
+    Returns:
+        FinePerCoarse (float or NDArray): Fine counts per coarse count.
+    """
+    CoarseStep = Charge_to_CapacitorVoltage(IDAC_to_Charge(IDACCancel1, 1, IDAC_ID = "IDACCancel1"), Stage_Select = "1")
+    FineStep = Charge_to_CapacitorVoltage(IDAC_to_Charge(IDACCancel2, 1, IDAC_ID = "IDACCancel2"), Stage_Select = "2")
+    return CoarseStep * ResidualAmplification / FineStep
+
+### Stage specific default settings (IDACCancel, VoutTH) and cancellation current source - set to be equivalent to 25 photons at 30 keV per Coarse Cancellation and 0.2 photons at 30 keV per Fine Cancellation
+StageDefaults = {"1": (1502, 1763, "IDACCancel1"),
+                 "2": (919, 1156, "IDACCancel2")}
+
 def ChargeCancellation(VoltageStored, IDACCancel, VoutTH, Stage_Select, print_details = False):
     """Function which calculates the coarse or fine stage count based on cancellation voltage stored on the respective stage according to specified cancellation current ("IDACCancel") and threshold voltage (VoutTH) of the stage.
     Can select between the coarse and fine stage in which cancellation is occurring and the respective coarse or fine count (depending on "Stage_Select") is returned alongside any residual voltage.
+    This is a scalar wrapper around `ChargeCancellationVectorised()`.
 
     Args:
         VoltageStored (float): Voltage amount stored the 1st (Coarse) or 2nd (Fine) stage capacitor as selected by "Stage_Select". 
@@ -117,55 +157,147 @@ def ChargeCancellation(VoltageStored, IDACCancel, VoutTH, Stage_Select, print_de
         Count (int): The count associated with the number of times the selected stage's cancellation clock has fired - equivalent to X number of Y photons at Z keV.
         ResidualVoltage (float): Left over voltage post cancellation, utilised in simulation to propagate an injected charge through the 1st (Coarse) stage into the 2nd (Fine) stage.
     """
-    
-    ### Stage Specific parameters - set to be equivalent to 
-    if Stage_Select == "1":
-        default_IDACCancel = 1502
-        default_VoutTH = 1763
-        IDAC_ID = "IDACCancel1"
-    elif Stage_Select == "2":
-        default_IDACCancel = 919
-        default_VoutTH = 1156 
-        IDAC_ID = "IDACCancel2"
-    else:
+    if Stage_Select not in StageDefaults:
         print('Invalid stage selection, chose "1" for first stage (Coarse) and "2" for second stage (Fine).')
         return    
     
     # display if variation in the IDACCancel value supplied
     if print_details is True:
-        if abs(default_IDACCancel - IDACCancel) > 0: 
-            print(f"Selected non-default setting for IDACCancel: {IDACCancel} (default is {default_IDACCancel}).")
-        else:
-            print(f"Default setting for IDACCancel was selected: {IDACCancel}")
-
-        if abs(default_VoutTH - VoutTH) > 0: 
-            print(f"Selected non-default setting for VoutTH: {VoutTH} (default is {default_VoutTH}).")
-        else:
-            print(f"Default setting for VoutTH was selected: {VoutTH}")
+        PrintStageDetails(IDACCancel = IDACCancel, VoutTH = VoutTH, Stage_Select = Stage_Select)
 
-    ### Calcualte voltage versions of the VDAC and IDAC settings to allow for comparisons with VoltageStored
-    # define VoutTH1 in voltage
-    V_VoutTH = VDAC_to_voltage(VoutTH)
-    # define Voltage reduction upon a single clock of IDACCancel1
-    V_IDACCan = Charge_to_CapacitorVoltage(Charge=IDAC_to_Charge(CurrentMagnitude = IDACCancel, InjectionClocks = 1,  IDAC_ID = IDAC_ID),Stage_Select=Stage_Select)
-
-    Count = 0
-    while VoltageStored >= V_VoutTH:
-        VoltageStored -= V_IDACCan # Reduce voltage equivalent to the amount of charge discharge from capacitor upon incidence of IDACCancel1
-        Count += 1 # increment coarse stage counter by 1
+    Count, ResidualVoltage = ChargeCancellationVectorised(VoltageStored = VoltageStored, IDACCancel = IDACCancel, VoutTH = VoutTH, Stage_Select = Stage_Select)
+    Count, ResidualVoltage = int(Count), float(ResidualVoltage)
     
     ### pass any voltage < VoutTH as residual
-    ResidualVoltage = VoltageStored
     assert ResidualVoltage < VoutTH, "Residual voltage has not been determined correctly, is larger than selected stage threshold"
     
     # return coarse count and residual voltage
     return Count, ResidualVoltage
 
 
+def PrintStageDetails(IDACCancel, VoutTH, Stage_Select):
+    """Prints whether the "IDACCancel" and "VoutTH" settings supplied for a stage are the same as or differ from the stage default settings.
+
+    Args:
+        IDACCancel (int): DAC setting of the selected stage cancellation current.
+        VoutTH (int): DAC setting of the selected stage threshold voltage.
+        Stage_Select (str): Selects between the 1st (Coarse) and 2nd (Fine) stages using the strings "1" and "2" respectively.
+    """
+    default_IDACCancel, default_VoutTH, _ = StageDefaults[Stage_Select]
+
+    if abs(default_IDACCancel - IDACCancel) > 0: 
+        print(f"Selected non-default setting for IDACCancel: {IDACCancel} (default is {default_IDACCancel}).")
+    else:
+        print(f"Default setting for IDACCancel was selected: {IDACCancel}")
+
+    if abs(default_VoutTH - VoutTH) > 0: 
+        print(f"Selected non-default setting for VoutTH: {VoutTH} (default is {default_VoutTH}).")
+    else:
+        print(f"Default setting for VoutTH was selected: {VoutTH}")
+
+
+def ChargeCancellationVectorised(VoltageStored, IDACCancel, VoutTH, Stage_Select):
+    """Vectorised version of `ChargeCancellation()` which calculates the stage count and residual voltage for arrays of any shape in a single pass.
+    Rather than subtracting one cancellation step at a time, the count is found from the closed form: Count = floor((VoltageStored - V_VoutTH) / V_IDACCancel) + 1 (0 if below threshold).
+    Entries within floating point rounding of a threshold boundary are re-evaluated by repeated subtraction so that counts are identical to the original iterative model.
+    All of "VoltageStored", "IDACCancel" and "VoutTH" may be scalars or arrays and are broadcast together.
+
+    Args:
+        VoltageStored (float or NDArray): Voltage stored on the 1st (Coarse) or 2nd (Fine) stage capacitor as selected by "Stage_Select". Units given in volts (V).
+        IDACCancel (int or NDArray): DAC setting(s) defining the magnitude of the cancellation current for the selected stage. Takes values between 0 and 4095.
+        VoutTH (int or NDArray): DAC setting(s) defining the threshold voltage for the selected stage. Takes values between 0 and 4095.
+        Stage_Select (str): Selects between the 1st (Coarse) and 2nd (Fine) stages using the strings "1" and "2" respectively.
+
+    Returns:
+        Count (NDArray): Integer array of the number of times the selected stage's cancellation clock has fired. An "IDACCancel" of 0 can never cancel a voltage above threshold
+                        (the scalar model would never terminate), these entries are returned as -1.
+        ResidualVoltage (NDArray): Voltage left over post cancellation, same shape as "Count". Units given in volts (V).
+    """
+    import numpy as np
+
+    if Stage_Select not in StageDefaults:
+        print('Invalid stage selection, chose "1" for first stage (Coarse) and "2" for second stage (Fine).')
+        return    
+    IDAC_ID = StageDefaults[Stage_Select][2]
+
+    ### Calcualte voltage versions of the VDAC and IDAC settings to allow for comparisons with VoltageStored
+    V_VoutTH = VDAC_to_voltage(np.asarray(VoutTH, dtype=float))
+    V_IDACCan = Charge_to_CapacitorVoltage(Charge=IDAC_to_Charge(CurrentMagnitude = np.asarray(IDACCancel, dtype=float), InjectionClocks = 1,  IDAC_ID = IDAC_ID),Stage_Select=Stage_Select)
+    VoltageStored, V_VoutTH, V_IDACCan = np.broadcast_arrays(np.asarray(VoltageStored, dtype=float), V_VoutTH, V_IDACCan)
+
+    Above = VoltageStored >= V_VoutTH
+    Valid = V_IDACCan > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Count = np.where(Above & Valid, np.floor((VoltageStored - V_VoutTH) / np.where(Valid, V_IDACCan, 1.0)) + 1, 0).astype(np.int64)
+    ResidualVoltage = np.asarray(VoltageStored - Count * V_IDACCan)
+
+    # Repeated subtraction accumulates rounding error of up to ~1 ulp per step, so entries whose residual lands within that error of a threshold
+    # boundary can round either way. These (rare) entries are re-evaluated with the original iterative subtraction, vectorised over the subset.
+    Tolerance = (Count + 4) * 2 * np.finfo(float).eps * (np.abs(VoltageStored) + np.abs(V_VoutTH) + np.abs(V_IDACCan))
+    Ambiguous = Above & Valid & ((np.abs(ResidualVoltage - V_VoutTH) <= Tolerance) | (np.abs(ResidualVoltage + V_IDACCan - V_VoutTH) <= Tolerance))
+    if np.any(Ambiguous):
+        Voltage = VoltageStored[Ambiguous].copy()
+        Threshold = V_VoutTH[Ambiguous]
+        Step = V_IDACCan[Ambiguous]
+        SubCount = np.zeros(Voltage.shape, dtype=np.int64)
+        Active = Voltage >= Threshold
+        while np.any(Active):
+            Voltage[Active] -= Step[Active]
+            SubCount[Active] += 1
+            Active &= Voltage >= Threshold
+        Count[Ambiguous] = SubCount
+        ResidualVoltage[Ambiguous] = Voltage
+
+    # a zero cancellation current never brings the voltage below threshold
+    Count[Above & ~Valid] = -1
+
+    return Count, ResidualVoltage
+
+
+def ReadoutVectorised(CurrentMagnitude, InjectionClocks, IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156, return_residuals = False):
+    """NumPy native version of `Readout()` which propagates an injected charge through both stages for input arrays of any shape in one pass.
+    All arguments are broadcast together, so any of the test pulse or bias settings can be supplied as arrays (e.g. a 4096 point IDACCal sweep, or per-pixel thresholds).
+
+    Args:
+        CurrentMagnitude (int or NDArray): DAC value associated with the magnitude of the test pulse current "IDACCal". Takes values between 0 and 4095.
+        InjectionClocks (int or NDArray): Length of time in 2 ns clocks that the current source was active high for.
+        IDACCancel1 (int or NDArray, optional): DAC setting of the 1st (Coarse) stage cancellation current. Defaults to 1502.
+        VoutTH1 (int or NDArray, optional): DAC setting of the 1st (Coarse) stage threshold voltage. Defaults to 1763.
+        IDACCancel2 (int or NDArray, optional): DAC setting of the 2nd (Fine) stage cancellation current. Defaults to 919.
+        VoutTH2 (int or NDArray, optional): DAC setting of the 2nd (Fine) stage threshold voltage. Defaults to 1156.
+        return_residuals (bool, optional): If "True" the coarse stage residual voltage and the amplified residual voltage passed to the fine stage are also returned. Defaults to False.
+
+    Returns:
+        ReadoutArray (NDArray): Integer array of shape (2, *S) where S is the broadcast shape of the arguments, index 0 is the coarse count and index 1 the fine count.
+        ResidualVoltage (NDArray, optional): Coarse stage residual voltage of shape S, only returned if "return_residuals" is "True". Units given in volts (V).
+        Amp_ResidualVoltage (NDArray, optional): Amplified residual voltage on the fine stage of shape S, only returned if "return_residuals" is "True". Units given in volts (V).
+    """
+    import numpy as np
+
+    ### Charge injected via test pusle circuit to mimic photon detection
+    InjectedCharge = IDAC_to_Charge(np.asarray(CurrentMagnitude, dtype=float), np.asarray(InjectionClocks, dtype=float),  IDAC_ID = "IDACCal")
+
+    ### Charge from test pulse is stored as a voltage on first stage capacitor, offset by the VrefAmp baseline
+    VrefAmp = VDAC_to_voltage(VDAC = 2268, VrefAmp = True) 
+    VoltageStored_CoarseStage = Charge_to_CapacitorVoltage(InjectedCharge, Stage_Select = "1") + VrefAmp
+
+    CoarseCount, ResidualVoltage = ChargeCancellationVectorised(VoltageStored = VoltageStored_CoarseStage, IDACCancel = IDACCancel1, VoutTH = VoutTH1, Stage_Select = "1")
+    # Residual Voltage is amplified by factor of 4 in transfer to fine stage - only that above the reference voltage is multiplied by 4
+    Amp_ResidualVoltage = ((ResidualVoltage - VrefAmp) * ResidualAmplification) + VrefAmp
+    FineCount, _ = ChargeCancellationVectorised(VoltageStored = Amp_ResidualVoltage, IDACCancel = IDACCancel2, VoutTH = VoutTH2, Stage_Select = "2")
+
+    CoarseCount, FineCount = np.broadcast_arrays(CoarseCount, FineCount)
+    ReadoutArray = np.stack([CoarseCount, FineCount])
+
+    if return_residuals is True:
+        return ReadoutArray, ResidualVoltage, Amp_ResidualVoltage
+    return ReadoutArray
+
 
 def Readout(CurrentMagnitude, InjectionClocks, IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156, print_details = False):
     """Function which simulated the readout of the Baby D detector for a specified amount of charge injected as defined by "CurrentMagnitude" and "InjectionClocks" passed through the `IDAC_to_Charge()` function.
     Default values are equivalent to 25 photons at 30 keV per Coarse Cancellation and 0.2 photons at 30 keV per Fine Cancellation, but this can be varied via the function arguments.
+    This is a wrapper around `ReadoutVectorised()` which keeps the original (2,N) output format.
 
     Args:
         CurrentMagnitude (int): DAC value associated with the magnitude of the current source applied. In this case is particularly related to the test pulse current "IDACCal". Takes values between 0 and 4095.
@@ -181,64 +313,94 @@ def Readout(CurrentMagnitude, InjectionClocks, IDACCancel1 = 1502, VoutTH1 = 176
                                 the equivalent dimension numpy array is returned with dim 2 in the zeroth axis (2,N).
     """
     import numpy as np
-    # Check if test pulse input is not a single value, if not ensure it is in format that it can be correctly processed
-        
-    if isinstance(CurrentMagnitude,int) is True and isinstance(InjectionClocks,int) is True: 
-        pass
 
-    elif isinstance(CurrentMagnitude,int) is False and isinstance(InjectionClocks,int) is False: 
-        if isinstance(CurrentMagnitude,list) is True:
-            CurrentMagnitude = np.array(CurrentMagnitude)
-        if isinstance(InjectionClocks,list) is True:
-            InjectionClocks = np.array(InjectionClocks)
+    CurrentMagnitude = np.asarray(CurrentMagnitude)
+    InjectionClocks = np.asarray(InjectionClocks)
+    if CurrentMagnitude.ndim > 0 and InjectionClocks.ndim > 0:
+        assert len(CurrentMagnitude) == len(InjectionClocks), "Arguments are not of the same length."
 
-    else:
+    if print_details is True:
+        PrintStageDetails(IDACCancel = IDACCancel1, VoutTH = VoutTH1, Stage_Select = "1")
+        PrintStageDetails(IDACCancel = IDACCancel2, VoutTH = VoutTH2, Stage_Select = "2")
 
-        if isinstance(CurrentMagnitude,int) is True:
-            CurrentMagnitude = [CurrentMagnitude]*len(InjectionClocks)
-            CurrentMagnitude = np.array(CurrentMagnitude)
-            if isinstance(InjectionClocks,list) is True:
-                InjectionClocks = np.array(InjectionClocks)
-            assert len(CurrentMagnitude) == len(InjectionClocks), "Arguments are not of the same length."
+    ReadoutArray = ReadoutVectorised(CurrentMagnitude, InjectionClocks, IDACCancel1 = IDACCancel1, VoutTH1 = VoutTH1, IDACCancel2 = IDACCancel2, VoutTH2 = VoutTH2)
+    ReadoutList = ReadoutArray.reshape(2, -1).astype(float)
 
-        elif isinstance(InjectionClocks,int) is True:
-            InjectionClocks = [InjectionClocks]*len(CurrentMagnitude)
-            InjectionClocks = np.array(InjectionClocks)
-            if isinstance(CurrentMagnitude,list) is True:
-                CurrentMagnitude = np.array(CurrentMagnitude)
-            assert len(CurrentMagnitude) == len(InjectionClocks), "Arguments are not of the same length."
+    return ReadoutList
 
-        else:
-            print("some other datainput type")
-            print(type(CurrentMagnitude), type(InjectionClocks))
 
+### Order of the axes of the scan grid returned by `ReadoutScan()`
+ScanParameters = ("CurrentMagnitude", "InjectionClocks", "IDACCancel1", "VoutTH1", "IDACCancel2", "VoutTH2")
 
-            
-    ### Charge injected via test pusle circuit to mimic photon detection
-    InjectedCharge = IDAC_to_Charge(CurrentMagnitude, InjectionClocks,  IDAC_ID = "IDACCal")
+def _ReadoutScanChunk(Grid, Start, Stop):
+    """Evaluates the flattened scan grid elements [Start, Stop) with `ReadoutVectorised()`. Defined at module level so it can be sent to a process pool."""
+    import numpy as np
 
-    ### Charge from test pulse is stored as a voltage on first stage capacitor
-    VrefAmp = VDAC_to_voltage(VDAC = 2268, VrefAmp = True) 
-    # need to add VefAmp to the voltage stored due to the injected charge as this is the baseline voltage
-    VoltageStored_CoarseStage = Charge_to_CapacitorVoltage(InjectedCharge, Stage_Select = "1") + VrefAmp
+    Shape = tuple(len(values) for values in Grid)
+    Index = np.unravel_index(np.arange(Start, Stop), Shape)
+    Settings = dict(zip(ScanParameters, [values[idx] for values, idx in zip(Grid, Index)]))
+    return ReadoutVectorised(**Settings).astype(np.int32)
+
+
+def ReadoutScan(CurrentMagnitude = 100, InjectionClocks = 54, IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156, chunk_size = 2**20, processes = None, outfile = None):
+    """Evaluates the readout over the full Cartesian grid of the supplied test pulse and bias settings. Any of the arguments can be given as a single value or as a range / list of values,
+    every argument given as a range becomes an axis of the returned result cube (in the order of "ScanParameters"). Small grids are evaluated in one broadcast call, 
+    larger grids are split into chunks of "chunk_size" elements which are spread over a process pool.
+
+    Args:
+        CurrentMagnitude (int or array_like, optional): Test pulse current "IDACCal" DAC value(s). Defaults to 100.
+        InjectionClocks (int or array_like, optional): Test pulse length(s) in 2 ns clocks. Defaults to 54.
+        IDACCancel1 (int or array_like, optional): 1st (Coarse) stage cancellation current DAC setting(s). Defaults to 1502.
+        VoutTH1 (int or array_like, optional): 1st (Coarse) stage threshold voltage DAC setting(s). Defaults to 1763.
+        IDACCancel2 (int or array_like, optional): 2nd (Fine) stage cancellation current DAC setting(s). Defaults to 919.
+        VoutTH2 (int or array_like, optional): 2nd (Fine) stage threshold voltage DAC setting(s). Defaults to 1156.
+        chunk_size (int, optional): Maximum number of grid points evaluated at once, limits the peak memory used. Defaults to 2**20.
+        processes (int, optional): Number of worker processes used when the grid is larger than "chunk_size". None uses all available cores, 1 evaluates all chunks in this process. Defaults to None.
+        outfile (str, optional): If given, the result cube is written to a memory-mapped .npy file at this path instead of being held in RAM. Defaults to None.
+
+    Returns:
+        Axes (dict): Maps the name of each scanned parameter to its values, in the same order as the axes of "ReadoutCube".
+        ReadoutCube (NDArray): Integer array of shape (2, *[len(values) for values in Axes.values()]), index 0 of the zeroth axis is the coarse count and index 1 the fine count.
+    """
+    import numpy as np
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    Settings = dict(zip(ScanParameters, (CurrentMagnitude, InjectionClocks, IDACCancel1, VoutTH1, IDACCancel2, VoutTH2)))
+    Grid = tuple(np.atleast_1d(np.asarray(values)).ravel() for values in Settings.values())
+    Axes = {name: values for name, values in zip(ScanParameters, Grid) if np.ndim(Settings[name]) > 0}
+
+    GridShape = tuple(len(values) for values in Grid)
+    NumPoints = int(np.prod(GridShape))
+    CubeShape = (2,) + tuple(len(values) for values in Axes.values())
 
-    # First stage Cancellation #! note that the cancellation here is general and doesn't disguish between the second stage being a ramp adc and the first stage being a ? adc.
-    if isinstance(VoltageStored_CoarseStage,float) is True:
-        ReadoutDim = 1 # set dimensionality to 1 which can be used instead of length for incrementing
-        VoltageStored_CoarseStage = [VoltageStored_CoarseStage] # turns float to a single valued list, measn we can use the generalised next step which accounts for cases with more than one input value
+    if outfile is None:
+        ReadoutCube = np.empty(CubeShape, dtype=np.int32)
     else:
-        ReadoutDim = len(VoltageStored_CoarseStage)
-    ReadoutList = np.zeros(shape=(2,ReadoutDim))
-    for vi in range(ReadoutDim):
-        voltage = VoltageStored_CoarseStage[vi]
-        CoarseCount, ResidualVoltage = ChargeCancellation(VoltageStored = voltage, IDACCancel = IDACCancel1, VoutTH = VoutTH1, Stage_Select = "1", print_details = print_details)
-        # Residual Voltage is amplified by factor of 4 in transfer to fine stage - only that above the reference voltage is multiplied by 4
-        Amp_ResidaulVoltage = ((ResidualVoltage - VrefAmp) * 4) + VrefAmp
-        FineCount, DiscardedVoltage = ChargeCancellation(VoltageStored = Amp_ResidaulVoltage, IDACCancel = IDACCancel2, VoutTH = VoutTH2, Stage_Select = "2", print_details = print_details)
-        
-        ReadoutList[:,vi] = CoarseCount,FineCount
+        ReadoutCube = np.lib.format.open_memmap(outfile, mode='w+', dtype=np.int32, shape=CubeShape)
+    FlatCube = ReadoutCube.reshape(2, NumPoints) # a view for both in memory and memory-mapped output
 
-    return ReadoutList
+    Chunks = [(start, min(start + chunk_size, NumPoints)) for start in range(0, NumPoints, chunk_size)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    if len(Chunks) == 1 or processes == 1:
+        for start, stop in Chunks:
+            FlatCube[:, start:stop] = _ReadoutScanChunk(Grid, start, stop)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {executor.submit(_ReadoutScanChunk, Grid, start, stop): (start, stop) for start, stop in Chunks}
+            for future, (start, stop) in futures.items():
+                FlatCube[:, start:stop] = future.result()
+
+    if outfile is not None:
+        ReadoutCube.flush()
+
+    return Axes, ReadoutCube
+
+
+# calls of the public functions are recorded while profiling is enabled, see `Instrumentation`
+instrument_module(globals())
 
 
 # #%%  ###* Testing Area ###
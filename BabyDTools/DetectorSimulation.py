@@ -0,0 +1,146 @@
+# DetectorSimulation.py
+# Monte Carlo simulation of full BabyD captures, photon arrivals and noise on top of the charge cancellation model
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from BabyDTools import ChargeCancellationModel as CCM
+from BabyDTools.SPI_analysis import pack_data
+
+FrameShape = (16, 16)
+
+
+def PhotonVoltage(PhotonEnergy = 30):
+    """Voltage stored on the 1st (Coarse) stage capacitor by a single absorbed photon.
+
+    Args:
+        PhotonEnergy (float, optional): Photon energy in keV. Defaults to 30.
+
+    Returns:
+        Voltage (float): Units given in volts (V).
+    """
+    Charge = PhotonEnergy * 1000 / CCM.Charge_to_Energy(1) # Charge_to_Energy is linear, its value at 1 C is eV per coulomb
+    return CCM.Charge_to_CapacitorVoltage(Charge, Stage_Select = "1")
+
+
+def PixelVariation(GainSpread = 0.02, OffsetSpread = 1e-3, seed = None, shape = FrameShape):
+    """Draws the fixed per-pixel variation of a simulated detector: a relative gain of the charge to voltage conversion and an offset of the stored voltage.
+    Pass the result to `SimulateFrames()` to simulate several captures (e.g. the steps of a sweep) with the same detector.
+
+    Args:
+        GainSpread (float, optional): Standard deviation of the relative gain about 1. Defaults to 0.02.
+        OffsetSpread (float, optional): Standard deviation of the stored voltage offset about 0. Units given in volts (V). Defaults to 1 mV.
+        seed (int or np.random.SeedSequence, optional): Seed of the random number generator, None for a random detector. Defaults to None.
+        shape (tuple, optional): Pixel shape of the detector. Defaults to (16, 16).
+
+    Returns:
+        PixelMaps (dict): "Gain" and "Offset" arrays of shape "shape".
+    """
+    rng = np.random.default_rng(seed)
+    return {'Gain': 1 + GainSpread * rng.standard_normal(shape), 'Offset': OffsetSpread * rng.standard_normal(shape)}
+
+
+def _SimulateChunk(seed, NumFrames, Photons, PhotonEnergy, Injected, Gain, Offset, VoltageNoise, ThresholdNoise, IDACCancel1, VoutTH1, IDACCancel2, VoutTH2):
+    """Simulates "NumFrames" frames with a generator seeded by "seed". Defined at module level so it can be sent to a process pool.
+
+    Returns:
+        frames (NDArray): uint8 array of shape [NumFrames,*P,3].
+    """
+    rng = np.random.default_rng(seed)
+    shape = (NumFrames,) + Gain.shape
+    VrefAmp = CCM.VDAC_to_voltage(VDAC = 2268, VrefAmp = True)
+    NoiseDAC = ThresholdNoise / CCM.VDAC_to_voltage(1) # threshold noise as a (non-integer) shift of the VoutTH DAC setting
+
+    # photons absorbed in each pixel and frame (plus any test pulse), each storing the same charge scaled by the pixel's gain
+    Arrivals = rng.poisson(Photons, size = shape)
+    Stored = (Arrivals * PhotonVoltage(PhotonEnergy) + Injected) * Gain + Offset + VrefAmp
+    if VoltageNoise > 0:
+        Stored += VoltageNoise * rng.standard_normal(shape)
+
+    Threshold1 = VoutTH1 + NoiseDAC * rng.standard_normal(shape) if ThresholdNoise > 0 else VoutTH1
+    Coarse, Residual = CCM.ChargeCancellationVectorised(VoltageStored = Stored, IDACCancel = IDACCancel1, VoutTH = Threshold1, Stage_Select = "1")
+
+    Amplified = (Residual - VrefAmp) * CCM.ResidualAmplification + VrefAmp
+    if VoltageNoise > 0:
+        Amplified += VoltageNoise * rng.standard_normal(shape)
+    Threshold2 = VoutTH2 + NoiseDAC * rng.standard_normal(shape) if ThresholdNoise > 0 else VoutTH2
+    Fine, _ = CCM.ChargeCancellationVectorised(VoltageStored = Amplified, IDACCancel = IDACCancel2, VoutTH = Threshold2, Stage_Select = "2")
+
+    # counters saturate, the overflow flag marks samples which did not fit in the coarse / fine counters (or were never cancelled)
+    frames = np.empty(shape + (3,), dtype = np.uint8)
+    frames[..., 0] = np.clip(Coarse, 0, 2**8 - 1)
+    frames[..., 1] = np.clip(Fine, 0, 2**7 - 1)
+    frames[..., 2] = (Coarse < 0) | (Coarse > 2**8 - 1) | (Fine < 0) | (Fine > 2**7 - 1)
+    return frames
+
+
+def SimulateFrames(NumFrames, Photons = 1.0, PhotonEnergy = 30, CurrentMagnitude = 0, InjectionClocks = 0, IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156, VoltageNoise = 5e-4, ThresholdNoise = 2e-4,
+                   PixelMaps = None, GainSpread = 0.02, OffsetSpread = 1e-3, seed = None, packed = False, chunk_frames = 8192, processes = 1, outfile = None):
+    """Monte Carlo simulation of a capture of "NumFrames" frames under illumination, as a noisy, non-uniform counterpart to `ChargeCancellationModel.ReadoutVectorised()`.
+    In every pixel and frame a Poisson number of photons of energy "PhotonEnergy" is absorbed (on top of an optional test pulse), the stored voltage is scaled by the pixel's gain and shifted by its offset,
+    Gaussian noise is added to the voltage stored on each stage and to each stage threshold, and the charge is propagated through both cancellation stages.
+    All frames of a chunk are simulated in one vectorised pass. Chunks are spread over a process pool, each with its own generator spawned from "seed",
+    so the result depends only on "seed" and "chunk_frames" and not on the number of processes.
+
+    Args:
+        NumFrames (int): Number of frames to simulate.
+        Photons (float or NDArray, optional): Mean number of photons absorbed per pixel per frame, a scalar or a [16,16] flux map. Defaults to 1.0.
+        PhotonEnergy (float, optional): Photon energy in keV. Defaults to 30.
+        CurrentMagnitude, InjectionClocks (int, optional): Test pulse "IDACCal" DAC value and length in 2 ns clocks injected into every pixel and frame, as `ChargeCancellationModel.ReadoutVectorised()`.
+                                                         Defaults to 0 (no test pulse).
+        IDACCancel1, VoutTH1, IDACCancel2, VoutTH2 (int, optional): Bias settings, as `ChargeCancellationModel.ReadoutVectorised()`.
+        VoltageNoise (float, optional): Standard deviation of the noise on the voltage stored on each stage, per sample. Units given in volts (V). Defaults to 0.5 mV.
+        ThresholdNoise (float, optional): Standard deviation of the noise on each stage threshold, per sample. Units given in volts (V). Defaults to 0.2 mV.
+        PixelMaps (dict, optional): Per-pixel variation from `PixelVariation()`. Defaults to None (drawn from "GainSpread", "OffsetSpread" and "seed").
+        GainSpread, OffsetSpread (float, optional): Spread of the per-pixel variation when "PixelMaps" is not given, see `PixelVariation()`. Defaults to 0.02 and 1 mV.
+        seed (int or np.random.SeedSequence, optional): Seed of the random number generator, the same seed gives the same capture. Defaults to None (a random capture).
+        packed (bool, optional): Return the frames packed to one uint16 per sample, see `SPI_analysis.pack_data`. Defaults to False.
+        chunk_frames (int, optional): Number of frames simulated at once, limits the memory used. Defaults to 8192.
+        processes (int, optional): Number of worker processes, None uses all available cores. Defaults to 1.
+        outfile (str, optional): If given, the frames are written to a memory-mapped .npy file at this path instead of being held in RAM. Defaults to None.
+
+    Returns:
+        frames (NDArray): uint8 array of shape [NumFrames,16,16,3] (coarse [0], fine [1], overflow [2]), or uint16 [NumFrames,16,16] if "packed" is "True".
+                        `frames.transpose(1,0,2,3)` gives the [16,NumFrames,16,3] layout of `SPI_analysis.build_array`.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        Root = np.random.SeedSequence(seed.entropy, spawn_key = seed.spawn_key) # a fresh copy, so the children spawned below are the same on every call
+    else:
+        Root = np.random.SeedSequence(seed)
+    PixelSeed, FrameSeed = Root.spawn(2)
+    if PixelMaps is None:
+        PixelMaps = PixelVariation(GainSpread = GainSpread, OffsetSpread = OffsetSpread, seed = PixelSeed)
+    Gain, Offset = np.asarray(PixelMaps['Gain'], dtype = float), np.asarray(PixelMaps['Offset'], dtype = float)
+    Photons = np.broadcast_to(np.asarray(Photons, dtype = float), Gain.shape)
+
+    Chunks = [(start, min(start + chunk_frames, NumFrames)) for start in range(0, NumFrames, chunk_frames)]
+    Seeds = FrameSeed.spawn(len(Chunks))
+    Injected = CCM.Charge_to_CapacitorVoltage(CCM.IDAC_to_Charge(CurrentMagnitude, InjectionClocks, IDAC_ID = "IDACCal"), Stage_Select = "1")
+    Settings = (PhotonEnergy, Injected, Gain, Offset, VoltageNoise, ThresholdNoise, IDACCancel1, VoutTH1, IDACCancel2, VoutTH2)
+
+    shape = (NumFrames,) + Gain.shape + (() if packed is True else (3,))
+    dtype = np.uint16 if packed is True else np.uint8
+    if outfile is None:
+        frames = np.empty(shape, dtype = dtype)
+    else:
+        frames = np.lib.format.open_memmap(outfile, mode = 'w+', dtype = dtype, shape = shape)
+
+    def store(start, stop, block):
+        frames[start:stop] = pack_data(block) if packed is True else block
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if len(Chunks) <= 1 or processes == 1:
+        for (start, stop), chunkseed in zip(Chunks, Seeds):
+            store(start, stop, _SimulateChunk(chunkseed, stop - start, Photons, *Settings))
+    else:
+        with ProcessPoolExecutor(max_workers = processes) as executor:
+            futures = [executor.submit(_SimulateChunk, chunkseed, stop - start, Photons, *Settings) for (start, stop), chunkseed in zip(Chunks, Seeds)]
+            for (start, stop), future in zip(Chunks, futures):
+                store(start, stop, future.result())
+
+    if outfile is not None:
+        frames.flush()
+    return frames
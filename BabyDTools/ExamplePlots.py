@@ -1,13 +1,16 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 
+from BabyDTools.PixelHistograms import pixel_histograms, histogram_means
+from BabyDTools.Instrumentation import stage, instrument_module
 
-def CoarseFineCombinedPlot(Coarse,Fine,xs,xlabel='DAC setting'):
-    #### Needs to be adapted to allow for plotting of mutliple pixels on the same plot
-    fig, ax1 = plt.subplots()
+# pyplot is imported inside the interactive plotting functions, so importing this module (e.g. for the headless batch renderer) does not start a GUI backend
+
+
+def _combined_figure(fig, xlabel = 'DAC setting'):
+    """Builds the axes and (empty) lines of `CoarseFineCombinedPlot` on "fig", so a figure can be reused for many data sets by `_set_combined`."""
+    ax1 = fig.add_subplot()
 
-    assert len(Coarse) == len(Fine), 'Coarse and Fine data sets are not the same length'
     ax1.set_xlabel(xlabel)
     ax1.set_ylabel('Fine Count', color = 'C0')
     ax1.tick_params(axis= 'y', labelcolor = 'C0')
@@ -17,32 +20,74 @@ def CoarseFineCombinedPlot(Coarse,Fine,xs,xlabel='DAC setting'):
     ax2.tick_params(axis= 'y', labelcolor = 'C1')
     
 
-    ax1.plot(xs,Fine,marker = 'o',markersize =3,mec = 'C0',mfc = 'none',linestyle ='-', linewidth = 1, alpha = 0.5, color = 'C0', label = 'Fine')
-    ax2.plot(xs,Coarse,marker = 'o',markersize =3,mec = 'C1',mfc = 'none',linestyle ='-', linewidth = 1, alpha = 0.5, color = 'C1', label ='Coarse')
+    line_F, = ax1.plot([],[],marker = 'o',markersize =3,mec = 'C0',mfc = 'none',linestyle ='-', linewidth = 1, alpha = 0.5, color = 'C0', label = 'Fine')
+    line_C, = ax2.plot([],[],marker = 'o',markersize =3,mec = 'C1',mfc = 'none',linestyle ='-', linewidth = 1, alpha = 0.5, color = 'C1', label ='Coarse')
+    return ax1, ax2, (line_C, line_F)
+
+
+def _set_combined(axes, Coarse, Fine, xs):
+    ax1, ax2, (line_C, line_F) = axes
+    assert len(Coarse) == len(Fine), 'Coarse and Fine data sets are not the same length'
+    line_F.set_data(xs, Fine)
+    line_C.set_data(xs, Coarse)
+    for ax in (ax1, ax2):
+        ax.relim()
+        ax.autoscale_view()
+
 
+def _finish_combined(fig):
     fig.tight_layout()
     fig.legend(loc='upper center', bbox_to_anchor=(0.5, 1.06),
         ncol=3, fancybox=True, shadow=True)
-    fig.show()
 
-    return fig, ax1, ax2
+
+def CoarseFineCombinedPlot(Coarse,Fine,xs,xlabel='DAC setting', show = True):
+    import matplotlib.pyplot as plt
+    #### Needs to be adapted to allow for plotting of mutliple pixels on the same plot
+    fig = plt.figure()
+    axes = _combined_figure(fig, xlabel = xlabel)
+    _set_combined(axes, Coarse, Fine, xs)
+    _finish_combined(fig)
+    if show is True:
+        fig.show()
+
+    return fig, axes[0], axes[1]
 
 
-def CoarseFineSubPlots(Coarse,Fine):
-    fig, (ax1,ax2) = plt.subplots(ncols=1,nrows=2,sharex=True)
+def _subplots_figure(fig, xlabel = 'DAC setting'):
+    """Builds the axes and (empty) lines of `CoarseFineSubPlots` on "fig", see `_combined_figure`."""
+    ax1, ax2 = fig.subplots(ncols=1,nrows=2,sharex=True)
 
-    ax1.plot(Coarse, color = 'C0', label ='Coarse')
+    line_C, = ax1.plot([],[], color = 'C0', label ='Coarse')
     ax1.set_ylabel('Coarse Count', color = 'C0')
     ax1.tick_params(axis= 'y', labelcolor = 'C0')
     
-    ax2.plot(Fine, color = 'C1', label = 'Fine')
+    line_F, = ax2.plot([],[], color = 'C1', label = 'Fine')
     ax2.set_ylabel('Fine Count', color = 'C1')
     ax2.tick_params(axis= 'y', labelcolor = 'C1')
-    ax2.set_xlabel('DAC setting')
+    ax2.set_xlabel(xlabel)
+    return ax1, ax2, (line_C, line_F)
+
+
+def _set_subplots(axes, Coarse, Fine):
+    ax1, ax2, (line_C, line_F) = axes
+    line_C.set_data(np.arange(len(Coarse)), Coarse)
+    line_F.set_data(np.arange(len(Fine)), Fine)
+    for ax in (ax1, ax2):
+        ax.relim()
+        ax.autoscale_view()
+
+
+def CoarseFineSubPlots(Coarse,Fine, show = True):
+    import matplotlib.pyplot as plt
+    fig = plt.figure()
+    axes = _subplots_figure(fig)
+    _set_subplots(axes, Coarse, Fine)
 
     fig.tight_layout()
-    plt.show()
-    return fig, ax1, ax2
+    if show is True:
+        plt.show()
+    return fig, axes[0], axes[1]
 
 
 def histogram_array(array, plotcoarse = True, numslices = 5, set_limfine = False, limfine = (0,128), set_limcoarse = False, limcoarse = (0,256), save_plot = False, savedir = 'plots', plotname = None, return_data = False):
@@ -60,6 +105,7 @@ def histogram_array(array, plotcoarse = True, numslices = 5, set_limfine = False
     Returns:
         _type_: _description_
     """
+    import matplotlib.pyplot as plt
     
     fig = plt.figure(figsize=(7,6))
     
@@ -75,18 +121,18 @@ def histogram_array(array, plotcoarse = True, numslices = 5, set_limfine = False
         ax2 = fig.add_subplot(212) # add subplot for showing coarse data
         coarsebins = np.arange(0,2**8,1)
     
-    numframes = len(array[0,:,0,0]) # number of collections / frames in data array
-    slicewidth = int(numframes/numslices)
+    # per-pixel histograms of each time slice are computed headless, the averages plotted here are taken from them
+    slicemeans = histogram_means(pixel_histograms(array, windows = numslices))
 
     for i in range(numslices):
-        fineave = np.average(array[:,i:i*slicewidth+slicewidth,:,1],axis=1)
+        fineave = slicemeans['fine'][i]
         
         ax1.hist(fineave.ravel(),finebins,label=f'time {i}')
         
         fineaves += [fineave]
         
         if plotcoarse is True:
-            coarseave = np.average(array[:,i:i*slicewidth+slicewidth,:,0],axis=1)    
+            coarseave = slicemeans['coarse'][i]
         
             ax2.hist(coarseave.ravel(),coarsebins,label=f'time {i}')
             
@@ -110,14 +156,11 @@ def histogram_array(array, plotcoarse = True, numslices = 5, set_limfine = False
 
     if save_plot is True:
         
-        # check if plots folder exists
-        if not os.path.exists(savedir):
-            os.makedirs(savedir)
+        os.makedirs(savedir, exist_ok = True)
         
-        if plotname is None:
-            fig.savefig(savedir + '\\ArrayHistogram.png')
-        else:
-            fig.savefig(savedir + f'\\ArrayHistogram_{plotname}.png')
+        filename = 'ArrayHistogram.png' if plotname is None else f'ArrayHistogram_{plotname}.png'
+        with stage('matplotlib.savefig'):
+            fig.savefig(os.path.join(savedir, filename))
     
     if return_data is True:
         return fineaves, coarseaves
@@ -139,12 +182,16 @@ def histogram_pixel(array, pixel_sel = (8,8), plottitle = 'Histogram of Pixel Ou
         savedir (str, optional): _description_. Defaults to 'plots'.
         plotname (_type_, optional): _description_. Defaults to None.
     """
+    import matplotlib.pyplot as plt
     
     fig = plt.figure(figsize=(7,6))
 
+    # histogram of the selected pixel is computed headless, then drawn from the counts
+    pixelhist = pixel_histograms(array[pixel_sel[1]:pixel_sel[1]+1,:,pixel_sel[0]:pixel_sel[0]+1])
+
     ax1 = fig.add_subplot(211)
     finebins = np.arange(0,2**7,1)
-    ax1.hist(array[pixel_sel[1],:,pixel_sel[0],1],finebins,label=f'pixel ({pixel_sel[0]},{pixel_sel[1]})')
+    ax1.hist(np.arange(2**7),finebins,weights=pixelhist['fine'][0,0,0],label=f'pixel ({pixel_sel[0]},{pixel_sel[1]})')
 
     ax1.legend()
     ax1.set_xlabel('Fine Count')
@@ -157,7 +204,7 @@ def histogram_pixel(array, pixel_sel = (8,8), plottitle = 'Histogram of Pixel Ou
     
         ax2 = fig.add_subplot(212) # add subplot for showing coarse data
         coarsebins = np.arange(0,2**8,1)
-        ax2.hist(array[pixel_sel[1],:,pixel_sel[0],0],coarsebins,label=f'pixel ({pixel_sel[0]},{pixel_sel[1]})')
+        ax2.hist(np.arange(2**8),coarsebins,weights=pixelhist['coarse'][0,0,0],label=f'pixel ({pixel_sel[0]},{pixel_sel[1]})')
 
         ax2.legend()    
         ax2.set_xlabel('Coarse Count')
@@ -168,14 +215,11 @@ def histogram_pixel(array, pixel_sel = (8,8), plottitle = 'Histogram of Pixel Ou
     
     if save_plot is True:
         
-        # check if plots folder exists
-        if not os.path.exists(savedir):
-            os.makedirs(savedir)
+        os.makedirs(savedir, exist_ok = True)
         
-        if plotname is None:
-            fig.savefig(savedir + f'\\Pixel({pixel_sel[0]},{pixel_sel[1]})Histogram.png')
-        else:
-            fig.savefig(savedir + f'\\Pixel({pixel_sel[0]},{pixel_sel[1]})Histogram_{plotname}.png')
+        filename = f'Pixel({pixel_sel[0]},{pixel_sel[1]})Histogram.png' if plotname is None else f'Pixel({pixel_sel[0]},{pixel_sel[1]})Histogram_{plotname}.png'
+        with stage('matplotlib.savefig'):
+            fig.savefig(os.path.join(savedir, filename))
     
     if print_std is True:
         print('Fine Stage Standard Deviation for pixel (8,8) = ',np.std(array[pixel_sel[0],:,pixel_sel[1],1]))
@@ -185,23 +229,154 @@ def histogram_pixel(array, pixel_sel = (8,8), plottitle = 'Histogram of Pixel Ou
         
 #* Automated plots for bias setting sweeps to use within "CalibrateASIC.py"
 
-def plotcapture(Coarse, Fine, plottitle): #savefig = False, foldertitle = 'ImagePlots'
+def _capture_figure(fig, **kwargs):
+    """Builds the axes, images and colour bars of `plotcapture` on "fig", see `_combined_figure`."""
+    ax_F, ax_C = fig.subplots(1,2)
     
-    fig, (ax_F,ax_C) = plt.subplots(1,2, figsize = (10,10))
-    
-    im_C = ax_C.imshow(np.array(Coarse))
+    im_C = ax_C.imshow(np.zeros((16,16)))
     fig.colorbar(im_C, orientation='vertical')
     ax_C.set_title('Pixel readout \n on coarse stage')
     
 
-    im_F = ax_F.imshow(np.array(Fine))
+    im_F = ax_F.imshow(np.zeros((16,16)))
     fig.colorbar(im_F, orientation='vertical')
     ax_F.set_title('Pixel readout \n on fine stage')
     
-    fig.suptitle(f'Image plots of Baby D coarse and fine readout \n {plottitle}.')
+    title = fig.suptitle('')
+    return im_C, im_F, title
+
+
+def _set_capture(artists, Coarse, Fine, plottitle):
+    im_C, im_F, title = artists
+    for im, data in ((im_C, Coarse), (im_F, Fine)):
+        data = np.array(data, dtype = float)
+        im.set_data(data)
+        im.set_extent((-0.5, data.shape[1] - 0.5, data.shape[0] - 0.5, -0.5))
+        if np.any(np.isfinite(data)):
+            im.set_clim(np.nanmin(data), np.nanmax(data))
+    title.set_text(f'Image plots of Baby D coarse and fine readout \n {plottitle}.')
+
+
+def plotcapture(Coarse, Fine, plottitle, show = True): #savefig = False, foldertitle = 'ImagePlots'
+    import matplotlib.pyplot as plt
     
-    fig.show()
+    fig = plt.figure(figsize = (10,10))
+    artists = _capture_figure(fig)
+    _set_capture(artists, Coarse, Fine, plottitle)
+    
+    if show is True:
+        fig.show()
     
     # if savefig is True:
     #     fig.savefig(f"C:/Users/rif36645/OneDrive - Science and Technology Facilities Council/Projects-DESKTOP-P8841A7/DynamiX local files/B16Local/Plots/{foldertitle}/ArrayMap_({plottitle}).png",bbox_inches = 'tight')
-    
\ No newline at end of file
+    return fig
+
+
+#* Batch rendering of many figures (e.g. one per pixel or per sweep step) to files
+
+# figure size, builder and updater of each kind of batch plot, datasets of each kind are tuples of the arguments of the updater after the artists
+BatchPlots = {'capture': ((10, 10), _capture_figure, _set_capture), # (Coarse, Fine, plottitle) as `plotcapture`
+              'combined': ((6.4, 4.8), _combined_figure, _set_combined), # (Coarse, Fine, xs) as `CoarseFineCombinedPlot`
+              'subplots': ((6.4, 4.8), _subplots_figure, _set_subplots)} # (Coarse, Fine) as `CoarseFineSubPlots`
+
+
+def _render_chunk(kind, items, savedir, dpi, plotkwargs):
+    """Renders (filename, dataset) items to files on a single figure, updating the data of its artists for each item rather than building a new figure."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figsize, build, update = BatchPlots[kind]
+    fig = Figure(figsize = figsize) # not registered with pyplot, so no GUI backend is involved and nothing is left open
+    FigureCanvasAgg(fig)
+    artists = build(fig, **plotkwargs)
+    paths = []
+    try:
+        for i, (filename, dataset) in enumerate(items):
+            update(artists, *dataset)
+            if i == 0: # layout is fixed after the first data set
+                if kind == 'combined':
+                    _finish_combined(fig)
+                elif kind == 'subplots':
+                    fig.tight_layout()
+            path = os.path.join(savedir, filename)
+            with stage('matplotlib.savefig'):
+                fig.savefig(path, dpi = dpi)
+            paths += [path]
+    finally:
+        fig.clear()
+    return paths
+
+
+def render_batch(kind, datasets, savedir = 'plots', filenames = None, processes = None, chunk_size = 64, dpi = 100, **plotkwargs):
+    """Renders one figure per data set to image files without displaying anything, using the Agg backend. Each worker builds a single figure and reuses it for a chunk
+    of data sets by updating the data of its artists, and the chunks are spread across a process pool.
+
+    Args:
+        kind (str): "capture" (`plotcapture`, data sets of (Coarse, Fine, plottitle)), "combined" (`CoarseFineCombinedPlot`, data sets of (Coarse, Fine, xs))
+                    or "subplots" (`CoarseFineSubPlots`, data sets of (Coarse, Fine)).
+        datasets (list): Data set of each figure.
+        savedir (str, optional): Folder the figures are saved to. Defaults to 'plots'.
+        filenames (list, optional): File name of each figure (the extension sets the format). Defaults to None ("<kind>_<index>.png").
+        processes (int, optional): Number of worker processes, 1 renders in this process. Defaults to None (the number of CPUs).
+        chunk_size (int, optional): Number of figures rendered by a worker on one reused figure. Defaults to 64.
+        dpi (int, optional): Resolution of the saved figures. Defaults to 100.
+        **plotkwargs: Options of the figure, e.g. "xlabel" for "combined" and "subplots".
+
+    Returns:
+        paths (list): Paths of the saved figures, in the order of "datasets".
+    """
+    assert kind in BatchPlots, f"Unknown plot kind {kind}, expected one of {list(BatchPlots)}."
+    if filenames is None:
+        filenames = [f'{kind}_{i:05d}.png' for i in range(len(datasets))]
+    assert len(filenames) == len(datasets), 'A file name is needed for every data set.'
+    os.makedirs(savedir, exist_ok = True)
+
+    items = list(zip(filenames, datasets))
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    if processes == 1:
+        return [path for chunk in chunks for path in _render_chunk(kind, chunk, savedir, dpi, plotkwargs)]
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        results = executor.map(_render_chunk, [kind] * len(chunks), chunks, [savedir] * len(chunks), [dpi] * len(chunks), [plotkwargs] * len(chunks))
+        return [path for paths in results for path in paths]
+
+
+def render_sweep_maps(SweepValues, AveStore, savedir = 'plots', SweepName = 'Sweep', **kwargs):
+    """Saves an image map (`plotcapture`) of the average coarse and fine readout of every sweep step.
+
+    Args:
+        SweepValues (list): Values of the swept parameter.
+        AveStore (NDArray): Average and standard deviation across captures of shape [2,N_steps,N_rows,N_pixels,3], from `SPI_analysis.paramsweep_loaddata`
+                            with "AverageData" = True and "row_select" = "all".
+        SweepName (str, optional): Name of the swept parameter, used in the titles and file names. Defaults to 'Sweep'.
+        **kwargs: Passed to `render_batch()`.
+
+    Returns:
+        paths (list): Paths of the saved figures.
+    """
+    datasets = [(AveStore[0, i, ..., 0], AveStore[0, i, ..., 1], f'{SweepName} = {value}') for i, value in enumerate(SweepValues)]
+    filenames = [f'ArrayMap_({SweepName}_{value}).png' for value in SweepValues]
+    return render_batch('capture', datasets, savedir = savedir, filenames = filenames, **kwargs)
+
+
+def render_pixel_sweeps(SweepValues, AveStore, savedir = 'plots', xlabel = 'DAC setting', **kwargs):
+    """Saves the average coarse and fine response (`CoarseFineCombinedPlot`) of every pixel of a sweep.
+
+    Args:
+        SweepValues (list): Values of the swept parameter.
+        AveStore (NDArray): Average and standard deviation across captures of shape [2,N_steps,N_rows,N_pixels,3], see `render_sweep_maps()`.
+        xlabel (str, optional): Label of the swept parameter. Defaults to 'DAC setting'.
+        **kwargs: Passed to `render_batch()`.
+
+    Returns:
+        paths (list): Paths of the saved figures.
+    """
+    rows, pixels = AveStore.shape[2:4]
+    datasets = [(AveStore[0, :, row, pixel, 0], AveStore[0, :, row, pixel, 1], SweepValues) for row in range(rows) for pixel in range(pixels)]
+    filenames = [f'Pixel({pixel},{row})Sweep.png' for row in range(rows) for pixel in range(pixels)]
+    return render_batch('combined', datasets, savedir = savedir, filenames = filenames, xlabel = xlabel, **kwargs)
+
+
+# calls of the public functions are recorded while profiling is enabled, see `Instrumentation`
+instrument_module(globals())
@@ -10,13 +10,108 @@ def DetectorReadout(ICal_I, ICal_F, PulseWidth, IDACCancel1 = 330, VoutTH1 = 115
     OutputA = CCM.Readout(CurrentMagnitude = IDACCal, InjectionClocks = Time, IDACCancel1 = 330, VoutTH1 = 1156, IDACCancel2 = 1178, VoutTH2 = 600, print_details = PrintDetails)
     CoarseFineCombinedPlot(OutputA[0], OutputA[1],IDACCal,xlabel='IDACCal Setting')
 
-def PredictSettings():
+def _StageSteps(IDACCancel1, IDACCancel2):
+    """Voltage removed by a single coarse and fine cancellation clock, and the coarse stage (input referred) voltage equivalent to one fine count."""
+    CoarseStep = CCM.Charge_to_CapacitorVoltage(CCM.IDAC_to_Charge(IDACCancel1, 1, IDAC_ID = "IDACCancel1"), Stage_Select = "1")
+    FineStep = CCM.Charge_to_CapacitorVoltage(CCM.IDAC_to_Charge(IDACCancel2, 1, IDAC_ID = "IDACCancel2"), Stage_Select = "2")
+    return CoarseStep, FineStep, FineStep / CCM.ResidualAmplification # residual is amplified on transfer to the fine stage
+
+
+def PredictSettings(CoarseIncrement = 25, FineIncrement = 0.2, PhotonEnergy = 30, FineOffset = 3, FineBits = 7, SearchWidth = 8, MaxError = None):
     """
     Given specified coarse and fine count increment requirements, calculated predicted settings which fit this specification for an idea detector system.
+    The model is inverted analytically: the energy per coarse / fine count is linear in IDACCancel1 / IDACCancel2, VoutTH1 is placed one coarse step above VrefAmp so the residual
+    resets to the baseline after each coarse count and VoutTH2 is placed so that zero injected charge gives "FineOffset" fine counts (dark pedestal).
+    The integer DAC settings within "SearchWidth" of the analytic solution are then evaluated together with the model and the feasible sets are ranked by error.
+
+    Args:
+        CoarseIncrement (float, optional): Number of photons of energy "PhotonEnergy" per coarse count. Defaults to 25.
+        FineIncrement (float, optional): Number of photons of energy "PhotonEnergy" per fine count. Defaults to 0.2.
+        PhotonEnergy (float, optional): Photon energy in keV. Defaults to 30.
+        FineOffset (int, optional): Required fine count with no injected charge, leaves room for dark correction. Defaults to 3.
+        FineBits (int, optional): Number of bits of the fine counter, a set is only feasible if the fine count never exceeds 2**FineBits - 1. Defaults to 7.
+        SearchWidth (int, optional): Number of DAC codes either side of the analytic solution searched for each setting. Defaults to 8.
+        MaxError (float, optional): If given, only sets with total error below this value are returned. Defaults to None.
+
+    Returns:
+        Settings (NDArray): Integer array of shape (N,4) of feasible (IDACCancel1, VoutTH1, IDACCancel2, VoutTH2) settings, ranked from lowest to highest error.
+        Errors (NDArray): Total error of each set, the sum of the fractional errors of the coarse and fine increments, the coarse rollover offset (in coarse steps) and the dark pedestal offset (in fine steps).
     """
-    
-def CalibrationTestPulse():
+    CoarseEnergy = CoarseIncrement * PhotonEnergy * 1000 # eV
+    FineEnergy = FineIncrement * PhotonEnergy * 1000 # eV
+    VrefAmp = CCM.VDAC_to_voltage(VDAC = 2268, VrefAmp = True)
+    DACRange = np.arange(-SearchWidth, SearchWidth + 1)
+
+    # energy per cancellation clock for a DAC code of 1, all relationships are linear in the DAC code
+    _, _, FineStepInput = _StageSteps(1, 1)
+    CoarseEnergyPerDAC = CCM.IDAC_to_Energy(1, 1, IDAC_ID = "IDACCancel1")
+    FineEnergyPerDAC = CCM.Charge_to_Energy(FineStepInput / CCM.Charge_to_CapacitorVoltage(1, Stage_Select = "1"))
+
+    # candidate grid around the analytic solution with axes (IDACCancel1, VoutTH1, IDACCancel2, VoutTH2)
+    IDACCancel1 = np.round(CoarseEnergy / CoarseEnergyPerDAC) + DACRange[:,None,None,None]
+    IDACCancel2 = np.round(FineEnergy / FineEnergyPerDAC) + DACRange[None,None,:,None]
+    CoarseStep, FineStep, _ = _StageSteps(IDACCancel1, IDACCancel2)
+    VoutTH1 = np.round((VrefAmp + CoarseStep) * 4096) + DACRange[None,:,None,None]
+    VoutTH2 = np.round((VrefAmp - (FineOffset - 0.5) * FineStep) * 4096) + DACRange[None,None,None,:]
+    IDACCancel1, VoutTH1, IDACCancel2, VoutTH2 = [a.ravel() for a in np.broadcast_arrays(IDACCancel1, VoutTH1, IDACCancel2, VoutTH2)]
+
+    InRange = np.all([(a > 0) & (a < 4096) for a in (IDACCancel1, VoutTH1, IDACCancel2, VoutTH2)], axis = 0)
+    IDACCancel1, VoutTH1, IDACCancel2, VoutTH2 = [a[InRange].astype(int) for a in (IDACCancel1, VoutTH1, IDACCancel2, VoutTH2)]
+    CoarseStep, FineStep, _ = _StageSteps(IDACCancel1, IDACCancel2)
+
+    # evaluate the fine stage with the model at the dark baseline and at the top of the coarse residual window
+    Pedestal, _ = CCM.ChargeCancellationVectorised(VoltageStored = VrefAmp, IDACCancel = IDACCancel2, VoutTH = VoutTH2, Stage_Select = "2")
+    TopOfWindow = np.nextafter(CCM.VDAC_to_voltage(VoutTH1), -np.inf)
+    FineMax, _ = CCM.ChargeCancellationVectorised(VoltageStored = ((TopOfWindow - VrefAmp) * CCM.ResidualAmplification) + VrefAmp, IDACCancel = IDACCancel2, VoutTH = VoutTH2, Stage_Select = "2")
+    Feasible = (CCM.VDAC_to_voltage(VoutTH1) > VrefAmp) & (FineMax <= 2**FineBits - 1) & (Pedestal >= 0)
+
+    Errors = (np.abs(CCM.IDAC_to_Energy(IDACCancel1, 1, IDAC_ID = "IDACCancel1") / CoarseEnergy - 1)
+              + np.abs(IDACCancel2 * FineEnergyPerDAC / FineEnergy - 1)
+              + np.abs(CCM.VDAC_to_voltage(VoutTH1) - CoarseStep - VrefAmp) / CoarseStep
+              + np.abs(VrefAmp - CCM.VDAC_to_voltage(VoutTH2) - (FineOffset - 0.5) * FineStep) / FineStep)
+    if MaxError is not None:
+        Feasible &= Errors <= MaxError
+
+    Settings = np.stack([IDACCancel1, VoutTH1, IDACCancel2, VoutTH2], axis = 1)[Feasible]
+    Errors = Errors[Feasible]
+    Order = np.argsort(Errors, kind = 'stable')
+    return Settings[Order], Errors[Order]
+
+
+def CalibrationTestPulse(FineCounts, CoarseCounts = 0, IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156, MaxClocks = 256, Tolerance = 0):
     """
     For a required set number of fine counts and assocated increment energy resolution, 
     provide options for a test pulse which could be injected to produce such a fine count in an ideal detector.
-    """
\ No newline at end of file
+    Every (IDACCal, InjectionClocks) pair over the 0 - 4095 IDACCal range and 1 - "MaxClocks" clocks is evaluated in one call to `ReadoutVectorised()`.
+
+    Args:
+        FineCounts (int): Required fine count.
+        CoarseCounts (int, optional): Required coarse count. Defaults to 0.
+        IDACCancel1 (int, optional): 1st (Coarse) stage cancellation current DAC setting. Defaults to 1502.
+        VoutTH1 (int, optional): 1st (Coarse) stage threshold voltage DAC setting. Defaults to 1763.
+        IDACCancel2 (int, optional): 2nd (Fine) stage cancellation current DAC setting. Defaults to 919.
+        VoutTH2 (int, optional): 2nd (Fine) stage threshold voltage DAC setting. Defaults to 1156.
+        MaxClocks (int, optional): Longest test pulse searched, in 2 ns clocks. Defaults to 256.
+        Tolerance (float, optional): Largest readout error (in fine counts) of the returned pulses, 0 only returns pulses which give exactly the required readout. Defaults to 0.
+
+    Returns:
+        Pulses (NDArray): Integer array of shape (N,2) of (IDACCal, InjectionClocks) pairs, ranked from lowest to highest error.
+        Errors (NDArray): Distance in fine counts of each pulse's injected charge from the centre of the required readout bin, pulses close to 0 are the most robust to noise.
+    """
+    IDACCal = np.arange(4096)[:,None]
+    Clocks = np.arange(1, MaxClocks + 1)[None,:]
+    ReadoutArray, _, Amp_ResidualVoltage = CCM.ReadoutVectorised(IDACCal, Clocks, IDACCancel1 = IDACCancel1, VoutTH1 = VoutTH1, IDACCancel2 = IDACCancel2, VoutTH2 = VoutTH2, return_residuals = True)
+
+    _, FineStep, _ = _StageSteps(IDACCancel1, IDACCancel2)
+    FinePerCoarse = CCM.FinePerCoarse(IDACCancel1 = IDACCancel1, IDACCancel2 = IDACCancel2)
+    # continuous fine position of the injected charge, the readout bin n spans [n - 1, n) so its centre is at n - 0.5
+    FinePosition = (Amp_ResidualVoltage - CCM.VDAC_to_voltage(VoutTH2)) / FineStep
+    Errors = np.abs((ReadoutArray[0] - CoarseCounts) * FinePerCoarse + FinePosition - (FineCounts - 0.5))
+    Exact = (ReadoutArray[0] == CoarseCounts) & (ReadoutArray[1] == FineCounts)
+    Selected = Exact if Tolerance == 0 else Exact | (Errors <= Tolerance + 0.5)
+
+    IDACCal, Clocks = np.broadcast_arrays(IDACCal, Clocks)
+    Pulses = np.stack([IDACCal[Selected], Clocks[Selected]], axis = 1)
+    Errors = Errors[Selected]
+    Order = np.argsort(Errors, kind = 'stable')
+    return Pulses[Order], Errors[Order]
@@ -0,0 +1,265 @@
+# Instrumentation.py
+# Opt-in profiling of the BabyDTools functions: call counts, wall / CPU time, bytes read and memory allocated per function and stage
+#
+# Enabled for a block of code with the context manager:
+#   with Instrumentation.profile() as prof:
+#       SPI.calc_ave(SPI.build_array(SPI.load_data(filepath)))
+#   print(prof.summary())
+# or for a whole run by setting the environment variable BABYD_PROFILE=1 (or "memory" to also trace allocations), the summary is then printed on exit
+# and written as JSON to BABYD_PROFILE_OUTPUT if it is set. When disabled an instrumented function costs one extra check of an empty list per call.
+
+import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import functools
+import threading
+import tracemalloc
+
+import numpy as np
+
+_profiles = [] # profiles currently recording, instrumentation is disabled while this is empty
+_lock = threading.Lock()
+_local = threading.local() # per-thread stack of the stages being timed
+
+
+class _Frame:
+    """A stage being timed on the current thread."""
+    __slots__ = ('name', 'wall', 'cpu', 'child_wall', 'memory', 'child_peak')
+
+    def __init__(self, name):
+        self.name = name
+        self.child_wall = 0.0
+        self.child_peak = 0
+        self.memory = None
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            stack = _stack()
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak) # keep the parent's peak so far, it is reset for this stage
+            tracemalloc.reset_peak()
+            self.memory = current
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _nbytes(value):
+    """Bytes of the arrays in a returned value (an array or a list, tuple or dictionary of arrays), memory-maps are not counted as they are not allocated in RAM."""
+    if isinstance(value, np.ndarray):
+        return 0 if isinstance(value, np.memmap) else value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(item) for item in value.values())
+    return 0
+
+
+class Profile:
+    """Statistics recorded while profiling is enabled, per function ("<module>.<function>") or stage (e.g. "np.load"). For each the number of calls,
+    the wall and CPU time (inclusive of everything called from it), the self wall time (exclusive of the instrumented functions and stages it called),
+    the bytes read from disk, the bytes of the arrays returned and (with "memory" = "True") the peak memory allocated by the call are recorded."""
+
+    def __init__(self, memory = False):
+        """
+        Args:
+            memory (bool, optional): Trace memory allocations with `tracemalloc` (which includes NumPy arrays) to record the peak allocated by each call.
+                                    Slows down Python code noticeably. Defaults to False.
+        """
+        self.memory = memory
+        self.stats = {}
+        self.started = None
+        self.elapsed = 0.0
+        self._tracing = False # whether this profile started tracemalloc, and so stops it
+
+    def __repr__(self):
+        return f"Profile(entries={len(self.stats)}, elapsed={self.elapsed:.3f}s)"
+
+    def _entry(self, name):
+        entry = self.stats.get(name)
+        if entry is None:
+            entry = self.stats[name] = {'calls': 0, 'wall': 0.0, 'self_wall': 0.0, 'cpu': 0.0, 'bytes_read': 0, 'bytes_out': 0, 'peak_alloc': 0}
+        return entry
+
+    def _record(self, name, wall, self_wall, cpu, bytes_read = 0, bytes_out = 0, peak_alloc = 0):
+        entry = self._entry(name)
+        entry['calls'] += 1
+        entry['wall'] += wall
+        entry['self_wall'] += self_wall
+        entry['cpu'] += cpu
+        entry['bytes_read'] += bytes_read
+        entry['bytes_out'] += bytes_out
+        entry['peak_alloc'] = max(entry['peak_alloc'], peak_alloc)
+
+    def start(self):
+        """Starts recording, profiles can also be used as a context manager."""
+        if self.memory is True and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self.started = time.perf_counter()
+        with _lock:
+            _profiles.append(self)
+        return self
+
+    def stop(self):
+        """Stops recording."""
+        with _lock:
+            if self in _profiles:
+                _profiles.remove(self)
+        self.elapsed += time.perf_counter() - self.started
+        if self._tracing is True:
+            tracemalloc.stop()
+            self._tracing = False
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def to_dict(self):
+        return {'elapsed': self.elapsed, 'stats': self.stats}
+
+    def to_json(self, path):
+        """Writes the recorded statistics to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent = 2)
+
+    def summary(self, sort = 'wall', limit = None):
+        """Text table of the recorded statistics, sorted by "sort" (any statistic, e.g. "self_wall" to find where the time is spent), largest first."""
+        rows = sorted(self.stats.items(), key = lambda item: item[1][sort], reverse = True)[:limit]
+        width = max([len(name) for name, _ in rows] + [len('function / stage')])
+        lines = [f"Profiled {self.elapsed:.3f} s",
+                 f"{'function / stage':<{width}} {'calls':>8} {'wall s':>10} {'self s':>10} {'cpu s':>10} {'read MB':>10} {'out MB':>10} {'peak MB':>10}"]
+        for name, entry in rows:
+            lines += [f"{name:<{width}} {entry['calls']:>8} {entry['wall']:>10.4f} {entry['self_wall']:>10.4f} {entry['cpu']:>10.4f} "
+                      f"{entry['bytes_read'] / 2**20:>10.2f} {entry['bytes_out'] / 2**20:>10.2f} {entry['peak_alloc'] / 2**20:>10.2f}"]
+        return '\n'.join(lines)
+
+
+def profile(memory = False):
+    """Context manager which enables instrumentation and records into a new `Profile`, see the module header."""
+    return Profile(memory = memory)
+
+
+def enabled():
+    """True while any profile is recording."""
+    return len(_profiles) > 0
+
+
+def _finish(frame, bytes_read = 0, bytes_out = 0):
+    """Records a finished stage in every recording profile and charges its time to the stage it was called from."""
+    wall = time.perf_counter() - frame.wall
+    cpu = time.thread_time() - frame.cpu
+    stack = _stack()
+    stack.pop()
+    peak_alloc = 0
+    if frame.memory is not None and tracemalloc.is_tracing():
+        peak = max(tracemalloc.get_traced_memory()[1], frame.child_peak)
+        peak_alloc = peak - frame.memory
+        if stack:
+            stack[-1].child_peak = max(stack[-1].child_peak, peak)
+    if stack:
+        stack[-1].child_wall += wall
+    with _lock:
+        for prof in _profiles:
+            prof._record(frame.name, wall, wall - frame.child_wall, cpu, bytes_read = bytes_read, bytes_out = bytes_out, peak_alloc = peak_alloc)
+
+
+class _Stage:
+    """Times a named stage within a function, see `stage()`."""
+    __slots__ = ('name', 'frame', 'bytes_read')
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes_read = 0
+
+    def read(self, nbytes):
+        """Records bytes read from disk by this stage."""
+        self.bytes_read += int(nbytes)
+
+    def __enter__(self):
+        self.frame = _Frame(self.name)
+        _stack().append(self.frame)
+        return self
+
+    def __exit__(self, *exc):
+        _finish(self.frame, bytes_read = self.bytes_read)
+
+
+class _NoStage:
+    """Stand-in for `_Stage` while instrumentation is disabled."""
+    __slots__ = ()
+
+    def read(self, nbytes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    """Context manager timing a named stage inside a function, e.g. `with stage('np.load') as s: ...; s.read(nbytes)`. Returns a shared no-op when disabled."""
+    return _Stage(name) if _profiles else _NO_STAGE
+
+
+def instrument(function, name = None):
+    """Wraps a function so its calls are recorded while profiling is enabled."""
+    name = f"{function.__module__.rsplit('.', 1)[-1]}.{function.__qualname__}" if name is None else name
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _profiles:
+            return function(*args, **kwargs)
+        frame = _Frame(name)
+        _stack().append(frame)
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            return result
+        finally:
+            _finish(frame, bytes_out = _nbytes(result))
+
+    return wrapper
+
+
+def instrument_module(namespace):
+    """Instruments every public function defined in a module, called at the end of the module with its "globals()".
+    Functions are replaced in the module namespace, so calls between functions of the module and imports of them from other modules are recorded too."""
+    module = namespace['__name__']
+    for attr, value in list(namespace.items()):
+        if inspect.isfunction(value) and value.__module__ == module and not attr.startswith('_') and not hasattr(value, '__wrapped__'):
+            namespace[attr] = instrument(value)
+
+
+def _environment_profile():
+    """Starts a profile for the whole run if BABYD_PROFILE is set, reported when the interpreter exits."""
+    setting = os.environ.get('BABYD_PROFILE', '').strip().lower()
+    if setting in ('', '0', 'false', 'no', 'off'):
+        return None
+    prof = Profile(memory = setting == 'memory').start()
+
+    def report():
+        prof.stop()
+        print(prof.summary(), file = sys.stderr)
+        output = os.environ.get('BABYD_PROFILE_OUTPUT')
+        if output:
+            prof.to_json(output)
+    atexit.register(report)
+    return prof
+
+environment_profile = _environment_profile()
@@ -0,0 +1,168 @@
+# LiveMonitor.py
+# Incremental ingestion of a capture directory during acquisition, only frames added since the last poll are read
+
+import os
+import time
+
+import numpy as np
+
+from BabyDTools.SPI_analysis import parse_filename
+from BabyDTools.StreamingStatistics import PixelStatistics
+from BabyDTools.PixelHistograms import pixel_histograms, CoarseBins, FineBins
+
+
+class LiveMonitor:
+    """Watches a capture directory by polling and keeps running results of everything written to it: per-pixel statistics and histograms of each capture,
+    and the mean / standard deviation cube of each parameter sweep. Each poll compares the size and modification time of the .npy files with the previous poll,
+    and for new or grown files only the frames beyond those already seen are read (row-pair files are memory-mapped), so an update costs time proportional to the new data.
+    Files which cannot be read yet (e.g. still being written) are retried on the next poll.
+
+    Example:
+        monitor = LiveMonitor(folderpath, callback = lambda results: print(results['captures'].keys()))
+        monitor.watch(interval = 5)
+    """
+
+    def __init__(self, folderpath, ParamSweepStep = 1, histograms = True, recursive = False, chunk_frames = 16384, callback = None):
+        """
+        Args:
+            folderpath (str): Directory the row-pair and sweep .npy files are written to.
+            ParamSweepStep (int, optional): Step used in the sweep file names, see `SPI_analysis.parse_filename`. Defaults to 1.
+            histograms (bool, optional): Also keep per-pixel coarse / fine histograms of each capture. Defaults to True.
+            recursive (bool, optional): Also watch subdirectories. Defaults to False.
+            chunk_frames (int, optional): Number of new frames read at a time, limits the memory used. Defaults to 16384.
+            callback (callable, optional): Called with the results (see `results()`) after every poll which found new data. Defaults to None.
+        """
+        self.folderpath = folderpath
+        self.ParamSweepStep = ParamSweepStep
+        self.histograms = histograms
+        self.recursive = recursive
+        self.chunk_frames = chunk_frames
+        self.callback = callback
+
+        self.latest = None # results published by the last poll which found new data
+        self._files = {} # path -> (size, mtime, frames read)
+        self._captures = {} # relative directory and capture name -> {row: {'stats', 'coarse', 'fine'}}
+        self._sweeps = {} # relative directory and sweep name -> {(SweepValue, row): PixelStatistics}
+
+    def __repr__(self):
+        return f"LiveMonitor({self.folderpath!r}, files={len(self._files)}, captures={len(self._captures)}, sweeps={len(self._sweeps)})"
+
+    def _scan(self):
+        """Lists the .npy files being watched with their size and modification time."""
+        found = {}
+        pending = [self.folderpath]
+        while pending:
+            with os.scandir(pending.pop()) as it:
+                for item in it:
+                    if item.is_dir():
+                        if self.recursive is True:
+                            pending += [item.path]
+                    elif item.name.endswith('.npy'):
+                        stat = item.stat()
+                        found[item.path] = (stat.st_size, stat.st_mtime)
+        return found
+
+    def _ingest(self, path, fileinfo, item, start):
+        """Adds frames "start" onwards of a row-pair file [2,N,16,3] to the running results of its capture or sweep."""
+        reldir = os.path.relpath(os.path.dirname(path), self.folderpath)
+        if fileinfo['SweepValue'] is not None:
+            steps = self._sweeps.setdefault(os.path.normpath(os.path.join(reldir, fileinfo['SweepName'])), {})
+            stats = steps.setdefault((fileinfo['SweepValue'], fileinfo['Row']), PixelStatistics(shape = (2, 16)))
+            target = None
+        else:
+            name = os.path.join(reldir, f"{fileinfo['test_name']}NumCaptures_{fileinfo['NumCaptures']}_{fileinfo['timestamp']}")
+            rows = self._captures.setdefault(os.path.normpath(name), {})
+            target = rows.setdefault(fileinfo['Row'], {'stats': PixelStatistics(shape = (2, 16)),
+                                                      'coarse': np.zeros((2, 16, CoarseBins), dtype = np.int64), 'fine': np.zeros((2, 16, FineBins), dtype = np.int64)})
+            stats = target['stats']
+
+        for blockstart in range(start, item.shape[1], self.chunk_frames):
+            block = np.asarray(item[:, blockstart:blockstart + self.chunk_frames])
+            stats.update(block, frame_axis = 1)
+            if target is not None and self.histograms is True:
+                counts = pixel_histograms(block, frame_axis = 1)
+                target['coarse'] += counts['coarse'][0]
+                target['fine'] += counts['fine'][0]
+
+    def poll(self):
+        """Checks the directory once, reads the frames added to new or changed files and publishes the updated results if there were any.
+
+        Returns:
+            updated (list): Paths of the files that new frames were read from.
+        """
+        updated = []
+        for path, (size, mtime) in sorted(self._scan().items()):
+            known = self._files.get(path)
+            if known is not None and known[:2] == (size, mtime):
+                continue
+            fileinfo = parse_filename(path, ParamSweepStep = self.ParamSweepStep)
+            if fileinfo is None:
+                continue
+
+            try:
+                item = np.load(path, mmap_mode = 'r')
+            except (ValueError, OSError): # incomplete file, retried on the next poll
+                continue
+            start = known[2] if known is not None else 0
+            if item.shape[1] > start:
+                self._ingest(path, fileinfo, item, start)
+                updated += [path]
+            self._files[path] = (size, mtime, max(item.shape[1], start))
+
+        if len(updated) > 0:
+            self.latest = self.results()
+            if self.callback is not None:
+                self.callback(self.latest)
+        return updated
+
+    def watch(self, interval = 1.0, duration = None, max_polls = None):
+        """Polls the directory every "interval" seconds until "duration" seconds have passed or "max_polls" polls have been made (forever if neither is given).
+
+        Returns:
+            results (dict): The latest results, see `results()`.
+        """
+        started = time.monotonic()
+        polls = 0
+        while True:
+            self.poll()
+            polls += 1
+            if (max_polls is not None and polls >= max_polls) or (duration is not None and time.monotonic() - started + interval > duration):
+                return self.results()
+            time.sleep(interval)
+
+    def results(self):
+        """Current results of everything seen so far, rows (or sweep steps) without data are NaN (statistics) or zero (histograms).
+
+        Returns:
+            results (dict): "captures" maps each capture name (relative directory and "<test_name>NumCaptures_<N>_<timestamp>") to a dictionary of "frames" (frames read per row, [16]),
+                            "mean", "std" (of shape [16,16,2], coarse [0] / fine [1] as `PixelStatistics`), "overflow" ([16,16] count of overflow frames) and,
+                            if enabled, "coarse" / "fine" histograms ([16,16,256] and [16,16,128]).
+                            "sweeps" maps each sweep name (relative directory and "SweepName" of `SPI_analysis.parse_filename`) to a dictionary of "values" (sorted sweep values), "frames" ([N_steps,16]) and "mean", "std" ([N_steps,16,16,2]).
+        """
+        captures = {}
+        for name, rows in self._captures.items():
+            capture = {'frames': np.zeros(16, dtype = np.int64), 'mean': np.full((16, 16, 2), np.nan), 'std': np.full((16, 16, 2), np.nan),
+                       'overflow': np.zeros((16, 16), dtype = np.int64)}
+            if self.histograms is True:
+                capture['coarse'] = np.zeros((16, 16, CoarseBins), dtype = np.int64)
+                capture['fine'] = np.zeros((16, 16, FineBins), dtype = np.int64)
+            for row, target in rows.items():
+                stats = target['stats']
+                capture['frames'][row:row + 2] = stats.count
+                capture['mean'][row:row + 2], capture['std'][row:row + 2], capture['overflow'][row:row + 2] = stats.mean, stats.std, stats.overflow
+                if self.histograms is True:
+                    capture['coarse'][row:row + 2], capture['fine'][row:row + 2] = target['coarse'], target['fine']
+            captures[name] = capture
+
+        sweeps = {}
+        for name, steps in self._sweeps.items():
+            values = sorted({value for value, _ in steps})
+            sweep = {'values': values, 'frames': np.zeros((len(values), 16), dtype = np.int64),
+                     'mean': np.full((len(values), 16, 16, 2), np.nan), 'std': np.full((len(values), 16, 16, 2), np.nan)}
+            for (value, row), stats in steps.items():
+                step = values.index(value)
+                sweep['frames'][step, row:row + 2] = stats.count
+                sweep['mean'][step, row:row + 2], sweep['std'][step, row:row + 2] = stats.mean, stats.std
+            sweeps[name] = sweep
+
+        return {'captures': captures, 'sweeps': sweeps}
@@ -0,0 +1,91 @@
+# PixelHistograms.py
+# Headless per-pixel histograms of coarse and fine SPI data, computed with a single bincount per chunk of frames
+
+import numpy as np
+
+from BabyDTools.SPI_analysis import is_packed, unpack_data
+
+CoarseBins = 2**8 # coarse counter is 8-bit
+FineBins = 2**7 # fine counter is 7-bit
+
+
+def _windows(numframes, windows):
+    """Converts the "windows" argument of `pixel_histograms()` to a list of (start, stop) frame ranges."""
+    if windows is None:
+        return [(0, numframes)]
+    if isinstance(windows, (int, np.integer)):
+        slicewidth = numframes // windows
+        return [(i * slicewidth, (i + 1) * slicewidth) for i in range(windows)]
+    return [(int(start), int(stop)) for start, stop in windows]
+
+
+def _bincount(values, bins):
+    """Histograms the integer values of every pixel at once. "values" has shape [N,*pixels], returns counts of shape [*pixels,bins]."""
+    values = np.asarray(values).astype(np.int64, copy = False)
+    pixels = values.shape[1:]
+    codes = np.arange(int(np.prod(pixels))).reshape(pixels) * bins + values # unique integer code per (pixel, value)
+    valid = (values >= 0) & (values < bins) # values outside of the counter range are not counted
+    counts = np.bincount(codes[valid], minlength = int(np.prod(pixels)) * bins)
+    return counts.reshape(pixels + (bins,))
+
+
+def pixel_histograms(array, windows = None, frame_axis = 1, chunk_frames = 65536):
+    """Computes the coarse (256 bins) and fine (128 bins) histogram of every pixel for any set of frame windows, without any plotting.
+    Each window is read "chunk_frames" frames at a time and every pixel of a chunk is histogrammed with one `np.bincount` over integer (pixel, value) codes.
+
+    Args:
+        array (NDArray): Frame data, by default in the [16,N,16,3] layout of `SPI_analysis.build_array` (lazy and packed arrays are supported).
+        windows (int or list, optional): None for a single window of all frames, an integer number of equal, non-overlapping slices of the capture, or a list of (start, stop) frame ranges. Defaults to None.
+        frame_axis (int, optional): Axis of "array" along which frames are stacked. Defaults to 1.
+        chunk_frames (int, optional): Number of frames read at a time, limits the memory used. Defaults to 65536.
+
+    Returns:
+        histograms (dict): "coarse" of shape [N_windows,*pixels,256] and "fine" of shape [N_windows,*pixels,128] with the counts of each value,
+                            and "windows" the list of (start, stop) frame ranges. Histograms of different chunks of data are combined with `merge_histograms()`.
+    """
+    numframes = array.shape[frame_axis]
+    ranges = _windows(numframes, windows)
+    packed = is_packed(array)
+    pixels = tuple(size for axis, size in enumerate(array.shape if packed else array.shape[:-1]) if axis != frame_axis)
+
+    coarse = np.zeros((len(ranges),) + pixels + (CoarseBins,), dtype = np.int64)
+    fine = np.zeros((len(ranges),) + pixels + (FineBins,), dtype = np.int64)
+    for w, (start, stop) in enumerate(ranges):
+        for chunkstart in range(start, stop, chunk_frames):
+            index = [slice(None)] * len(array.shape)
+            index[frame_axis] = slice(chunkstart, min(chunkstart + chunk_frames, stop))
+            block = np.moveaxis(np.asarray(array[tuple(index)]), frame_axis, 0)
+            if packed:
+                block = unpack_data(block)
+            coarse[w] += _bincount(block[..., 0], CoarseBins)
+            fine[w] += _bincount(block[..., 1], FineBins)
+
+    return {'coarse': coarse, 'fine': fine, 'windows': ranges}
+
+
+def merge_histograms(*histograms):
+    """Sums histograms (as returned by `pixel_histograms()`) of separate chunks of data with the same windows and pixel layout, e.g. from parallel workers.
+
+    Returns:
+        histograms (dict): The combined histograms, with the windows of the first argument.
+    """
+    merged = {'coarse': histograms[0]['coarse'].copy(), 'fine': histograms[0]['fine'].copy(), 'windows': list(histograms[0]['windows'])}
+    for other in histograms[1:]:
+        merged['coarse'] += other['coarse']
+        merged['fine'] += other['fine']
+    return merged
+
+
+def histogram_means(histograms):
+    """Per-pixel mean value of each window, calculated from the histograms.
+
+    Returns:
+        means (dict): "coarse" and "fine" means of shape [N_windows,*pixels], NaN for pixels with no counts.
+    """
+    means = {}
+    for name in ('coarse', 'fine'):
+        counts = histograms[name]
+        total = counts.sum(axis = -1)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            means[name] = (counts * np.arange(counts.shape[-1])).sum(axis = -1) / total
+    return means
@@ -0,0 +1,156 @@
+# ReadoutLUT.py
+# Precomputed lookup tables of the charge cancellation model readout for a fixed bias configuration
+
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from BabyDTools import ChargeCancellationModel as CCM
+
+# default location of the on-disk table cache (None keeps tables in memory only, pass e.g. "~/.babyd/lut" as "cachedir" to reuse them across sessions),
+# and the maximum number of tables held in memory at once
+DefaultCacheDir = None
+MaxTablesInMemory = 8
+
+_Tables = OrderedDict() # in memory LRU cache of tables, most recently used last
+
+
+def LUTKey(IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156, MaxClocks = 256):
+    """Hash identifying a lookup table, built from the bias settings, the table size and the model constants (see `ChargeCancellationModel.ModelConstants()`),
+    so a table is rebuilt rather than reused if any of these change.
+
+    Returns:
+        Key (str): Hexadecimal SHA1 hash of the table settings.
+    """
+    Settings = {'IDACCancel1': int(IDACCancel1), 'VoutTH1': int(VoutTH1), 'IDACCancel2': int(IDACCancel2), 'VoutTH2': int(VoutTH2),
+                'MaxClocks': int(MaxClocks), 'ModelConstants': CCM.ModelConstants()}
+    return hashlib.sha1(json.dumps(Settings, sort_keys = True).encode()).hexdigest()
+
+
+def BuildLUT(IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156, MaxClocks = 256):
+    """Precomputes the (IDACCal x InjectionClocks) -> (coarse, fine, energy) map for a given bias configuration with `ChargeCancellationModel.ReadoutVectorised()`.
+    Tables are indexed directly by the DAC values i.e. Table['Coarse'][IDACCal, InjectionClocks].
+
+    Args:
+        IDACCancel1 (int, optional): 1st (Coarse) stage cancellation current DAC setting. Defaults to 1502.
+        VoutTH1 (int, optional): 1st (Coarse) stage threshold voltage DAC setting. Defaults to 1763.
+        IDACCancel2 (int, optional): 2nd (Fine) stage cancellation current DAC setting. Defaults to 919.
+        VoutTH2 (int, optional): 2nd (Fine) stage threshold voltage DAC setting. Defaults to 1156.
+        MaxClocks (int, optional): Longest test pulse in the table, in 2 ns clocks. Defaults to 256.
+
+    Returns:
+        Table (dict): Contains the "Coarse" and "Fine" counts (int32) and the injected "Energy" (eV) as arrays of shape (4096, MaxClocks + 1).
+    """
+    IDACCal = np.arange(4096)[:,None]
+    Clocks = np.arange(MaxClocks + 1)[None,:]
+    ReadoutArray = CCM.ReadoutVectorised(IDACCal, Clocks, IDACCancel1 = IDACCancel1, VoutTH1 = VoutTH1, IDACCancel2 = IDACCancel2, VoutTH2 = VoutTH2).astype(np.int32)
+    Energy = CCM.IDAC_to_Energy(IDACCal.astype(float), Clocks.astype(float), IDAC_ID = 'IDACCal')
+    return {'Coarse': ReadoutArray[0], 'Fine': ReadoutArray[1], 'Energy': Energy}
+
+
+def GetLUT(IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156, MaxClocks = 256, cachedir = DefaultCacheDir):
+    """Returns the lookup table for a bias configuration, from memory if it has been used recently, else from the on-disk cache, else it is built with `BuildLUT()` and saved.
+    At most "MaxTablesInMemory" tables are kept in memory, the least recently used table is dropped first.
+
+    Args:
+        cachedir (str, optional): Directory of the on-disk cache, tables are saved as "ReadoutLUT_<key>.npz". None disables the on-disk cache. Defaults to None.
+        Other arguments as `BuildLUT()`.
+
+    Returns:
+        Table (dict): As returned by `BuildLUT()`.
+    """
+    Key = LUTKey(IDACCancel1 = IDACCancel1, VoutTH1 = VoutTH1, IDACCancel2 = IDACCancel2, VoutTH2 = VoutTH2, MaxClocks = MaxClocks)
+    if Key in _Tables:
+        _Tables.move_to_end(Key)
+        return _Tables[Key]
+
+    filepath = None
+    if cachedir is not None:
+        cachedir = os.path.expanduser(cachedir)
+        filepath = os.path.join(cachedir, f'ReadoutLUT_{Key}.npz')
+    if filepath is not None and os.path.exists(filepath):
+        with np.load(filepath) as data:
+            Table = {name: data[name] for name in data.files}
+    else:
+        Table = BuildLUT(IDACCancel1 = IDACCancel1, VoutTH1 = VoutTH1, IDACCancel2 = IDACCancel2, VoutTH2 = VoutTH2, MaxClocks = MaxClocks)
+        if filepath is not None:
+            os.makedirs(cachedir, exist_ok = True)
+            tmppath = filepath[:-len('.npz')] + f'.{os.getpid()}.tmp.npz'
+            np.savez(tmppath, **Table)
+            os.replace(tmppath, filepath) # atomic so a partially written table is never read
+
+    _Tables[Key] = Table
+    while len(_Tables) > MaxTablesInMemory:
+        _Tables.popitem(last = False)
+    return Table
+
+
+def ClearLUTCache(cachedir = None):
+    """Drops all tables held in memory, and if "cachedir" is given also deletes the tables saved there."""
+    _Tables.clear()
+    if cachedir is not None and os.path.isdir(cachedir):
+        for name in os.listdir(cachedir):
+            if name.startswith('ReadoutLUT_') and name.endswith('.npz'):
+                os.remove(os.path.join(cachedir, name))
+
+
+def LUTReadout(CurrentMagnitude, InjectionClocks, IDACCancel1 = 1502, VoutTH1 = 1763, IDACCancel2 = 919, VoutTH2 = 1156, MaxClocks = 256, interpolate = False, return_energy = False,
+               FinePerCoarse = None, cachedir = DefaultCacheDir):
+    """Drop in replacement for `ChargeCancellationModel.ReadoutVectorised()` which answers from the lookup table of the bias configuration.
+    Integer test pulse settings are answered by direct indexing. Non-integer settings are rounded to the nearest table entry, or bilinearly interpolated if "interpolate" is "True".
+    Where the four neighbouring entries share a coarse count the fine count is interpolated directly. Across a coarse rollover (where the fine count wraps back to a low value)
+    the counts are interpolated together as the combined count Coarse * "FinePerCoarse" + Fine and split afterwards, so the result is still a consistent pair.
+    Settings outside of the table (IDACCal > 4095 or InjectionClocks > MaxClocks) are evaluated with the model.
+
+    Args:
+        CurrentMagnitude (int or NDArray): Test pulse current "IDACCal" DAC value(s).
+        InjectionClocks (int or NDArray): Test pulse length(s) in 2 ns clocks.
+        interpolate (bool, optional): Bilinearly interpolate the tables for non-integer inputs, the returned counts are then floats (the coarse count a whole number). Defaults to False.
+        return_energy (bool, optional): Also return the injected energy equivalent (eV) as `ChargeCancellationModel.IDAC_to_Energy()`. Defaults to False.
+        FinePerCoarse (float, optional): Number of fine counts equal to one coarse count, used to combine the counts when interpolating. 
+                                        Defaults to None (`ChargeCancellationModel.FinePerCoarse()` of "IDACCancel1" and "IDACCancel2").
+        Other arguments as `GetLUT()`.
+
+    Returns:
+        ReadoutArray (NDArray): Array of shape (2, *S) where S is the broadcast shape of the test pulse arguments, index 0 is the coarse count and index 1 the fine count.
+        Energy (NDArray, optional): Injected energy equivalent of shape S, only returned if "return_energy" is "True". Units given in electron volts (eV).
+    """
+    Table = GetLUT(IDACCancel1 = IDACCancel1, VoutTH1 = VoutTH1, IDACCancel2 = IDACCancel2, VoutTH2 = VoutTH2, MaxClocks = MaxClocks, cachedir = cachedir)
+    CurrentMagnitude, InjectionClocks = np.broadcast_arrays(np.asarray(CurrentMagnitude, dtype = float), np.asarray(InjectionClocks, dtype = float))
+    InTable = (CurrentMagnitude >= 0) & (CurrentMagnitude <= 4095) & (InjectionClocks >= 0) & (InjectionClocks <= MaxClocks)
+    Names = ('Coarse', 'Fine', 'Energy')
+
+    if interpolate is True:
+        FinePerCoarse = CCM.FinePerCoarse(IDACCancel1 = IDACCancel1, IDACCancel2 = IDACCancel2) if FinePerCoarse is None else FinePerCoarse
+        I = np.clip(CurrentMagnitude, 0, 4095)
+        T = np.clip(InjectionClocks, 0, MaxClocks)
+        I0 = np.minimum(np.floor(I).astype(np.intp), 4094)
+        T0 = np.minimum(np.floor(T).astype(np.intp), MaxClocks - 1)
+        dI, dT = I - I0, T - T0
+        Corners = [(I0, T0, (1 - dI) * (1 - dT)), (I0 + 1, T0, dI * (1 - dT)), (I0, T0 + 1, (1 - dI) * dT), (I0 + 1, T0 + 1, dI * dT)]
+        Coarse, Fine, Energy = [sum(Table[name][i, t] * w for i, t, w in Corners) for name in Names]
+        Low = np.minimum.reduce([np.where(w > 0, Table['Coarse'][i, t], np.inf) for i, t, w in Corners]) # coarse counts of the entries which contribute
+        High = np.maximum.reduce([np.where(w > 0, Table['Coarse'][i, t], -np.inf) for i, t, w in Corners])
+        # the combined count is linear so it is interpolated from the interpolated counts, its split is kept within the coarse counts of the neighbouring entries
+        Total = Coarse * FinePerCoarse + Fine
+        Split = np.clip(np.floor(Total / FinePerCoarse), Low, High)
+        Values = [np.where(Low == High, Low, Split).astype(float), np.where(Low == High, Fine, Total - Split * FinePerCoarse), Energy]
+    else:
+        I = np.clip(np.rint(CurrentMagnitude), 0, 4095).astype(np.intp)
+        T = np.clip(np.rint(InjectionClocks), 0, MaxClocks).astype(np.intp)
+        Values = [Table[name][I, T] for name in Names]
+
+    if not np.all(InTable):
+        Outside = ~InTable
+        ModelReadout = CCM.ReadoutVectorised(CurrentMagnitude[Outside], InjectionClocks[Outside], IDACCancel1 = IDACCancel1, VoutTH1 = VoutTH1, IDACCancel2 = IDACCancel2, VoutTH2 = VoutTH2)
+        Values = [np.array(v) for v in Values]
+        Values[0][Outside], Values[1][Outside] = ModelReadout
+        Values[2][Outside] = CCM.IDAC_to_Energy(CurrentMagnitude[Outside], InjectionClocks[Outside], IDAC_ID = 'IDACCal')
+
+    ReadoutArray = np.stack(Values[:2])
+    if return_energy is True:
+        return ReadoutArray, Values[2]
+    return ReadoutArray
@@ -0,0 +1,233 @@
+# ResultCache.py
+# Persistent on-disk cache of analysis results, keyed on the identity of the source files and the parameters of the call
+
+import os
+import json
+import pickle
+import hashlib
+
+import numpy as np
+
+from BabyDTools import SPI_analysis as SPI
+from BabyDTools import CaptureStore
+
+# default location of the cache and the largest total size it is allowed to grow to before the least recently used results are evicted
+DefaultCacheDir = os.path.join(os.path.expanduser('~'), '.babyd', 'results')
+MaxCacheBytes = 2 * 2**30 # 2 GB
+
+# keyword arguments which change how a result is computed but not the result itself, left out of the cache key
+IgnoredArguments = ('catalog', 'max_workers', 'readahead')
+
+_MISSING = object() # returned by `ResultCache.get` for a key with no stored result, so a stored None is a hit
+
+
+def file_identity(path, hash_contents = False):
+    """Identity of a source file (absolute path, size and modification time, or a SHA1 hash of its contents) or of a directory (the identities of every file below it).
+    Any change to a source file changes its identity, so results computed from the old file are never returned.
+
+    Args:
+        path (str): File or directory.
+        hash_contents (bool, optional): Identify files by a hash of their contents rather than size and modification time. Slower, but survives copying the data. Defaults to False.
+
+    Returns:
+        identity (list): JSON serialisable identity.
+    """
+    if os.path.isdir(path):
+        return [file_identity(os.path.join(root, name), hash_contents = hash_contents)
+                for root, dirs, files in sorted(os.walk(path)) for name in sorted(files) if not name.startswith('.')] # skips e.g. a catalog index
+    if hash_contents is True:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                sha1.update(block)
+        return [os.path.basename(path), sha1.hexdigest()]
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def _key_default(value):
+    """JSON form of the call arguments `json` cannot serialise itself: arrays by their type, shape and a hash of their contents, NumPy scalars by their value."""
+    if isinstance(value, np.ndarray):
+        return {'dtype': value.dtype.str, 'shape': list(value.shape), 'sha1': hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()}
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot build a cache key from an argument of type {type(value).__name__}, pass JSON serialisable values or numpy arrays.")
+
+
+class ResultCache:
+    """Content-addressed cache of the results of expensive analysis calls. A result is stored under a SHA1 key of the function, its parameters and the identity
+    of its source files (see `file_identity()`), so it is invalidated automatically when any source file changes. Results are pickled to "<key>.pkl" in the cache
+    directory, written atomically so concurrent notebooks and scripts can share a cache. When the cache grows beyond "max_bytes" the least recently used results are deleted.
+
+    Example:
+        cache = ResultCache()
+        values, ave = cached_paramsweep_loaddata(folderpath, cache = cache, pixel_select = 'all', row_select = 'all')
+    """
+
+    def __init__(self, cachedir = DefaultCacheDir, max_bytes = MaxCacheBytes, hash_contents = False):
+        """
+        Args:
+            cachedir (str, optional): Directory the results are stored in. Defaults to "~/.babyd/results".
+            max_bytes (int, optional): Largest total size of the stored results in bytes. Defaults to 2 GB.
+            hash_contents (bool, optional): Identify source files by a hash of their contents, see `file_identity()`. Defaults to False.
+        """
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"ResultCache({self.cachedir!r}, hits={self.hits}, misses={self.misses})"
+
+    def key(self, function, sources, *args, **kwargs):
+        """SHA1 key of a call of "function" with the given arguments on the given source files, keyword arguments in "IgnoredArguments" are not included.
+        Raises a TypeError for arguments which are neither JSON serialisable nor numpy arrays, rather than keying them on a (possibly summarised) repr."""
+        kwargs = {name: value for name, value in kwargs.items() if name not in IgnoredArguments}
+        Settings = {'function': f'{function.__module__}.{function.__qualname__}', 'args': args, 'kwargs': kwargs,
+                    'sources': [file_identity(path, hash_contents = self.hash_contents) for path in sources]}
+        return hashlib.sha1(json.dumps(Settings, sort_keys = True, default = _key_default).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, f'{key}.pkl')
+
+    def get(self, key, default = None):
+        """Returns the result stored under "key", or "default" if there is none. Marks the result as recently used."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        try:
+            os.utime(path) # the modification time records when a result was last used, for eviction
+        except FileNotFoundError: # evicted by another process since it was read
+            pass
+        return result
+
+    def put(self, key, result):
+        """Stores "result" under "key" and evicts least recently used results if the cache is over its size limit.
+        A result larger than the limit on its own is not stored, as it would evict every other result and then itself.
+
+        Returns:
+            stored (bool): True if the result was stored.
+        """
+        os.makedirs(self.cachedir, exist_ok = True)
+        path = self._path(key)
+        tmppath = f'{path}.{os.getpid()}.tmp'
+        with open(tmppath, 'wb') as f:
+            pickle.dump(result, f, protocol = pickle.HIGHEST_PROTOCOL)
+        if os.path.getsize(tmppath) > self.max_bytes:
+            os.remove(tmppath)
+            return False
+        os.replace(tmppath, path) # atomic so a partially written result is never read
+        self.evict()
+        return True
+
+    def call(self, function, sources, *args, **kwargs):
+        """Returns the result of `function(*args, **kwargs)` from the cache, computing and storing it if it is not there.
+
+        Args:
+            function (callable): Analysis function, its result must be picklable (e.g. arrays, lists and dictionaries of arrays).
+            sources (list): Paths of the files or directories the result is derived from.
+            *args, **kwargs: Arguments of the call, which must identify the result together with the sources. They must be JSON serialisable or numpy arrays (hashed by contents).
+                            An "out" argument cannot be passed, a cached result would never be written into it.
+
+        Returns:
+            result: The result of the call.
+        """
+        assert kwargs.get('out') is None, "Calls writing into an 'out' argument cannot be cached, a cached result would not be written into it."
+        key = self.key(function, sources, *args, **kwargs)
+        result = self.get(key, _MISSING)
+        if result is not _MISSING:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = function(*args, **kwargs)
+        self.put(key, result)
+        return result
+
+    def _entries(self):
+        if not os.path.isdir(self.cachedir):
+            return []
+        entries = []
+        for item in os.scandir(self.cachedir):
+            if item.name.endswith('.pkl'):
+                stat = item.stat()
+                entries += [(stat.st_mtime, stat.st_size, item.path)]
+        return sorted(entries)
+
+    def size(self):
+        """Total size of the stored results in bytes."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, max_bytes = None):
+        """Deletes the least recently used results until the cache is no larger than "max_bytes" (defaults to the limit of the cache).
+
+        Returns:
+            evicted (int): Number of results deleted.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError: # already evicted by another process
+                pass
+            total -= size
+            evicted += 1
+        return evicted
+
+    def clear(self):
+        """Deletes every stored result."""
+        self.evict(max_bytes = 0)
+
+
+def _capture_sources(filepath, catalog):
+    """Source files of the capture "filepath" belongs to, as loaded by `SPI_analysis.load_data`."""
+    if CaptureStore.is_hdf5(filepath):
+        return [filepath]
+    return SPI.capture_files(filepath, catalog = catalog)[0]
+
+
+def _capture_ave(filepath, catalog = None, **kwargs):
+    return SPI.calc_ave(SPI.load_data(filepath, mmap_mode = 'r', catalog = catalog), **kwargs)
+
+
+def _capture_histograms(filepath, catalog = None, **kwargs):
+    from BabyDTools.PixelHistograms import pixel_histograms
+    return pixel_histograms(SPI.build_array(SPI.load_data(filepath, mmap_mode = 'r', catalog = catalog), lazy = True), **kwargs)
+
+
+def _sweep_average(folderpath, **kwargs):
+    result = SPI.paramsweep_loaddata(folderpath, AverageData = True, **kwargs)
+    return None if result is None else (result[0], result[2])
+
+
+def cached_paramsweep_loaddata(folderpath, cache = None, **kwargs):
+    """The averaged sweep of `SPI_analysis.paramsweep_loaddata(..., AverageData = True)` through the result cache (a default `ResultCache` if "cache" is None), 
+    keyed on every file of the sweep folder or HDF5 file. Only the derived arrays are cached, the raw sweep data is not (load it with `paramsweep_loaddata` when needed).
+
+    Returns:
+        OrderedParamSweeped (list): Sorted values of the swept parameter.
+        AveStore (NDArray): Average [0] and standard deviation [1] across captures, as returned by `paramsweep_loaddata`.
+    """
+    cache = ResultCache() if cache is None else cache
+    kwargs.pop('AverageData', None)
+    return cache.call(_sweep_average, [folderpath], folderpath, **kwargs)
+
+
+def cached_calc_ave(filepath, cache = None, catalog = None, **kwargs):
+    """`SPI_analysis.calc_ave` of the capture "filepath" belongs to (as loaded by `SPI_analysis.load_data`), through the result cache, keyed on the files of the capture."""
+    cache = ResultCache() if cache is None else cache
+    return cache.call(_capture_ave, _capture_sources(filepath, catalog), filepath, catalog = catalog, **kwargs)
+
+
+def cached_pixel_histograms(filepath, cache = None, catalog = None, **kwargs):
+    """`PixelHistograms.pixel_histograms` of the full array of the capture "filepath" belongs to, through the result cache, keyed on the files of the capture."""
+    cache = ResultCache() if cache is None else cache
+    return cache.call(_capture_histograms, _capture_sources(filepath, catalog), filepath, catalog = catalog, **kwargs)
@@ -2,74 +2,143 @@
 # Function package for loading in SPI Data from BabyD
 
 import os
+import re
 import numpy as np
 
+from BabyDTools.Instrumentation import stage, instrument_module
+
 # general format of output``
 # ! "Row0to1Data_NoPixelConnectedNumCaptures_1000_153837"
 # ! "C:\Users\rif36645\OneDrive - Science and Technology Facilities Council\Projects-DESKTOP-P8841A7\DynamiX local files\testing_outputs\StephenTests\NoPixelSel\Row0to1Data_NoPixelConnectedNumCaptures_1000_153837.npy"
 
-def load_data(filepath, framecapture = True, printkeys = False, printfilepaths = False, printfileinfo = False):
+def parse_filename(filename, ParamSweepStep = 1):
+    """Splits the name of an SPI data file into its components, following the "Row0to1Data_<test_name>NumCaptures_<N>_<time>.npy" naming scheme.
+    Files from a parameter sweep additionally contain the sweep value after "step<ParamSweepStep>" and the sweep range as "start<start>stop<stop>".
+
+    Args:
+        filename (str): Name or path of the .npy file.
+        ParamSweepStep (int, optional): Step used during the parameter sweep, as used in the file name. Defaults to 1.
+
+    Returns:
+        fileinfo (dict): Contains "RowID" (e.g. "Row0to1Data"), "Row" (first row of the pair), "test_name", "NumCaptures", "timestamp" and "SweepValue", "SweepStart", "SweepStop" 
+                        (None if not a sweep file). "SweepName" identifies the sweep a file belongs to, it is the file name without the RowID, sweep value and timestamp.
+                        Returns None if the file name does not follow the naming scheme.
+    """
+    filename = os.path.basename(filename)
+    stem = os.path.splitext(filename)[0]
+    match = re.match(r'^(Row(\d+)to\d+[^_]*)_(.*?)NumCaptures_(\d+)_(\d+)', stem)
+    if match is None:
+        return None
+
+    fileinfo = {'RowID': match.group(1), 'Row': int(match.group(2)), 'test_name': match.group(3).split('_')[0],
+                'NumCaptures': int(match.group(4)), 'timestamp': match.group(5),
+                'SweepValue': None, 'SweepStart': None, 'SweepStop': None, 'SweepName': None}
+
+    sweepvalue = re.search(rf'step{ParamSweepStep}(-?\d+)', stem)
+    if sweepvalue is not None:
+        fileinfo['SweepValue'] = int(sweepvalue.group(1))
+        sweeprange = re.search(r'start(-?\d+)stop(-?\d+)', stem)
+        if sweeprange is not None:
+            fileinfo['SweepStart'], fileinfo['SweepStop'] = int(sweeprange.group(1)), int(sweeprange.group(2))
+        sweepname = stem[len(match.group(1)) + 1:].rsplit('_', 1)[0]
+        fileinfo['SweepName'] = re.sub(rf'step{ParamSweepStep}-?\d+', f'step{ParamSweepStep}', sweepname)
+
+    return fileinfo
+
+def capture_files(filepath, framecapture = True, catalog = None):
+    """Finds the files "load_data" loads for "filepath": all SPI data .npy files below its directory whose name contains the test name (or with a catalog, the files with exactly
+    the same test name, number of captures and timestamp), or only "filepath" itself if "framecapture" is "False".
+
+    Returns:
+        filepaths (list): Paths of the files.
+        keys (list): Dictionary key of each file in the output of "load_data", the RowID followed by the test name.
+    """
+    filename = os.path.basename(filepath)
+    RowID = filename.split('_')[0]
+    test_name = filename.split('_')[1].split('NumCaptures')[0]
+    
+    if framecapture is True and catalog is not None: # exact lookup of the files from the same capture
+        filepaths = catalog.capture_files(filepath)
+        keys = [fileinfo['RowID'] + fileinfo['test_name'] for fileinfo in map(parse_filename, filepaths)]
+    elif framecapture is True: # look for other files that share the same name but different RowID to put together a frame of data
+        filepaths = []
+        keys = []
+        with stage('os.walk'):
+            for root, dirs, files in os.walk(os.path.dirname(filepath) or os.curdir, topdown=True):
+                for name in files:
+                    fileinfo = parse_filename(name) if name.endswith('.npy') and test_name in name else None # skips e.g. HDF5 stores and index files
+                    if fileinfo is not None:
+                        filepaths += [os.path.join(root, name)]
+                        keys += [fileinfo['RowID'] + fileinfo['test_name']]
+    else:
+        filepaths = [filepath]
+        keys = [RowID + test_name]
+    return filepaths, keys
+
+def load_data(filepath, framecapture = True, printkeys = False, printfilepaths = False, printfileinfo = False, mmap_mode = None, catalog = None):
     """Collates recorded SPI data into a dictionary where each entry is a different row in the 16 x 16 pixel array.
     Can select between only reading in a partiular .npy file containing SPI data from 2 rows, or by setting "framecapture" to "True", 
     the full pixel array is loaded to dictionary from 8 .npy files which share a common testname. 
+    An HDF5 capture written by `CaptureStore.convert_capture` (.h5 / .hdf5) is loaded in the same dictionary format.
+    With "mmap_mode" set the files are memory-mapped rather than read, data is then only read from disk when it is accessed (see `build_array(lazy = True)`).
+    Packed captures (see `pack_capture`) are loaded in their packed form, which "build_array", "calc_ave" and "calc_stats" accept directly.
 
     Args:
-        filepath (_type_): path of .npy file to be loaded in
+        filepath (_type_): path of .npy file to be loaded in, or of an HDF5 capture file
         framecapture (bool, optional): Parameter which choses to load in all .npy files which share a common test name (True) or just the single specified file (False). 
         This is utilised to load all recorded SPI data which relates to the same test, producing a dictionary containing data for all rows of the pixel array. Defaults to True.
         printkeys (bool, optional): Prints the keys of the returned dictionary. Defaults to False.
         printfilepaths (bool, optional): Prints the file paths which were called in loading the data. This includes those that were identified to share a common test name. Defaults to False.
         printfileinfo (bool, optional): Prints the "filename", "test_name" and "RowID" as as split from the "filepath" argument. Used for debugging. Defaults to False.
+        mmap_mode (str, optional): Passed to `np.load`, "r" opens the files read-only as memory-maps, "r+" / "c" allow (copy-on-)write. None reads the full files into memory. 
+                                    For HDF5 files any value other than None returns lazy row views which only read the chunks that are accessed. Defaults to None.
+        catalog (CaptureCatalog, optional): If given with "framecapture" = "True", the files of the capture are found by exact lookup in the catalog (see `CaptureCatalog`) 
+                                            rather than walking the directory tree and matching file names containing the test name. Defaults to None.
 
     Returns:
         _type_: _description_
     """
     
-    datastore = {} # can change to hdf5 later if I want
-    filename = filepath.split('\\')[-1]
-    RowID = filename.split('_')[0]
-    test_name = filename.split('_')[1].split('NumCaptures')[0]
+    from BabyDTools import CaptureStore
+
+    if CaptureStore.is_hdf5(filepath): # consolidated HDF5 capture
+        datastore = CaptureStore.load_capture(filepath, lazy = mmap_mode is not None)
+        if printkeys is True:
+            print(datastore.keys())
+        return datastore
+
     if printfileinfo is True:
+        filename = os.path.basename(filepath)
         print(filename)
-        print(test_name)
-        print(RowID)
-    
-    if framecapture is True: # look for other files that share the same name but different RowID to put together a frame of data
-        capturefiles = []
-        captureRowID = []
-        capturetest_name = []
-        for root, dirs, files in os.walk(filepath.split(filename)[0], topdown=True):
-            for name in files:
-                if test_name in name:
-                    capturefiles += [os.path.join(root, name)]
-                    captureRowID += [name.split('_')[0]]
-                    capturetest_name += [name.split('_')[1].split('NumCaptures')[0]]
-
-        filepaths = capturefiles.copy()
-        RowIDs = captureRowID.copy()
-        test_names = capturetest_name.copy()
-    else:
-        filepaths = [filepath]
-        RowIDs = [RowID]
-        test_names = [test_name]
+        print(filename.split('_')[1].split('NumCaptures')[0])
+        print(filename.split('_')[0])
+
+    datastore = {}
+    filepaths, keys = capture_files(filepath, framecapture = framecapture, catalog = catalog)
         
     if printfilepaths is True:
         print(filepaths)
         
-    for i in range(len(filepaths)):
-        datastore[RowIDs[i] + test_names[i]] = np.load(filepaths[i])
+    for path, key in zip(filepaths, keys):
+        with stage('np.load') as loading:
+            datastore[key] = np.load(path, mmap_mode = mmap_mode)
+            if mmap_mode is None:
+                loading.read(datastore[key].nbytes)
     
     if printkeys is True:
         print(datastore.keys())
     return datastore
 
-def calc_ave(datastore, buildarray = True):
+def calc_ave(datastore, buildarray = True, chunk_frames = None):
     """Determines the average value for each pixel in the datastore, will accept the dictionary format produced by "load_data" or the numpy array format produced by "build_array".
     If in dictionary format the "buildarray" argument can be varied to return the output of this function either as a dictionary or a numpy array (array is default.)
+    Lazy arrays (`build_array(lazy = True)`), or any input when "chunk_frames" is given, are averaged in a single streaming pass over blocks of frames (see `calc_stats`) 
+    so the data never has to fit in memory.
 
     Args:
         datastore (_type_): Contains data from SPI array sweep in dictionary format OR in numpy array format
         buildarray (bool, optional): If "True", the output of this function is returned as a numpy array of shape (N,M) where N and M are the number of pixes in the x and y directions . Defaults to True.
+        chunk_frames (int, optional): Number of frames read at a time when streaming. Defaults to None (4096 frames for lazy arrays, whole array otherwise).
 
     Returns:
         _type_: _description_
@@ -81,14 +150,9 @@ def calc_ave(datastore, buildarray = True):
         ave_dict_fine = {}
         ave_dict_coarse = {}
         for key, item in datastore.items():
-            
-            fine1 = [np.average(item[0][:,pixel,1]) for pixel in range(16)]
-            fine2 = [np.average(item[1][:,pixel,1]) for pixel in range(16)]
-            ave_dict_fine['Fine' + key] = [fine1,fine2]
-            
-            coarse1 = [np.average(item[0][:,pixel,0]) for pixel in range(16)]
-            coarse2 = [np.average(item[1][:,pixel,0]) for pixel in range(16)]
-            ave_dict_coarse['Coarse' + key] = [coarse1,coarse2]
+            mean = calc_stats(item, chunk_frames = chunk_frames).mean # shape [2,16,2] - (row in pair, pixel, coarse/fine)
+            ave_dict_fine['Fine' + key] = [mean[0,:,1], mean[1,:,1]]
+            ave_dict_coarse['Coarse' + key] = [mean[0,:,0], mean[1,:,0]]
                 
         if buildarray is True:
             array_fine = build_array(datastore = ave_dict_fine)
@@ -99,9 +163,13 @@ def calc_ave(datastore, buildarray = True):
             return ave_dict
         
         
-    elif isinstance(datastore, np.ndarray) is True:
+    elif isinstance(datastore, (np.ndarray, LazyFrameArray)) is True:
         print('numpy array type datastore identified')
 
+        if isinstance(datastore, LazyFrameArray) or chunk_frames is not None or is_packed(datastore):
+            mean = calc_stats(datastore, chunk_frames = chunk_frames).mean
+            return [mean[:,:,1], mean[:,:,0]]
+
         array_fine = np.average(datastore[:,:,:,1],axis=1)
         array_coarse = np.average(datastore[:,:,:,0],axis=1)  
 
@@ -111,132 +179,677 @@ def calc_ave(datastore, buildarray = True):
         print('unrecognised dataformat')
 
 
-def build_array(datastore):
+def calc_stats(datastore, chunk_frames = None):
+    """Computes the per-pixel mean, standard deviation, min / max of the coarse and fine data and the number of overflow frames in a single sequential pass, 
+    reading "chunk_frames" frames at a time. Accepts the output of "build_array" (including lazy arrays), a single row-pair entry of "load_data", 
+    or the full "load_data" dictionary (which must contain all 16 rows). Packed data (see `pack_data`) is unpacked one block at a time.
+
+    Args:
+        datastore (_type_): Frame data with frames along axis 1, e.g. [16,N,16,3] or [2,N,16,3], or a dictionary as returned by "load_data".
+        chunk_frames (int, optional): Number of frames read at a time. Defaults to None (whole array for in-memory arrays, 4096 frames for memory-mapped or lazy data).
+
+    Returns:
+        stats (StreamingStatistics.PixelStatistics): Statistics with arrays of shape [rows,16,2] (coarse [0], fine [1]), see `PixelStatistics`.
+    """
+    from BabyDTools.StreamingStatistics import PixelStatistics
+
+    if isinstance(datastore, dict):
+        datastore = LazyFrameArray(datastore)
+    rows = len(datastore)
+    packed = is_packed(datastore[0])
+    shape = (rows,) + tuple(datastore[0].shape[1:] if packed else datastore[0].shape[1:-1])
+    numframes = datastore[0].shape[0]
+    if chunk_frames is None:
+        chunk_frames = numframes if type(datastore) is np.ndarray else 4096 # np.memmap is an ndarray subclass, read in bounded blocks
+
+    stats = PixelStatistics(shape = shape)
+    for start in range(0, numframes, max(chunk_frames, 1)):
+        stop = min(start + chunk_frames, numframes)
+        if isinstance(datastore, (np.ndarray, LazyFrameArray)):
+            block = datastore[:, start:stop]
+        else: # list of lazy rows e.g. from an HDF5 capture
+            block = np.stack([row[start:stop] for row in datastore])
+        if packed:
+            block = unpack_data(block)
+        stats.update(block, frame_axis = 1)
+    return stats
+
+
+def build_array(datastore, lazy = False):
     """Converts dictionary containing SPI data for an the full detector array into numpy array of dimensions [16,N,16,3].
     Indexes 0 and 2 (shape = 16) define the number of pixels in the array
     Index 1 (shape = N) defines the number of frames collected
-    Index 3 (shape = 3) selects between Coarse [0], Fine [1] and Overflow [2]
+    Index 3 (shape = 3) selects between Coarse [0], Fine [1] and Overflow [2], packed data (see `pack_data`) has no index 3 and gives a packed [16,N,16] array.
 
     Args:
         datastore (_type_): Contains data from SPI array sweep in dictionary format, argument is the output of "load_data"
+        lazy (bool, optional): If "True" a `LazyFrameArray` is returned which stitches the row pairs together without copying them. Used with `load_data(mmap_mode = 'r')` 
+                            data is only read from disk for the slices that are accessed. Defaults to False.
 
     Returns:
         _type_: _description_
     """
+    if lazy is True:
+        return LazyFrameArray(datastore)
+
     data_array = [[] for _ in range(16)] 
     for key, item in datastore.items():
         data_array[int(key.split('Row')[1].split('to')[0])] = item[0]
         data_array[int(key.split('Row')[1].split('to')[0]) + 1] = item[1]
         
-    data_array = np.array(data_array)
+    with stage('build_array.np.array'): # conversion of the list of rows to one array
+        data_array = np.array(data_array)
     return data_array
+
+
+class LazyFrameArray:
+    """Read-only [16,N,16,3] view of the row-pair arrays returned by `load_data`, indexed in the same way as the output of `build_array`.
+    Rows are stitched together only for the slice being accessed, so with memory-mapped row-pair files (`load_data(mmap_mode = 'r')`) nothing is read from disk
+    until it is indexed and selecting a single row returns a view of the underlying file without any copy.
+    """
+
+    def __init__(self, datastore):
+        self.rows = [None for _ in range(16)]
+        for key, item in datastore.items():
+            row = int(key.split('Row')[1].split('to')[0])
+            self.rows[row] = item[0]
+            self.rows[row + 1] = item[1]
+
+        missing = [row for row in range(16) if self.rows[row] is None]
+        assert len(missing) == 0, f"Rows {missing} are missing from the datastore."
+        assert all(row.shape == self.rows[0].shape for row in self.rows), "Row-pair files do not contain the same number of frames."
+
+        self.shape = (16,) + tuple(self.rows[0].shape)
+        self.dtype = self.rows[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f"LazyFrameArray(shape={self.shape}, dtype={self.dtype})"
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+
+        rowkey, rest = key[0], key[1:]
+        if isinstance(rowkey, (int, np.integer)):
+            return self.rows[rowkey][rest]
+        return np.stack([self.rows[row][rest] for row in np.arange(16)[rowkey]])
+
+    def __array__(self, dtype = None, copy = None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
         
 
-## may be unnecessary
-# def dark_correct(test_datastore, dark_dict): 
-    
-#     darkcorrected = {}
-#     for k,v in dark_dict.items():
-#         finekeys = []
-#         if 'Fine' in k:
-            
-#             rowid = k.split('Fine')[1]
-#             for kd, vd in test_datastore.items():
-#                 if rowid in kd:
-#                     vc = vd.copy()
-#                     # vc0 = np.zeros(shape=(10000,16))
-#                     # vc1 = np.zeros(shape=(10000,16))
-#                     for i in range(len(vd[0][:,0,0])):
-#                         vc[0][i,:,1] = vd[0][i,:,1] - [int(j) for j in v[0]]
-#                         vc[1][i,:,1] = vd[1][i,:,1] - [int(j) for j in v[1]]
-#                     darkcorrected[f'{kd}'] = vc
-                    
-#             finekeys += [k]
-            
-    
-#     return darkcorrected
+# Packed sample format: each pixel sample stored as a single uint16 with the 8-bit coarse count in bits 15-8, the 7-bit fine count in bits 7-1 and the overflow flag in bit 0,
+# i.e. (coarse << 8 | fine << 1 | overflow). Packed arrays drop the trailing [coarse, fine, overflow] axis, e.g. a row-pair file becomes [2,N,16].
+# The structured form keeps the three values as named fields ("coarse", "fine", "overflow") of 3 bytes per sample.
+StructuredDtype = np.dtype([('coarse', np.uint8), ('fine', np.uint8), ('overflow', np.bool_)])
 
-def paramsweep_loaddata(folderpath, ParamSweepStep = 1, pixel_select = 8, row_select = 0, AverageData = False): #! will improve later to allow for multiple pixels but not a priority rn
-    """Loads in folder containing all of the data files for parameter sweep. By default returns an 4 dimensional array containing the sweep output: [N_captures,N_files,Npixels,3] 
-    and a 1-D array containg the values of the sweeped parameter. The final index of the sweeped values returns the coarse data [0], fine data [1], or overflow value [2].
-    With the "AverageData" argument set to "True" an additional variable will be returned which averages over the "N_captures" and calculates the standard deviation. 
-    This is stored as an array of shape [2,N_files,N_pixels,3], where for first index Average is [0] and std = [1].
-    
-    **NOTE:** At current N_pixels is set to a specific pixel so retunring arrays will be 3-D not 4-D.
+
+def is_packed(array):
+    """Checks if "array" holds packed samples, either structured or uint16 without the trailing axis of 3 (coarse, fine, overflow)."""
+    dtype = np.dtype(array.dtype)
+    return dtype.names is not None or (dtype == np.uint16 and (len(array.shape) == 0 or array.shape[-1] != 3))
+
+
+def pack_data(array, structured = False):
+    """Packs SPI data into one uint16 per pixel sample (see "StructuredDtype" for the layout) or the structured form.
 
     Args:
-        folderpath (_type_): _description_
-        ParamSweepStep (int, optional): _description_. Defaults to 1.
-        pixel_select (int, optional): _description_. Defaults to 8.
-        row_select (int, optional): Can only take values 0 or 1 and correspond to the first or second row in the 2 row SPI readout file. For even numbered row, input 0, for odd numbered row, input 1. Defaults to 0.
-        AverageData (bool, optional): _description_. Defaults to False.
+        array (NDArray): Data with a trailing axis of coarse [0], fine [1] and overflow [2], e.g. a row-pair file [2,N,16,3] or the output of "build_array".
+        structured (bool, optional): Return the structured form ("StructuredDtype") rather than uint16. Defaults to False.
 
     Returns:
-        _type_: _description_
+        packed (NDArray): Packed data with the trailing axis removed.
     """
-    
-    ParentDatastore = []
-    ParamSweeped = []
-
-    for root, dirs, files in os.walk(folderpath, topdown=True):
-        for file in files:
-            datastore = load_data(filepath = folderpath + '/' + file, framecapture = False, printkeys = False)
-            for key, item in datastore.items():
-                ParamSweeped  += [int(file.split(f'step{ParamSweepStep}')[1].split('_')[0])]
-                ParentDatastore += [item[row_select,:,:,:]] # row_select can only take values 0 or 1 and correspond to the first or second row in the 2 row SPI readout file.
-                
-    ParentDatastore = np.array(ParentDatastore)
-    
-    if isinstance(pixel_select, str):
-        if pixel_select.lower == 'all':
-            OrderedData = np.zeros_like(ParentDatastore[:,:,:,:]) # can only do this because step is 1
+    array = np.asarray(array)
+    coarse, fine, overflow = array[..., 0], array[..., 1], array[..., 2]
+    assert np.all((coarse >= 0) & (coarse < 2**8) & (fine >= 0) & (fine < 2**7)), "Coarse values must be in the range [0, 255] and fine in [0, 127] to be packed."
+
+    if structured is True:
+        packed = np.empty(array.shape[:-1], dtype = StructuredDtype)
+        packed['coarse'], packed['fine'], packed['overflow'] = coarse, fine, overflow != 0
+        return packed
+    return (coarse.astype(np.uint16) << 8) | (fine.astype(np.uint16) << 1) | (overflow != 0).astype(np.uint16)
+
+
+def unpack_data(packed, dtype = np.uint8):
+    """Unpacks data packed by "pack_data" (either form) to an array with a trailing axis of coarse [0], fine [1] and overflow [2].
+
+    Args:
+        packed (NDArray): Packed data.
+        dtype (optional): Data type of the returned array. Defaults to np.uint8.
+
+    Returns:
+        array (NDArray): Unpacked data of shape [*packed.shape,3].
+    """
+    packed = np.asarray(packed)
+    array = np.empty(packed.shape + (3,), dtype = dtype)
+    if packed.dtype.names is not None:
+        array[..., 0], array[..., 1], array[..., 2] = packed['coarse'], packed['fine'], packed['overflow']
+    else:
+        array[..., 0], array[..., 1], array[..., 2] = packed >> 8, (packed >> 1) & 0x7F, packed & 1
+    return array
+
+
+def pack_capture(filepath, outfolder, structured = False, chunk_frames = 65536, catalog = None):
+    """Writes packed copies (see "pack_data") of all row-pair files of a capture into "outfolder", keeping the file names so they load with "load_data" as before.
+    Files are memory-mapped and packed one block of frames at a time.
+
+    Args:
+        filepath (str): Path of any one of the row-pair .npy files of the capture.
+        outfolder (str): Folder to write the packed files to, must not be the folder of the capture.
+        structured (bool, optional): Write the structured form rather than uint16. Defaults to False.
+        chunk_frames (int, optional): Number of frames packed at a time. Defaults to 65536.
+        catalog (CaptureCatalog, optional): Used to find the files of the capture. Defaults to None (files in the same folder with the same test name and number of captures).
+
+    Returns:
+        outpaths (list): Paths of the packed files.
+    """
+    assert os.path.abspath(outfolder) != os.path.abspath(os.path.dirname(filepath)), "Packed files would overwrite the capture, choose a different output folder."
+    if catalog is not None:
+        filepaths = catalog.capture_files(filepath)
+    else:
+        fileinfo = parse_filename(filepath)
+        folder = os.path.dirname(filepath)
+        filepaths = []
+        for name in sorted(os.listdir(folder or os.curdir)):
+            info = parse_filename(name) if name.endswith('.npy') else None
+            if info is not None and info['test_name'] == fileinfo['test_name'] and info['NumCaptures'] == fileinfo['NumCaptures']:
+                filepaths += [os.path.join(folder, name)]
+
+    os.makedirs(outfolder, exist_ok = True)
+    outpaths = []
+    for path in filepaths:
+        item = np.load(path, mmap_mode = 'r')
+        outpath = os.path.join(outfolder, os.path.basename(path))
+        packed = np.lib.format.open_memmap(outpath, mode = 'w+', dtype = StructuredDtype if structured is True else np.uint16, shape = item.shape[:-1])
+        for start in range(0, item.shape[1], chunk_frames):
+            packed[:, start:start + chunk_frames] = pack_data(item[:, start:start + chunk_frames], structured = structured)
+        packed.flush()
+        outpaths += [outpath]
+    return outpaths
+
+
+def _frame_blocks(array, start, stop, chunk_frames, frame_axis, unpack):
+    """Yields [chunk,16,16,3] blocks of frames "start" to "stop" of an array (or lazy array / HDF5 dataset) with frames along "frame_axis"."""
+    for blockstart in range(start, stop, chunk_frames):
+        index = [slice(None)] * len(array.shape)
+        index[frame_axis] = slice(blockstart, min(blockstart + chunk_frames, stop))
+        block = np.ascontiguousarray(np.moveaxis(np.asarray(array[tuple(index)]), frame_axis, 0))
+        yield unpack_data(block) if unpack is True and is_packed(block) else block
+
+
+def _sweep_blocks(folderpath, start, stop, chunk_frames, unpack, ParamSweepStep, catalog):
+    """Yields (SweepValue, block) for each step of a sweep folder, rows without a file in the sweep are zero."""
+    files = _sweep_files(folderpath, ParamSweepStep = ParamSweepStep, catalog = catalog)
+    for SweepValue in sorted({fileinfo['SweepValue'] for fileinfo, _ in files}):
+        rows = [None for _ in range(16)]
+        for fileinfo, path in files:
+            if fileinfo['SweepValue'] == SweepValue:
+                item = np.load(path, mmap_mode = 'r')
+                rows[fileinfo['Row']], rows[fileinfo['Row'] + 1] = item[0], item[1]
+        first = next(row for row in rows if row is not None)
+        for blockstart in range(start, min(stop, first.shape[0]), chunk_frames):
+            blockstop = min(blockstart + chunk_frames, stop, first.shape[0])
+            block = np.zeros((blockstop - blockstart, 16) + first.shape[1:], dtype = first.dtype)
+            for row, data in enumerate(rows):
+                if data is not None:
+                    block[:, row] = data[blockstart:blockstop]
+            yield SweepValue, unpack_data(block) if unpack is True and is_packed(block) else block
+
+
+def _hdf5_blocks(h5path, start, stop, chunk_frames):
+    """Yields the frame blocks of an HDF5 capture, or (SweepValue, block) for each step of an HDF5 sweep (see `CaptureStore`), reading only the chunks of each block."""
+    import h5py
+
+    with h5py.File(h5path, 'r') as h5file:
+        if 'sweep' in h5file:
+            dataset = h5file['sweep']
+            for step, SweepValue in enumerate(h5file['sweep_values'][:]):
+                for blockstart in range(start, min(stop, dataset.shape[1]), chunk_frames):
+                    yield int(SweepValue), dataset[step, blockstart:min(blockstart + chunk_frames, stop)]
+        else:
+            dataset = h5file['frames']
+            for blockstart in range(start, min(stop, dataset.shape[0]), chunk_frames):
+                yield dataset[blockstart:min(blockstart + chunk_frames, stop)]
+
+
+def _readahead(blocks, depth):
+    """Runs the generator "blocks" on a background thread, keeping up to "depth" blocks ready so reading overlaps with the processing of the previous block."""
+    import queue
+    import threading
+
+    ready = queue.Queue(maxsize = depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                ready.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for block in blocks:
+                if not put((block, None)):
+                    return
+            put((done, None))
+        except BaseException as error: # passed on to the consumer
+            put((done, error))
+        finally:
+            if hasattr(blocks, 'close'):
+                blocks.close()
+
+    thread = threading.Thread(target = reader, daemon = True)
+    thread.start()
+    try:
+        while True:
+            block, error = ready.get()
+            if error is not None:
+                raise error
+            if block is done:
+                return
+            yield block
+    finally:
+        stopped.set() # consumer finished or stopped early
+        thread.join()
+
+
+def iter_frames(source, chunk_frames = 4096, start = 0, stop = None, readahead = 0, unpack = True, ParamSweepStep = 1, catalog = None):
+    """Generator of aligned [chunk,16,16,3] frame blocks from a capture of any size, so analysis can run with bounded memory (e.g. `PixelStatistics.update()` on each block).
+    Data is memory-mapped (or read chunk by chunk from HDF5) and only the frames of the current block are read.
+
+    Args:
+        source (_type_): Path of any row-pair .npy file of a capture (see "load_data"), an HDF5 capture or sweep written by `CaptureStore`, a sweep folder (see "paramsweep_loaddata"),
+                        or data already loaded: a "load_data" dictionary or an array / `LazyFrameArray` in the [16,N,16,3] layout of "build_array".
+        chunk_frames (int, optional): Number of frames per block, the last block of a range may be shorter. Defaults to 4096.
+        start (int, optional): First frame to read. Defaults to 0.
+        stop (int, optional): Frame to stop before. Defaults to None (the end of the capture).
+        readahead (int, optional): Number of blocks read ahead on a background thread, 0 reads each block when it is requested. Defaults to 0.
+        unpack (bool, optional): Unpack packed data (see "pack_data") to the [chunk,16,16,3] layout, else packed blocks of [chunk,16,16] are returned. Defaults to True.
+        ParamSweepStep (int, optional): Step used in sweep file names. Defaults to 1.
+        catalog (CaptureCatalog, optional): Used to find the files of the capture or sweep. Defaults to None.
+
+    Yields:
+        block (NDArray): Frames of shape [chunk,16,16,3]. For sweeps (sweep folders and HDF5 sweeps), (SweepValue, block) for each step in order of sweep value, 
+                        rows not recorded in a sweep folder are zero.
+    """
+    from BabyDTools.CaptureStore import is_hdf5
+
+    if stop is None:
+        stop = np.iinfo(np.int64).max
+
+    if isinstance(source, str) and os.path.isdir(source):
+        blocks = _sweep_blocks(source, start, stop, chunk_frames, unpack, ParamSweepStep, catalog)
+    elif isinstance(source, str) and is_hdf5(source):
+        blocks = _hdf5_blocks(source, start, stop, chunk_frames)
+    else:
+        if isinstance(source, str):
+            source = load_data(source, mmap_mode = 'r', catalog = catalog)
+        array = LazyFrameArray(source) if isinstance(source, dict) else source
+        blocks = _frame_blocks(array, start, min(stop, array.shape[1]), chunk_frames, 1, unpack)
+
+    if readahead > 0:
+        blocks = _readahead(blocks, readahead)
+    yield from blocks
+
+
+def build_dark_map(datastore, chunk_frames = None, savepath = None):
+    """Builds the per-pixel dark map (mean coarse and fine value) of a dark capture in a single streaming pass, see `calc_stats`.
+
+    Args:
+        datastore (_type_): Dark capture as accepted by "calc_stats", e.g. the output of "load_data" (memory-mapped or HDF5 captures are streamed) or "build_array".
+        chunk_frames (int, optional): Number of frames read at a time. Defaults to None (see `calc_stats`).
+        savepath (str, optional): If given the dark map is saved to this .npy file for reuse with `load_dark_map`. Defaults to None.
+
+    Returns:
+        DarkMap (NDArray): Mean dark value of shape [16,16,2] (row, pixel, coarse [0] / fine [1]).
+    """
+    DarkMap = calc_stats(datastore, chunk_frames = chunk_frames).mean
+    if savepath is not None:
+        np.save(savepath, DarkMap)
+    return DarkMap
+
+
+def load_dark_map(filepath):
+    """Loads a dark map saved by `build_dark_map`."""
+    return np.load(filepath)
+
+
+def _dark_correct_block(block, dark, FinePerCoarse, out):
+    """Subtracts the dark map (in fine counts) from a block of frames [rows,N,16,3] into "out", borrowing from the coarse count when the fine value goes negative."""
+    values = block[..., :2].astype(np.float64)
+    fine = values[..., 1] - dark
+    borrow = np.maximum(np.ceil(-fine / FinePerCoarse), 0) # whole coarse counts needed to bring the fine value back to 0 or above
+    fine += borrow * FinePerCoarse
+    out[..., 0] = values[..., 0] - borrow
+    out[..., 1] = np.rint(fine) if np.issubdtype(out.dtype, np.integer) else fine
+    out[..., 2] = block[..., 2]
+
+
+def dark_correct(datastore, DarkMap, FinePerCoarse = None, inplace = False, out = None, chunk_frames = 1024, IDACCancel1 = 1502, IDACCancel2 = 919):
+    """Subtracts a dark map (see `build_dark_map`) from every frame of a capture by broadcasting, one block of "chunk_frames" frames at a time.
+    Coarse and fine are corrected together: where the fine value would go negative one coarse count is borrowed for every "FinePerCoarse" fine counts,
+    so the fine value is never negative and the coarse value may become negative. The overflow flag is copied unchanged.
+    For integer data the corrected fine value is rounded to whole counts and the output has a signed integer type (e.g. int16 for uint8 data).
+
+    Args:
+        datastore (_type_): Capture in the dictionary format of "load_data" (including memory-mapped captures) or the [16,N,16,3] array of "build_array" (lazy arrays are supported).
+        DarkMap (NDArray or str): Dark map of shape [16,16,2], or the path of a dark map saved by `build_dark_map`.
+        FinePerCoarse (float, optional): Number of fine counts equal to one coarse count. Defaults to None (`ChargeCancellationModel.FinePerCoarse()` of "IDACCancel1" and "IDACCancel2").
+        inplace (bool, optional): Write the corrected data back into "datastore" (e.g. a memory-map opened with mmap_mode = "r+"), which must have a signed data type. Defaults to False.
+        out (str or NDArray, optional): For array input, a preallocated [16,N,16,3] output array or the path of a .npy file which is created as a memory-map. Defaults to None.
+        chunk_frames (int, optional): Number of frames corrected at a time, limits the memory used. Defaults to 1024.
+        IDACCancel1 (int, optional): DAC setting of the 1st (Coarse) stage cancellation current the capture was taken with. Defaults to 1502.
+        IDACCancel2 (int, optional): DAC setting of the 2nd (Fine) stage cancellation current the capture was taken with. Defaults to 919.
+
+    Returns:
+        corrected (_type_): Dark corrected data in the same format as "datastore".
+    """
+    if isinstance(DarkMap, str):
+        DarkMap = load_dark_map(DarkMap)
+    DarkMap = np.asarray(DarkMap)
+    if FinePerCoarse is None:
+        from BabyDTools.ChargeCancellationModel import FinePerCoarse as ModelFinePerCoarse
+        FinePerCoarse = ModelFinePerCoarse(IDACCancel1 = IDACCancel1, IDACCancel2 = IDACCancel2)
+
+    if isinstance(datastore, dict):
+        items = [(key, int(key.split('Row')[1].split('to')[0]), item) for key, item in datastore.items()]
+    else:
+        items = [(None, 0, datastore)]
+
+    corrected = {}
+    for key, row, item in items:
+        lazyrows = item if isinstance(item, list) else None # pair of lazy rows e.g. from an HDF5 capture
+        shape = (len(item),) + tuple(item[0].shape) if lazyrows is not None else item.shape
+        dtype = np.dtype(item[0].dtype if lazyrows is not None else item.dtype)
+        if np.issubdtype(dtype, np.integer):
+            dtype = np.promote_types(dtype, np.int16)
+        dark = (DarkMap[..., 0] * FinePerCoarse + DarkMap[..., 1])[row:row + shape[0], None] # combined dark value in fine counts, broadcast over frames
+
+        writerows = None # row arrays written to when correcting the rows of a lazy array in place
+        if inplace is True:
+            if isinstance(item, LazyFrameArray):
+                writerows = item.rows
+                assert all(isinstance(r, np.ndarray) for r in writerows), "Lazy row views (e.g. of an HDF5 capture) cannot be corrected in place."
+            else:
+                assert isinstance(item, np.ndarray), f"Cannot correct {type(item).__name__} in place, only numpy arrays, memory-maps and lazy arrays of them."
+            assert np.issubdtype(item.dtype, np.signedinteger) or np.issubdtype(item.dtype, np.floating), f"Cannot correct data of type {item.dtype} in place, the corrected values can be negative."
+            result = item
+        elif out is not None and key is None:
+            if isinstance(out, str):
+                result = np.lib.format.open_memmap(out, mode = 'w+', dtype = dtype, shape = shape)
+            else:
+                assert out.shape == shape, f"Output array has shape {out.shape}, expected {shape}."
+                result = out
         else:
+            result = np.empty(shape, dtype = dtype)
+
+        for start in range(0, shape[1], chunk_frames):
+            stop = min(start + chunk_frames, shape[1])
+            block = np.stack([r[start:stop] for r in lazyrows]) if lazyrows is not None else np.asarray(item[:, start:stop])
+            if writerows is not None: # indexing a lazy array returns a copy, the corrected block is written back to each row
+                _dark_correct_block(block, dark, FinePerCoarse, block)
+                for r, corrected_row in zip(writerows, block):
+                    r[start:stop] = corrected_row
+            else:
+                _dark_correct_block(block, dark, FinePerCoarse, result[:, start:stop])
+
+        for r in (writerows or [result]):
+            if isinstance(r, np.memmap):
+                r.flush()
+        if key is None:
+            return result
+        corrected[key] = result
+    return corrected
+
+
+def _sweep_selection(pixel_select, row_select, RowPairs):
+    """Validates the pixel and row selection of a sweep and returns the pixel index and the (absolute) rows to load."""
+    if isinstance(pixel_select, str):
+        if pixel_select.lower() != 'all':
             print("invalid pixel selection, did you mean 'all', or a an index from 0 to 15?")
+            return None, None
+        pixel_select = slice(None)
+
+    if isinstance(row_select, str):
+        if row_select.lower() != 'all':
+            print("invalid row selection, did you mean 'all', 0 or 1?")
+            return None, None
+        rows = [row for pair in RowPairs for row in (pair, pair + 1)]
+    else:
+        assert len(RowPairs) == 1, f"Sweep contains row pairs {list(RowPairs)}, use row_select = 'all' to load more than one row pair."
+        rows = RowPairs[0] + row_select # row_select can only take values 0 or 1 and correspond to the first or second row in the 2 row SPI readout file.
+
+    return pixel_select, rows
+
+
+def _sweep_files(folderpath, ParamSweepStep = 1, catalog = None):
+    """Lists the sweep files in a folder (or looks them up in a catalog) as (parsed file name, path) pairs."""
+    if catalog is not None:
+        files = [(fileinfo, fileinfo['path']) for fileinfo in catalog.sweep_files(folderpath = folderpath)]
     else:
-        OrderedData = np.zeros_like(ParentDatastore[:,:,pixel_select,:]) # can only do this because step is 1
+        with stage('os.listdir'):
+            names = sorted(os.listdir(folderpath))
+        files = [(parse_filename(file, ParamSweepStep = ParamSweepStep), os.path.join(folderpath, file)) for file in names if file.endswith('.npy')] # skips e.g. a catalog index file
+        files = [(fileinfo, path) for fileinfo, path in files if fileinfo is not None and fileinfo['SweepValue'] is not None]
+    assert len(files) > 0, f"No sweep files found in {folderpath}."
+    return files
+
+
+def _average_store(stats, out):
+    """Writes the mean [0] and standard deviation [1] across captures of a `StreamingStatistics.PixelStatistics` into "out" of shape [2,*P,3], the overflow flag [2] averaged as a 0 / 1 value."""
+    out[0, ..., :2] = stats.mean
+    out[1, ..., :2] = stats.std
+    out[0, ..., 2] = stats.overflow / stats.count
+    out[1, ..., 2] = np.sqrt(out[0, ..., 2] * (1 - out[0, ..., 2]))
+
+
+def _load_sweep_file(StepData, fileinfo, path, rows, pixel_select, StepAverage = None, chunk_frames = 65536):
+    """Copies the selected rows and pixels of one sweep file into "StepData", the [N_captures,(N_rows),(N_pixels),3] slot of its sweep step, one block of "chunk_frames" frames at a time.
+    With "StepAverage", the [2,(N_rows),(N_pixels),3] slot of the step in "AveStore", the mean and standard deviation across captures of the rows copied are accumulated from the same blocks."""
+    from BabyDTools.StreamingStatistics import PixelStatistics
+
+    with stage('np.load') as loading:
+        item = np.load(path, mmap_mode = 'r')
+        if isinstance(rows, list):
+            targets = [(item[i], rows.index(fileinfo['Row'] + i)) for i in range(2)]
+        else:
+            targets = [(item[rows - fileinfo['Row']], None)]
+
+        for data, slot in targets:
+            data = data[:, pixel_select, :]
+            stats = PixelStatistics(shape = data.shape[1:-1]) if StepAverage is not None else None
+            for start in range(0, len(data), chunk_frames):
+                block = np.asarray(data[start:start + chunk_frames])
+                if slot is None:
+                    StepData[start:start + len(block)] = block
+                else:
+                    StepData[start:start + len(block), slot] = block
+                loading.read(block.nbytes)
+                if stats is not None:
+                    stats.update(block)
+            if stats is not None:
+                _average_store(stats, StepAverage if slot is None else StepAverage[:, slot])
+
+
+def paramsweep_loaddata(folderpath, ParamSweepStep = 1, pixel_select = 8, row_select = 0, AverageData = False, max_workers = None, out = None, catalog = None):
+    """Loads in folder containing all of the data files for parameter sweep. By default returns an array containing the sweep output: [N_files,N_captures,N_pixels,3] 
+    and a 1-D array containg the values of the sweeped parameter. The final index of the sweeped values returns the coarse data [0], fine data [1], or overflow value [2].
+    With the "AverageData" argument set to "True" an additional variable will be returned which averages over the "N_captures" and calculates the standard deviation. 
+    This is stored as an array of shape [2,N_files,N_pixels,3], where for first index Average is [0] and std = [1]. It is accumulated with `StreamingStatistics.PixelStatistics`
+    from the blocks of frames as they are copied, so no floating point copy of the whole sweep is made.
     
-    offset = int(file.split('start')[1].split('stop')[0])
+    The sweep files are read concurrently on a thread pool, each straight into its slot of a preallocated output array (given by the sweep value parsed from the file name).
+    With a single pixel selected the N_pixels axis is dropped. With "row_select" = "all" every row found in the folder is loaded and an N_rows axis is added before N_pixels.
 
-    for i in range(len(ParamSweeped)):
-        
-        if isinstance(pixel_select, str):
-            if pixel_select.lower == 'all':
-                OrderedData[ParamSweeped[i] - offset,:,1] = ParentDatastore[i,:,:,1]# fine
-                OrderedData[ParamSweeped[i] - offset,:,0] = ParentDatastore[i,:,:,0]# coarse
+    Args:
+        folderpath (_type_): Folder containing the sweep .npy files, or an HDF5 sweep file written by `CaptureStore.convert_sweep`.
+        ParamSweepStep (int, optional): Step used during the parameter sweep, as used in the file names. Defaults to 1.
+        pixel_select (int, optional): Index of the pixel (column) to load from 0 to 15, or "all". Defaults to 8.
+        row_select (int, optional): Can only take values 0 or 1 and correspond to the first or second row in the 2 row SPI readout file. For even numbered row, input 0, for odd numbered row, input 1. 
+                                    "all" loads every row in the folder. Defaults to 0.
+        AverageData (bool, optional): Also return the average and standard deviation across captures. Defaults to False.
+        max_workers (int, optional): Number of threads used to read the files. Defaults to None (the `ThreadPoolExecutor` default).
+        out (str or NDArray, optional): Output to write the sweep into, either a preallocated array of the correct shape or the path of a .npy file which is created as a memory-map. Defaults to None.
+        catalog (CaptureCatalog, optional): If given the sweep files are looked up in the catalog rather than listing the folder. Defaults to None.
+
+    Returns:
+        OrderedParamSweeped (list): Sorted values of the swept parameter.
+        OrderedData (NDArray): Sweep data of shape [N_files,N_captures,(N_rows),(N_pixels),3].
+        AveStore (NDArray, optional): Average [0] and standard deviation [1] across captures, of shape [2,N_files,(N_rows),(N_pixels),3]. Only returned if "AverageData" is "True".
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from BabyDTools import CaptureStore
+    
+    if CaptureStore.is_hdf5(folderpath): # consolidated HDF5 sweep
+        with CaptureStore.load_sweep(folderpath) as (SweepValues, dataset):
+            pixel_select, rows = _sweep_selection(pixel_select, row_select, list(dataset.attrs['RowPairs']))
+            if rows is None:
+                return
+            if isinstance(rows, list):
+                OrderedData = np.stack([dataset[:, :, row, pixel_select, :] for row in rows], axis = 2)
             else:
-                print("invalid pixel selection, did you mean 'all', or a an index from 0 to 15?")
+                OrderedData = dataset[:, :, rows, pixel_select, :] # only the chunks of the selected row pair are read
+        OrderedParamSweeped = [int(value) for value in SweepValues]
+        if AverageData is True:
+            from BabyDTools.StreamingStatistics import PixelStatistics
+            AveStore = np.zeros((2,) + OrderedData.shape[:1] + OrderedData.shape[2:])
+            for step, StepData in enumerate(OrderedData):
+                stats = PixelStatistics(shape = StepData.shape[1:-1])
+                for start in range(0, len(StepData), 65536):
+                    stats.update(StepData[start:start + 65536])
+                _average_store(stats, AveStore[:, step])
+
+    else:
+        files = _sweep_files(folderpath, ParamSweepStep = ParamSweepStep, catalog = catalog)
+
+        OrderedParamSweeped = sorted({fileinfo['SweepValue'] for fileinfo, _ in files})
+        StepIndex = {value: i for i, value in enumerate(OrderedParamSweeped)}
+        RowPairs = sorted({fileinfo['Row'] for fileinfo, _ in files})
+        pixel_select, rows = _sweep_selection(pixel_select, row_select, RowPairs)
+        if rows is None:
+            return
+
+        first = np.load(files[0][1], mmap_mode = 'r')
+        shape = (len(OrderedParamSweeped), first.shape[1])
+        if isinstance(rows, list):
+            shape += (len(rows),)
+        shape += first[0][:, pixel_select, :].shape[1:]
+
+        if out is None:
+            OrderedData = np.zeros(shape, dtype = first.dtype)
+        elif isinstance(out, str):
+            OrderedData = np.lib.format.open_memmap(out, mode = 'w+', dtype = first.dtype, shape = shape)
         else:
-            OrderedData[ParamSweeped[i] - offset,:,1] = ParentDatastore[i,:,pixel_select,1]# fine
-            OrderedData[ParamSweeped[i] - offset,:,0] = ParentDatastore[i,:,pixel_select,0]# coarse
-        
-        
-    
-    OrderedParamSweeped = sorted(ParamSweeped)
+            assert out.shape == shape, f"Output array has shape {out.shape}, expected {shape}."
+            OrderedData = out
+
+        AveStore = np.zeros((2,) + shape[:1] + shape[2:]) if AverageData is True else None
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            futures = [executor.submit(_load_sweep_file, OrderedData[StepIndex[fileinfo['SweepValue']]], fileinfo, path, rows, pixel_select,
+                                       StepAverage = AveStore[:, StepIndex[fileinfo['SweepValue']]] if AverageData is True else None) for fileinfo, path in files]
+            for future in futures:
+                future.result() # re-raises any error from the worker
+
+        if isinstance(OrderedData, np.memmap):
+            OrderedData.flush()
     
     if AverageData is False:
         return  OrderedParamSweeped, OrderedData
     
     else:   
-        #* Average the readout over the number of captures and compute the standard deviation of the distribution
-        AveStore = [np.average(OrderedData, axis = 1), np.std(OrderedData, axis = 1)]
-        AveStore = np.array(AveStore) # has shape [2,N_files,N_pixels,3] where the first axis is: [0] = average across captures, [1] = standard deviation across captures
-
-        
+        #* AveStore has shape [2,N_files,N_pixels,3] where the first axis is: [0] = average across captures, [1] = standard deviation across captures
         return OrderedParamSweeped, OrderedData, AveStore
     
     
-def twoparamsweep_loaddata(folderpath, SecondaryParamDirectories, returnraw = True):
-    
-    DataStore = {}
-    
-    for SecDir in SecondaryParamDirectories:
-        subfolderpath = folderpath + '\\' + SecDir
-        
-        DataStore[SecDir + '_ys'], DataStore[SecDir + '_xs'] = paramsweep_loaddata(folderpath = subfolderpath, ParamSweepStep = 1, return_raw = returnraw)
+def twoparamsweep_loaddata(folderpath, SecondaryParamDirectories = None, ParamSweepStep = 1, max_workers = None, out = None, catalog = None, SecondaryPrefix = None):
+    """Loads a two parameter sweep, where each of the "SecondaryParamDirectories" inside "folderpath" holds a full sweep of the primary parameter (as loaded by `paramsweep_loaddata`), 
+    into one dense array of shape [N_secondary,N_primary,N_captures,N_rows,N_pixels,3] containing every row and pixel found, with the labels of each axis.
+    The files of all secondary directories are read concurrently on a thread pool, each straight into its slot of the preallocated output.
+    Steps (and row pairs) missing from a secondary directory are left as zeros (NaN for a floating point "out") and flagged in "Recorded".
+    With "out" given as a .npy path the output is a memory-map, which can later be reopened with `np.load(out, mmap_mode = 'r')` and sliced along either parameter without loading everything.
+
+    Args:
+        folderpath (str): Folder containing the secondary parameter directories.
+        SecondaryParamDirectories (list, optional): Names of the secondary parameter directories, in the order of the output. Defaults to None (every subdirectory, sorted by the number at the end of its name if present).
+        ParamSweepStep (int, optional): Step used during the primary parameter sweep, as used in the file names. Defaults to 1.
+        max_workers (int, optional): Number of threads used to read the files. Defaults to None (the `ThreadPoolExecutor` default).
+        out (str or NDArray, optional): Preallocated output array, or the path of a .npy file which is created as a memory-map. Defaults to None.
+        catalog (CaptureCatalog, optional): If given the sweep files are looked up in the catalog rather than listing the folders. Defaults to None.
+        SecondaryPrefix (str, optional): Text before the secondary value in the directory names, needed when it ends in a digit (e.g. "VoutTH1" for "VoutTH11740"). 
+                                        Defaults to None (the value is the number at the end of the name).
+
+    Returns:
+        SecondaryValues (list): Values of the secondary parameter parsed from the number at the end of each directory name (after "SecondaryPrefix", the name itself if there is none), labels of the first axis of "DataCube".
+        OrderedParamSweeped (list): Sorted values of the primary swept parameter, labels of the second axis of "DataCube".
+        rows (list): Detector row of each index of the N_rows axis of "DataCube".
+        DataCube (NDArray): Sweep data of shape [N_secondary,N_primary,N_captures,N_rows,N_pixels,3].
+        Recorded (NDArray): Boolean array of shape [N_secondary,N_primary,N_rows], False where no file was found for that secondary value, primary value and row.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def SecondaryValue(name):
+        if SecondaryPrefix is not None and name.startswith(SecondaryPrefix):
+            name = name[len(SecondaryPrefix):]
+        value = re.search(r'(-?\d+)$', name)
+        return int(value.group(1)) if value is not None else name
+
+    if SecondaryParamDirectories is None:
+        SecondaryParamDirectories = [name for name in os.listdir(folderpath) if os.path.isdir(os.path.join(folderpath, name))]
+        SecondaryParamDirectories = sorted(SecondaryParamDirectories, key = lambda name: (SecondaryValue(name) if isinstance(SecondaryValue(name), int) else 0, name))
+    SecondaryValues = [SecondaryValue(name) for name in SecondaryParamDirectories]
     
+    SweepFiles = [_sweep_files(os.path.join(folderpath, SecDir), ParamSweepStep = ParamSweepStep, catalog = catalog) for SecDir in SecondaryParamDirectories]
+    AllFiles = [(i, fileinfo, path) for i, files in enumerate(SweepFiles) for fileinfo, path in files]
+
+    OrderedParamSweeped = sorted({fileinfo['SweepValue'] for _, fileinfo, _ in AllFiles})
+    StepIndex = {value: i for i, value in enumerate(OrderedParamSweeped)}
+    RowPairs = sorted({fileinfo['Row'] for _, fileinfo, _ in AllFiles})
+    rows = [row for pair in RowPairs for row in (pair, pair + 1)]
+
+    first = np.load(AllFiles[0][2], mmap_mode = 'r')
+    shape = (len(SecondaryParamDirectories), len(OrderedParamSweeped), first.shape[1], len(rows)) + first.shape[2:]
+    if out is None:
+        DataCube = np.zeros(shape, dtype = first.dtype)
+    elif isinstance(out, str):
+        DataCube = np.lib.format.open_memmap(out, mode = 'w+', dtype = first.dtype, shape = shape)
+    else:
+        assert out.shape == shape, f"Output array has shape {out.shape}, expected {shape}."
+        DataCube = out
+
+    Recorded = np.zeros((len(SecondaryParamDirectories), len(OrderedParamSweeped), len(rows)), dtype = bool)
+    for i, fileinfo, path in AllFiles:
+        Recorded[i, StepIndex[fileinfo['SweepValue']], rows.index(fileinfo['Row']):rows.index(fileinfo['Row']) + 2] = True
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        futures = [executor.submit(_load_sweep_file, DataCube[i, StepIndex[fileinfo['SweepValue']]], fileinfo, path, rows, slice(None)) for i, fileinfo, path in AllFiles]
+        for future in futures:
+            future.result() # re-raises any error from the worker
 
-    return DataStore
+    if not np.all(Recorded):
+        Missing = sorted({(SecondaryValues[i], OrderedParamSweeped[step]) for i, step, _ in np.argwhere(~Recorded)}, key = str)
+        print(f"{len(Missing)} (secondary, primary) steps have missing rows, flagged in 'Recorded': {Missing[:10]}{' ...' if len(Missing) > 10 else ''}")
+        if np.issubdtype(DataCube.dtype, np.floating):
+            for i, step, row in np.argwhere(~Recorded):
+                DataCube[i, step, :, row] = np.nan
 
+    if isinstance(DataCube, np.memmap):
+        DataCube.flush()
 
+    return SecondaryValues, OrderedParamSweeped, rows, DataCube, Recorded
 
 
+# calls of the public functions are recorded while profiling is enabled, see `Instrumentation`
+instrument_module(globals())
@@ -0,0 +1,188 @@
+# SerialisedData.py
+# Decoding of the raw serialised byte stream of the BabyD SPI readout into [frames,16,16,3] arrays, incrementally one chunk of bytes at a time
+
+import time
+
+import numpy as np
+
+from BabyDTools.SPI_analysis import pack_data, unpack_data
+
+# Assumed stream format (to be confirmed against the readout firmware): each frame is 256 16-bit words, one per pixel in row-major order (row 0 pixels 0-15, row 1, ...),
+# most significant byte first. Each word uses the packed sample layout of `SPI_analysis.pack_data`: coarse in bits 15-8, fine in bits 7-1 and the overflow flag in bit 0.
+# Frames can optionally be preceded by a fixed synchronisation header, which is checked and used to resynchronise after corrupted or dropped bytes.
+FrameShape = (16, 16)
+WordDtype = np.dtype('>u2')
+
+
+class StreamDecoder:
+    """Incremental decoder of the serialised SPI stream. Byte chunks of any size are passed to `feed()`, which decodes every complete frame received so far
+    in one vectorised step (`np.frombuffer` and bit shifts on the whole block of words) and keeps any partial frame until the next chunk arrives.
+
+    Example:
+        decoder = StreamDecoder()
+        for chunk in FileByteSource(filepath):
+            frames = decoder.feed(chunk) # [n,16,16,3]
+        frames = decoder.flush()
+    """
+
+    def __init__(self, FrameHeader = b'', WordDtype = WordDtype, FrameShape = FrameShape):
+        """
+        Args:
+            FrameHeader (bytes, optional): Synchronisation header preceding every frame, empty if the stream has none. Defaults to b''.
+            WordDtype (np.dtype, optional): Data type of a word including its byte order. Defaults to big endian uint16.
+            FrameShape (tuple, optional): Number of rows and pixels per row of a frame. Defaults to (16, 16).
+        """
+        self.FrameHeader = bytes(FrameHeader)
+        self.WordDtype = np.dtype(WordDtype)
+        self.FrameShape = tuple(FrameShape)
+        self.FrameBytes = len(self.FrameHeader) + int(np.prod(self.FrameShape)) * self.WordDtype.itemsize
+
+        self.frames = 0 # number of frames decoded
+        self.skipped = 0 # number of bytes discarded while resynchronising to the frame header
+        self._buffer = bytearray()
+
+    def __repr__(self):
+        return f"StreamDecoder(frames={self.frames}, skipped={self.skipped}, pending={self.pending})"
+
+    @property
+    def pending(self):
+        """Number of bytes received which do not yet form a complete frame."""
+        return len(self._buffer)
+
+    def feed(self, data):
+        """Adds a chunk of bytes to the stream and decodes all of the frames it completes.
+
+        Args:
+            data (bytes): Next chunk of the stream, of any length.
+
+        Returns:
+            frames (NDArray): uint8 array of shape [n,16,16,3] (coarse [0], fine [1], overflow [2]) with the n frames completed by this chunk (n may be 0).
+        """
+        self._buffer += data
+        HeaderBytes = len(self.FrameHeader)
+        blocks = []
+        while True:
+            # with a header a frame is only accepted once the header of the next frame has arrived, so a frame which lost bytes is detected and dropped
+            numframes = (len(self._buffer) - HeaderBytes) // self.FrameBytes if HeaderBytes > 0 else len(self._buffer) // self.FrameBytes
+            if numframes <= 0:
+                break
+            raw = np.frombuffer(bytes(self._buffer[:numframes * self.FrameBytes + HeaderBytes]), dtype = np.uint8)
+
+            good = numframes
+            if HeaderBytes > 0:
+                headers = raw[(np.arange(numframes + 1) * self.FrameBytes)[:, None] + np.arange(HeaderBytes)]
+                synced = np.all(headers == np.frombuffer(self.FrameHeader, dtype = np.uint8), axis = 1)
+                valid = synced[:-1] & synced[1:]
+                good = numframes if np.all(valid) else int(np.argmin(valid))
+
+            if good > 0:
+                words = raw[:good * self.FrameBytes].reshape(good, self.FrameBytes)[:, HeaderBytes:]
+                blocks += [unpack_data(np.ascontiguousarray(words).view(self.WordDtype).reshape((good,) + self.FrameShape))]
+                del self._buffer[:good * self.FrameBytes]
+                self.frames += good
+            if good == numframes:
+                break
+
+            # corrupted frame, drop bytes up to the next header
+            position = self._buffer.find(self.FrameHeader, 1)
+            if position < 0:
+                position = len(self._buffer) - (HeaderBytes - 1) # keep a possible partial header at the end
+            del self._buffer[:position]
+            self.skipped += position
+
+        if len(blocks) == 0:
+            return np.empty((0,) + self.FrameShape + (3,), dtype = np.uint8)
+        return np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+
+    def flush(self):
+        """Ends the stream, decoding the last frame (which is held back waiting for the next header when the stream has one) and discarding any partial frame.
+
+        Returns:
+            frames (NDArray): The remaining frames, of shape [n,16,16,3].
+        """
+        frames = self.feed(self.FrameHeader) # the end of the stream stands in for the next header
+        self.skipped += max(len(self._buffer) - len(self.FrameHeader), 0)
+        self._buffer.clear()
+        return frames
+
+
+def decode(data, FrameHeader = b'', WordDtype = WordDtype, FrameShape = FrameShape):
+    """Decodes a complete serialised stream held in memory, see `StreamDecoder`.
+
+    Returns:
+        frames (NDArray): uint8 array of shape [N,16,16,3]. Any trailing partial frame is ignored.
+    """
+    decoder = StreamDecoder(FrameHeader = FrameHeader, WordDtype = WordDtype, FrameShape = FrameShape)
+    frames = decoder.feed(data)
+    return np.concatenate([frames, decoder.flush()])
+
+
+def decode_stream(source, decoder = None, **kwargs):
+    """Decodes an iterable of byte chunks (e.g. a `FileByteSource`) as a generator of frame blocks, the first stage of a streaming pipeline.
+
+    Args:
+        source (iterable): Chunks of the serialised stream.
+        decoder (StreamDecoder, optional): Decoder to use, e.g. to inspect its counters afterwards. Defaults to None (a new decoder created with **kwargs).
+
+    Yields:
+        frames (NDArray): Blocks of decoded frames of shape [n,16,16,3], empty blocks are skipped.
+    """
+    if decoder is None:
+        decoder = StreamDecoder(**kwargs)
+    for chunk in source:
+        frames = decoder.feed(chunk)
+        if len(frames) > 0:
+            yield frames
+    frames = decoder.flush()
+    if len(frames) > 0:
+        yield frames
+
+
+def encode(frames, FrameHeader = b'', WordDtype = WordDtype):
+    """Serialises frames into the stream format, the inverse of `decode()`. Used to generate test streams from recorded or simulated data.
+
+    Args:
+        frames (NDArray): Frames of shape [N,16,16,3], e.g. `SPI_analysis.build_array(...).transpose(1,0,2,3)`.
+
+    Returns:
+        data (bytes): Serialised stream.
+    """
+    words = pack_data(frames).astype(WordDtype).reshape(len(frames), -1)
+    if len(FrameHeader) == 0:
+        return words.tobytes()
+    records = np.empty((len(frames), len(FrameHeader) + words.shape[1] * words.itemsize), dtype = np.uint8)
+    records[:, :len(FrameHeader)] = np.frombuffer(bytes(FrameHeader), dtype = np.uint8)
+    records[:, len(FrameHeader):] = words.view(np.uint8)
+    return records.tobytes()
+
+
+class FileByteSource:
+    """Stand-in for the hardware byte stream, replaying a file (e.g. written from `encode()`) as an iterable of byte chunks.
+    Chunk sizes need not be a multiple of the frame size, so frames and words are split across chunks as they would be on the real link.
+    """
+
+    def __init__(self, filepath, chunk_size = 65536, repeat = 1, delay = 0):
+        """
+        Args:
+            filepath (str): File containing the serialised stream.
+            chunk_size (int, optional): Number of bytes per chunk. Defaults to 65536.
+            repeat (int, optional): Number of times the file is replayed, None to replay it forever. Defaults to 1.
+            delay (float, optional): Pause between chunks in seconds, to mimic the data rate of the readout. Defaults to 0.
+        """
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self.repeat = repeat
+        self.delay = delay
+
+    def __iter__(self):
+        replay = 0
+        while self.repeat is None or replay < self.repeat:
+            with open(self.filepath, 'rb') as f:
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                    if self.delay > 0:
+                        time.sleep(self.delay)
+            replay += 1
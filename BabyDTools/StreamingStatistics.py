@@ -0,0 +1,228 @@
+# StreamingStatistics.py
+# Single pass per-pixel statistics of SPI frame data, computed one chunk of frames at a time
+
+import numpy as np
+
+from BabyDTools.SPI_analysis import is_packed, unpack_data
+
+
+class PixelStatistics:
+    """Running per-pixel statistics of coarse [0] and fine [1] data, and the number of frames with the overflow flag [2] set.
+    Frames are consumed in chunks with `update()`, the mean and variance are accumulated with Welford's algorithm (in the batched form of Chan et al.)
+    so the result is numerically stable and independent of the chunk size. Statistics of separate parts of a capture (e.g. from parallel workers) are combined with `merge()`.
+
+    All statistics are arrays of shape [16,16,2] (row, column, coarse/fine), matching the layout of the output of `SPI_analysis.calc_ave`, except "overflow" which is [16,16].
+    """
+
+    def __init__(self, shape = (16, 16)):
+        self.shape = tuple(shape)
+        self.count = 0
+        self.mean = np.zeros(self.shape + (2,))
+        self.M2 = np.zeros(self.shape + (2,)) # sum of squared differences from the mean
+        self.min = np.full(self.shape + (2,), np.inf)
+        self.max = np.full(self.shape + (2,), -np.inf)
+        self.overflow = np.zeros(self.shape, dtype = np.int64)
+
+    def __repr__(self):
+        return f"PixelStatistics(count={self.count}, shape={self.shape})"
+
+    def update(self, chunk, frame_axis = 0):
+        """Adds a chunk of frames to the statistics.
+
+        Args:
+            chunk (NDArray): Frame data, e.g. of shape [N,16,16,3] or the [16,N,16,3] layout of `SPI_analysis.build_array` (with "frame_axis" = 1), or packed (see `SPI_analysis.pack_data`).
+            frame_axis (int, optional): Axis of "chunk" along which frames are stacked. Defaults to 0.
+
+        Returns:
+            self (PixelStatistics): Allows chaining of updates.
+        """
+        chunk = np.moveaxis(np.asarray(chunk), frame_axis, 0)
+        if is_packed(chunk):
+            chunk = unpack_data(chunk)
+        n = chunk.shape[0]
+        if n == 0:
+            return self
+        assert chunk.shape[1:-1] == self.shape, f"Chunk of shape {chunk.shape} does not match the pixel shape {self.shape}."
+
+        data = chunk[..., :2].astype(np.float64)
+        mean = data.mean(axis = 0)
+        M2 = ((data - mean) ** 2).sum(axis = 0)
+        self._combine(n, mean, M2, data.min(axis = 0), data.max(axis = 0), np.count_nonzero(chunk[..., 2], axis = 0))
+        return self
+
+    def merge(self, *others):
+        """Combines the statistics of other parts of the data into this one, as if all of the frames had been passed to `update()`.
+
+        Args:
+            *others (PixelStatistics): Statistics of the other parts of the data.
+
+        Returns:
+            self (PixelStatistics): The merged statistics.
+        """
+        for other in others:
+            assert other.shape == self.shape, "Cannot merge statistics of different pixel shapes."
+            if other.count > 0:
+                self._combine(other.count, other.mean, other.M2, other.min, other.max, other.overflow)
+        return self
+
+    def _combine(self, n, mean, M2, minimum, maximum, overflow):
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.M2 = self.M2 + M2 + delta ** 2 * (self.count * n / total)
+        self.count = total
+        self.min = np.minimum(self.min, minimum)
+        self.max = np.maximum(self.max, maximum)
+        self.overflow = self.overflow + overflow
+
+    @property
+    def variance(self):
+        """Population variance (as `np.var` / `np.std` with ddof = 0)."""
+        return self.M2 / self.count if self.count > 0 else np.full(self.M2.shape, np.nan)
+
+    @property
+    def std(self):
+        """Population standard deviation (as `np.std`)."""
+        return np.sqrt(self.variance)
+
+    @property
+    def coarse(self):
+        """Dictionary of the coarse statistics, each of shape [16,16]."""
+        return {'mean': self.mean[..., 0], 'std': self.std[..., 0], 'min': self.min[..., 0], 'max': self.max[..., 0]}
+
+    @property
+    def fine(self):
+        """Dictionary of the fine statistics, each of shape [16,16]."""
+        return {'mean': self.mean[..., 1], 'std': self.std[..., 1], 'min': self.min[..., 1], 'max': self.max[..., 1]}
+
+
+def stream_statistics(chunks, frame_axis = 0, shape = (16, 16)):
+    """Reduces an iterable of frame chunks to a single `PixelStatistics` in one sequential pass.
+
+    Args:
+        chunks (iterable): Chunks of frame data, see `PixelStatistics.update()`.
+        frame_axis (int, optional): Axis of each chunk along which frames are stacked. Defaults to 0.
+        shape (tuple, optional): Pixel shape of the data. Defaults to (16, 16).
+
+    Returns:
+        stats (PixelStatistics): Statistics of all of the frames.
+    """
+    stats = PixelStatistics(shape = shape)
+    for chunk in chunks:
+        stats.update(chunk, frame_axis = frame_axis)
+    return stats
+
+
+class RollingStatistics:
+    """Per-pixel moving mean and standard deviation of coarse [0] and fine [1] data over the last "window" frames, for monitoring drift during long captures.
+    Frames are streamed in with `update()`. Running sums over the window are kept (new frames added, frames leaving the window subtracted) so the cost is O(1) per frame
+    whatever the window length. Every "step" frames the window statistics are recorded, giving a drift time series without reprocessing the capture for each window.
+
+    The baseline is the first full window (unless one is given), pixels whose recorded mean moves further than "threshold" counts from it are flagged.
+    """
+
+    def __init__(self, window = 1000, step = None, threshold = 1.0, baseline = None, shape = (16, 16), chunk_frames = 1024):
+        """
+        Args:
+            window (int, optional): Number of frames in the moving window. Defaults to 1000.
+            step (int, optional): Number of frames between recorded points of the time series. Defaults to None (equal to "window").
+            threshold (float, optional): Largest allowed change of a pixel's moving mean from its baseline, in counts. Defaults to 1.0.
+            baseline (NDArray, optional): Baseline mean of shape [*shape,2] e.g. a dark map, by default the first full window is used. Defaults to None.
+            shape (tuple, optional): Pixel shape of the data. Defaults to (16, 16).
+            chunk_frames (int, optional): Largest number of frames processed at once within `update()` (never more than "window"), bounds its temporary memory whatever the size of the chunks passed in. Defaults to 1024.
+        """
+        self.window = window
+        self.step = window if step is None else step
+        self.threshold = threshold
+        self.shape = tuple(shape)
+        self.baseline = None if baseline is None else np.asarray(baseline, dtype = np.float64)
+        self.chunk_frames = max(min(chunk_frames, window), 1)
+
+        self.count = 0 # number of frames seen
+        self._ring = np.zeros((window,) + self.shape + (2,)) # last "window" frames, oldest at self._head
+        self._head = 0
+        self._sum = np.zeros(self.shape + (2,))
+        self._sumsq = np.zeros(self.shape + (2,))
+
+        self.frames = [] # frame number (1 based) at which each point of the time series was recorded
+        self.means = []
+        self.stds = []
+
+    def __repr__(self):
+        return f"RollingStatistics(window={self.window}, step={self.step}, count={self.count}, points={len(self.frames)})"
+
+    def update(self, chunk, frame_axis = 0):
+        """Adds a chunk of frames, recording a point of the time series for every "step" frames once the window is full.
+
+        Args:
+            chunk (NDArray): Frame data, e.g. of shape [N,16,16,3] or the [16,N,16,3] layout of `SPI_analysis.build_array` (with "frame_axis" = 1), or packed (see `SPI_analysis.pack_data`).
+            frame_axis (int, optional): Axis of "chunk" along which frames are stacked. Defaults to 0.
+
+        Returns:
+            self (RollingStatistics): Allows chaining of updates.
+        """
+        chunk = np.moveaxis(np.asarray(chunk), frame_axis, 0)
+        for start in range(0, len(chunk), self.chunk_frames): # bounded blocks, so the temporary arrays below never exceed "chunk_frames" frames
+            block = chunk[start:start + self.chunk_frames]
+            self._update_block((unpack_data(block) if is_packed(block) else block)[..., :2].astype(np.float64))
+        return self
+
+    def _update_block(self, new):
+        """Adds a block of at most "window" frames [n,*shape,2], so every frame leaving the window as they arrive is in the ring buffer."""
+        n = len(new)
+        W = self.window
+
+        # frames leaving the window as each new frame arrives, oldest first
+        positions = (self._head + np.arange(n)) % W
+        old = self._ring[positions]
+
+        sums = new - old
+        np.cumsum(sums, axis = 0, out = sums)
+        sums += self._sum
+        sumsqs = np.square(new) - np.square(old)
+        np.cumsum(sumsqs, axis = 0, out = sumsqs)
+        sumsqs += self._sumsq
+        framenumbers = self.count + np.arange(1, n + 1)
+
+        record = np.nonzero((framenumbers >= W) & ((framenumbers - W) % self.step == 0))[0]
+        if len(record) > 0:
+            mean = sums[record] / W
+            std = np.sqrt(np.maximum(sumsqs[record] / W - mean ** 2, 0))
+            self.frames += framenumbers[record].tolist()
+            self.means += list(mean)
+            self.stds += list(std)
+            if self.baseline is None:
+                self.baseline = mean[0].copy()
+
+        # the new frames replace the ones that left the window in the ring buffer
+        self._ring[positions] = new
+        self._head = (self._head + n) % W
+        self._sum, self._sumsq = sums[-1].copy(), sumsqs[-1].copy()
+        self.count += n
+
+    @property
+    def current_mean(self):
+        """Moving mean of the current window (of the frames seen so far if the window is not yet full)."""
+        return self._sum / max(min(self.count, self.window), 1)
+
+    @property
+    def current_std(self):
+        """Moving standard deviation of the current window (of the frames seen so far if the window is not yet full)."""
+        n = max(min(self.count, self.window), 1)
+        return np.sqrt(np.maximum(self._sumsq / n - (self._sum / n) ** 2, 0))
+
+    @property
+    def drift(self):
+        """Time series of the change of each pixel's moving mean from its baseline, of shape [N_points,*shape,2]."""
+        if len(self.means) == 0:
+            return np.zeros((0,) + self.shape + (2,))
+        return np.array(self.means) - self.baseline
+
+    @property
+    def flagged(self):
+        """Boolean array of shape [*shape,2], True for pixels (and stage) whose moving mean has drifted more than "threshold" from the baseline."""
+        return np.any(np.abs(self.drift) > self.threshold, axis = 0)
+
+    def flagged_pixels(self):
+        """List of (row, column, stage) of the flagged pixels, where stage is "coarse" or "fine"."""
+        return [(int(row), int(col), ('coarse', 'fine')[stage]) for row, col, stage in zip(*np.nonzero(self.flagged))]
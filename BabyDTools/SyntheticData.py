@@ -0,0 +1,140 @@
+# SyntheticData.py
+# Writes simulated capture folders and parameter sweeps in the file layout and naming scheme of the SPI acquisition, as a stand-in for the rig
+
+import os
+import time
+
+import numpy as np
+
+from BabyDTools import DetectorSimulation as DS
+
+# arguments of `DetectorSimulation.SimulateFrames` which can be swept
+SweepableParameters = ('Photons', 'PhotonEnergy', 'CurrentMagnitude', 'InjectionClocks', 'IDACCancel1', 'VoutTH1', 'IDACCancel2', 'VoutTH2')
+RowPairs = tuple(range(0, 16, 2))
+
+
+def _timestamp(offset = 0):
+    """Time of day as used at the end of the file names ("HHMMSS"), "offset" seconds from now."""
+    return time.strftime('%H%M%S', time.localtime(time.time() + offset))
+
+
+def _seeds(seed):
+    """Root seed sequence and the seed sequences of the pixel variation and of the frame data."""
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.SeedSequence(seed.entropy, spawn_key = seed.spawn_key).spawn(2) # a fresh copy, so the same seed gives the same children on every call
+    return np.random.SeedSequence(seed).spawn(2)
+
+
+def _write_rowfiles(paths, rows, NumCaptures, seed, dtype = np.uint8, block_frames = 65536, **SimulationOptions):
+    """Simulates "NumCaptures" frames one block at a time and writes them to the row-pair files "paths" (first rows "rows") of shape [2,NumCaptures,16,3].
+    Each file is written under a temporary name and renamed once complete, so a loader (or `LiveMonitor`) never sees a partly written file."""
+    tmppaths = [f'{path}.{os.getpid()}.tmp' for path in paths]
+    files = [np.lib.format.open_memmap(tmppath, mode = 'w+', dtype = dtype, shape = (2, NumCaptures, 16, 3)) for tmppath in tmppaths]
+    Blocks = [(start, min(start + block_frames, NumCaptures)) for start in range(0, NumCaptures, block_frames)]
+    for (start, stop), blockseed in zip(Blocks, seed.spawn(len(Blocks))):
+        frames = DS.SimulateFrames(stop - start, seed = blockseed, **SimulationOptions)
+        for i, row in enumerate(rows):
+            files[i][:, start:stop] = frames[:, row:row + 2].transpose(1, 0, 2, 3)
+    while files:
+        files.pop().flush() # the memory-maps are released before renaming, which Windows requires
+    for tmppath, path in zip(tmppaths, paths):
+        os.replace(tmppath, path)
+    return list(paths)
+
+
+def write_capture(folderpath, test_name = 'Synthetic', NumCaptures = 1000, rows = RowPairs, timestamp = None, seed = None, dtype = np.uint8, block_frames = 65536, **SimulationOptions):
+    """Writes a simulated capture as the row-pair files of the rig, "Row<r>to<r+1>Data_<test_name>NumCaptures_<NumCaptures>_<timestamp>.npy", each of shape [2,NumCaptures,16,3],
+    which can be read by `SPI_analysis.load_data` and everything built on it. Frames are simulated with `DetectorSimulation.SimulateFrames` and written one block at a time,
+    so captures far larger than memory (uint8 captures take 768 bytes per frame) can be written.
+
+    Args:
+        folderpath (str): Directory to write the files to, created if it does not exist.
+        test_name (str, optional): Test name used in the file names, must not contain "_". Defaults to "Synthetic".
+        NumCaptures (int, optional): Number of frames. Defaults to 1000.
+        rows (iterable, optional): First row of each row pair written. Defaults to all 8 row pairs.
+        timestamp (str, optional): Time stamp at the end of the file names. Defaults to None (the current time, "HHMMSS").
+        seed (int or np.random.SeedSequence, optional): Seed of the simulation, the same seed gives the same files. Defaults to None (random).
+        dtype (optional): Data type of the files. Defaults to np.uint8.
+        block_frames (int, optional): Number of frames simulated and written at a time, limits the memory used. Defaults to 65536.
+        **SimulationOptions: Passed to `DetectorSimulation.SimulateFrames`, e.g. "Photons", the bias settings, the noise, "PixelMaps" and "processes".
+
+    Returns:
+        filepaths (list): Paths of the files written.
+    """
+    assert '_' not in test_name, "The test name cannot contain '_', it separates the fields of the file name."
+    os.makedirs(folderpath, exist_ok = True)
+    timestamp = _timestamp() if timestamp is None else timestamp
+    PixelSeed, FrameSeed = _seeds(seed)
+    if SimulationOptions.get('PixelMaps') is None:
+        SimulationOptions['PixelMaps'] = DS.PixelVariation(GainSpread = SimulationOptions.pop('GainSpread', 0.02), OffsetSpread = SimulationOptions.pop('OffsetSpread', 1e-3), seed = PixelSeed)
+
+    paths = [os.path.join(folderpath, f'Row{row}to{row + 1}Data_{test_name}NumCaptures_{NumCaptures}_{timestamp}.npy') for row in rows]
+    return _write_rowfiles(paths, list(rows), NumCaptures, FrameSeed, dtype = dtype, block_frames = block_frames, **SimulationOptions)
+
+
+def write_sweep(folderpath, SweptParameter = 'VoutTH2', SweepValues = range(1100, 1201, 10), ParamSweepStep = 1, NumCaptures = 1000, SweepName = None, rows = RowPairs,
+                seed = None, dtype = np.uint8, block_frames = 65536, **SimulationOptions):
+    """Writes a simulated parameter sweep as the files of the rig, one set of row-pair files per sweep value, named
+    "Row<r>to<r+1>Data_<SweepName>step<ParamSweepStep><value>_start<first>stop<last>NumCaptures_<NumCaptures>_<timestamp>.npy",
+    which can be read by `SPI_analysis.paramsweep_loaddata`. Every step is simulated with the same detector (per-pixel variation) and its own seed.
+
+    Args:
+        folderpath (str): Directory to write the files to, created if it does not exist.
+        SweptParameter (str, optional): Argument of `DetectorSimulation.SimulateFrames` which is swept, one of "SweepableParameters". Defaults to "VoutTH2".
+        SweepValues (iterable, optional): Integer values of the swept parameter. Defaults to 1100 to 1200 in steps of 10.
+        ParamSweepStep (int, optional): Step written into the file names, see `SPI_analysis.parse_filename`. Defaults to 1.
+        NumCaptures (int, optional): Number of frames per step. Defaults to 1000.
+        SweepName (str, optional): Name of the sweep in the file names, must not contain "_". Defaults to None (the swept parameter).
+        Other arguments as `write_capture()`.
+
+    Returns:
+        SweepValues (list): Values of the swept parameter.
+        filepaths (list): Paths of the files written, one list per step.
+    """
+    assert SweptParameter in SweepableParameters, f"Unknown swept parameter {SweptParameter}, expected one of {SweepableParameters}."
+    SweepValues = [int(value) for value in SweepValues]
+    SweepName = SweptParameter if SweepName is None else SweepName
+    assert '_' not in SweepName, "The sweep name cannot contain '_', it separates the fields of the file name."
+    os.makedirs(folderpath, exist_ok = True)
+    PixelSeed, FrameSeed = _seeds(seed)
+    if SimulationOptions.get('PixelMaps') is None:
+        SimulationOptions['PixelMaps'] = DS.PixelVariation(GainSpread = SimulationOptions.pop('GainSpread', 0.02), OffsetSpread = SimulationOptions.pop('OffsetSpread', 1e-3), seed = PixelSeed)
+
+    filepaths = []
+    for step, (value, stepseed) in enumerate(zip(SweepValues, FrameSeed.spawn(len(SweepValues)))):
+        name = f'{SweepName}step{ParamSweepStep}{value}_start{SweepValues[0]}stop{SweepValues[-1]}NumCaptures_{NumCaptures}_{_timestamp(step)}'
+        paths = [os.path.join(folderpath, f'Row{row}to{row + 1}Data_{name}.npy') for row in rows]
+        filepaths += [_write_rowfiles(paths, list(rows), NumCaptures, stepseed, dtype = dtype, block_frames = block_frames, **{SweptParameter: value}, **SimulationOptions)]
+    return SweepValues, filepaths
+
+
+def write_twoparamsweep(folderpath, SecondaryParameter = 'VoutTH1', SecondaryValues = range(1740, 1781, 20), SweptParameter = 'VoutTH2', SweepValues = range(1100, 1201, 10),
+                        SecondaryDirectory = '{SecondaryParameter}_{value}', seed = None, **SweepOptions):
+    """Writes a simulated two parameter sweep, one directory per value of the secondary parameter each holding a full sweep of the primary parameter (see `write_sweep()`),
+    which can be read by `SPI_analysis.twoparamsweep_loaddata`. Every sweep is simulated with the same detector.
+
+    Args:
+        folderpath (str): Directory to create the secondary parameter directories in.
+        SecondaryParameter (str, optional): Argument of `DetectorSimulation.SimulateFrames` held fixed within each directory, one of "SweepableParameters". Defaults to "VoutTH1".
+        SecondaryValues (iterable, optional): Values of the secondary parameter. Defaults to 1740 to 1780 in steps of 20.
+        SweptParameter, SweepValues: Primary swept parameter and its values, as `write_sweep()`.
+        SecondaryDirectory (str, optional): Format of the directory names, ending in the value so `twoparamsweep_loaddata` can parse it (separated from parameter names ending in a digit).
+                                            Defaults to "{SecondaryParameter}_{value}".
+        seed (int or np.random.SeedSequence, optional): Seed of the simulation. Defaults to None (random).
+        **SweepOptions: Passed to `write_sweep()`.
+
+    Returns:
+        SecondaryDirectories (list): Names of the directories written, in the order of "SecondaryValues".
+    """
+    assert SecondaryParameter in SweepableParameters and SecondaryParameter != SweptParameter, f"Secondary parameter must be one of {SweepableParameters} and differ from the swept parameter."
+    PixelSeed, FrameSeed = _seeds(seed)
+    if SweepOptions.get('PixelMaps') is None:
+        SweepOptions['PixelMaps'] = DS.PixelVariation(GainSpread = SweepOptions.pop('GainSpread', 0.02), OffsetSpread = SweepOptions.pop('OffsetSpread', 1e-3), seed = PixelSeed)
+
+    SecondaryValues = list(SecondaryValues)
+    SecondaryDirectories = []
+    for value, sweepseed in zip(SecondaryValues, FrameSeed.spawn(len(SecondaryValues))):
+        directory = SecondaryDirectory.format(SecondaryParameter = SecondaryParameter, value = value)
+        write_sweep(os.path.join(folderpath, directory), SweptParameter = SweptParameter, SweepValues = SweepValues, seed = sweepseed, **{SecondaryParameter: value}, **SweepOptions)
+        SecondaryDirectories += [directory]
+    return SecondaryDirectories
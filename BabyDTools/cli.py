@@ -0,0 +1,286 @@
+# cli.py
+# "babyd" command line entry point for headless batch processing of capture directories
+#
+#   babyd stats <root> -o results               per-pixel statistics of every capture below <root>
+#   babyd histogram <root> -o results --plot    per-pixel histograms (and histogram plots) of every capture
+#   babyd sweep <root> -o results --fit --plot  averaged sweep cubes, calibration fits and sweep maps of every sweep folder
+#   babyd convert <root> -o converted --to hdf5 HDF5 (or packed .npy) copies of every capture and sweep
+#   babyd simulate <outdir> --frames 100000     synthetic captures and sweeps, see `SyntheticData`
+#
+# Only the standard library is imported at start up, NumPy, h5py and matplotlib are imported by the commands that use them so the non-plotting commands start quickly.
+
+import os
+import sys
+import argparse
+
+_catalog = None # catalog of the directory being processed, set in each worker process by `_init_worker`
+
+
+def _init_worker(catalog, plotting):
+    global _catalog
+    _catalog = catalog
+    if plotting is True:
+        import matplotlib
+        matplotlib.use('Agg') # headless
+
+
+def _run_parallel(function, tasks, processes, catalog = None, plotting = False):
+    """Yields `function(task)` for every task in order, on a process pool of "processes" workers (all cores if None) or in this process if it is 1."""
+    processes = os.cpu_count() or 1 if processes is None else processes
+    if processes == 1 or len(tasks) <= 1:
+        _init_worker(catalog, plotting)
+        for task in tasks:
+            yield function(task)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers = min(processes, len(tasks)), initializer = _init_worker, initargs = (catalog, plotting)) as executor:
+        yield from executor.map(function, tasks)
+
+
+def _open_catalog(root, outdir, ParamSweepStep):
+    """Catalog of "root", with its index kept in the output directory so the data directory is not written to and later runs only rescan changed directories."""
+    from BabyDTools.CaptureCatalog import CaptureCatalog
+    os.makedirs(outdir, exist_ok = True)
+    return CaptureCatalog(root, indexpath = os.path.join(outdir, '.babyd_catalog.json'), ParamSweepStep = ParamSweepStep)
+
+
+def _find_captures(root, catalog):
+    """(name, filepath) of every capture below "root", name being its directory relative to "root" and "<test_name>NumCaptures_<N>_<timestamp>", filepath any one of its files.
+    A single .npy or HDF5 capture file can also be given as "root"."""
+    if os.path.isfile(root):
+        name = os.path.splitext(os.path.basename(root))[0]
+        return [(name, root)]
+    captures = {}
+    for fileinfo in catalog.entries():
+        if fileinfo['SweepValue'] is None:
+            reldir = os.path.relpath(os.path.dirname(fileinfo['path']), catalog.rootdir)
+            name = os.path.normpath(os.path.join(reldir, f"{fileinfo['test_name']}NumCaptures_{fileinfo['NumCaptures']}_{fileinfo['timestamp']}"))
+            captures.setdefault(name, fileinfo['path'])
+    return sorted(captures.items())
+
+
+def _find_sweeps(root, catalog):
+    """(name, folderpath) of every folder below "root" containing sweep files, name being the folder relative to "root". An HDF5 sweep file can also be given as "root"."""
+    if os.path.isfile(root):
+        return [(os.path.splitext(os.path.basename(root))[0], root)]
+    folders = {os.path.dirname(fileinfo['path']) for fileinfo in catalog.entries() if fileinfo['SweepValue'] is not None}
+    names = {folder: os.path.relpath(folder, catalog.rootdir) for folder in folders}
+    return sorted((name if name != os.curdir else os.path.basename(folder), folder) for folder, name in names.items())
+
+
+def _load_capture(filepath):
+    from BabyDTools import SPI_analysis as SPI
+    catalog = _catalog if filepath.endswith('.npy') else None
+    return SPI.build_array(SPI.load_data(filepath, mmap_mode = 'r', catalog = catalog), lazy = True)
+
+
+def _output_path(outdir, name, suffix):
+    path = os.path.join(outdir, f'{name}{suffix}')
+    os.makedirs(os.path.dirname(path) or os.curdir, exist_ok = True)
+    return path
+
+
+#* stats
+
+def _stats_task(task):
+    import numpy as np
+    from BabyDTools import SPI_analysis as SPI
+    name, filepath, outdir, chunk_frames = task
+    stats = SPI.calc_stats(_load_capture(filepath), chunk_frames = chunk_frames)
+    path = _output_path(outdir, name, '_stats.npz')
+    np.savez(path, count = stats.count, mean = stats.mean, std = stats.std, min = stats.min, max = stats.max, overflow = stats.overflow)
+    return f"{name}: {stats.count} frames, mean coarse {np.nanmean(stats.mean[..., 0]):.3f}, mean fine {np.nanmean(stats.mean[..., 1]):.3f}, " \
+           f"{int(stats.overflow.sum())} overflows -> {path}"
+
+
+def stats(args):
+    """Per-pixel mean, standard deviation, min / max and overflow count of every capture (`SPI_analysis.calc_stats`), saved as "<capture>_stats.npz"."""
+    catalog = None if os.path.isfile(args.root) else _open_catalog(args.root, args.output, args.ParamSweepStep)
+    tasks = [(name, filepath, args.output, args.chunk_frames) for name, filepath in _find_captures(args.root, catalog)]
+    for line in _run_parallel(_stats_task, tasks, args.processes, catalog = catalog):
+        print(line, flush = True)
+    return len(tasks)
+
+
+#* histogram
+
+def _histogram_task(task):
+    import numpy as np
+    from BabyDTools.PixelHistograms import pixel_histograms
+    name, filepath, outdir, windows, chunk_frames, plot = task
+    array = _load_capture(filepath)
+    histograms = pixel_histograms(array, windows = windows, chunk_frames = chunk_frames)
+    path = _output_path(outdir, name, '_histograms.npz')
+    np.savez(path, coarse = histograms['coarse'], fine = histograms['fine'], windows = np.array(histograms['windows']))
+    if plot is True:
+        import matplotlib.pyplot as plt
+        from BabyDTools.ExamplePlots import histogram_array
+        histogram_array(array, numslices = windows or 1, save_plot = True, savedir = os.path.dirname(path), plotname = os.path.basename(name))
+        plt.close('all')
+    return f"{name}: {len(histograms['windows'])} window(s) -> {path}"
+
+
+def histogram(args):
+    """Coarse / fine histograms of every pixel of every capture (`PixelHistograms.pixel_histograms`), saved as "<capture>_histograms.npz" and optionally plotted."""
+    catalog = None if os.path.isfile(args.root) else _open_catalog(args.root, args.output, args.ParamSweepStep)
+    tasks = [(name, filepath, args.output, args.windows, args.chunk_frames, args.plot) for name, filepath in _find_captures(args.root, catalog)]
+    for line in _run_parallel(_histogram_task, tasks, args.processes, catalog = catalog, plotting = args.plot):
+        print(line, flush = True)
+    return len(tasks)
+
+
+#* sweep
+
+def _sweep_task(task):
+    import numpy as np
+    from BabyDTools import SPI_analysis as SPI
+    name, folderpath, outdir, ParamSweepStep, fit, plot = task
+    SweepValues, SweepData, AveStore = SPI.paramsweep_loaddata(folderpath, ParamSweepStep = ParamSweepStep, pixel_select = 'all', row_select = 'all', AverageData = True,
+                                                               catalog = _catalog if os.path.isdir(folderpath) else None)
+    results = {'values': np.asarray(SweepValues), 'mean': AveStore[0], 'std': AveStore[1]}
+    if fit is True:
+        from BabyDTools.Calibration import FitSweep
+        results.update({f'fit_{key}': value for key, value in FitSweep(SweepValues, SweepData).items()})
+    path = _output_path(outdir, name, '_sweep.npz')
+    np.savez(path, **results)
+    if plot is True:
+        from BabyDTools.ExamplePlots import render_sweep_maps
+        SweepName = 'Sweep'
+        if _catalog is not None and os.path.isdir(folderpath):
+            SweepName = _catalog.sweep_files(folderpath = folderpath)[0]['SweepName'].split(f'step{ParamSweepStep}')[0] # name of the swept parameter
+        render_sweep_maps(SweepValues, AveStore, savedir = path[:-len('.npz')], SweepName = SweepName, processes = 1) # sweeps are already spread over the workers
+    return f"{name}: {len(SweepValues)} steps of {SweepData.shape[1]} frames -> {path}"
+
+
+def sweep(args):
+    """Average and standard deviation cube of every parameter sweep folder (`SPI_analysis.paramsweep_loaddata`), saved as "<folder>_sweep.npz",
+    optionally with the calibration fits of every pixel (`Calibration.FitSweep`) and a map of every step."""
+    catalog = None if os.path.isfile(args.root) else _open_catalog(args.root, args.output, args.ParamSweepStep)
+    tasks = [(name, folderpath, args.output, args.ParamSweepStep, args.fit, args.plot) for name, folderpath in _find_sweeps(args.root, catalog)]
+    for line in _run_parallel(_sweep_task, tasks, args.processes, catalog = catalog, plotting = args.plot):
+        print(line, flush = True)
+    return len(tasks)
+
+
+#* convert
+
+def _convert_task(task):
+    kind, name, path, outdir, to, options = task
+    if to == 'packed':
+        from BabyDTools import SPI_analysis as SPI
+        if kind == 'sweep':
+            return f"{name}: sweeps can only be converted to hdf5, skipped"
+        outpaths = SPI.pack_capture(path, os.path.join(outdir, os.path.dirname(name)), catalog = _catalog)
+        return f"{name}: {len(outpaths)} packed files -> {os.path.dirname(outpaths[0])}"
+
+    from BabyDTools import CaptureStore
+    h5path = _output_path(outdir, name, '.h5')
+    if kind == 'sweep':
+        CaptureStore.convert_sweep(path, h5path = h5path, ParamSweepStep = options['ParamSweepStep'], compression = options['compression'], shuffle = options['shuffle'])
+    else:
+        CaptureStore.convert_capture(path, h5path = h5path, compression = options['compression'], shuffle = options['shuffle'], catalog = _catalog)
+    return f"{name} -> {h5path}"
+
+
+def convert(args):
+    """Converts every capture (and for HDF5 every sweep folder) to a single HDF5 file (`CaptureStore`) or to packed .npy files (`SPI_analysis.pack_capture`)."""
+    catalog = _open_catalog(args.root, args.output, args.ParamSweepStep)
+    options = {'ParamSweepStep': args.ParamSweepStep, 'compression': args.compression, 'shuffle': args.compression is not None}
+    tasks = [('capture', name, path, args.output, args.to, options) for name, path in _find_captures(args.root, catalog)]
+    tasks += [('sweep', name, path, args.output, args.to, options) for name, path in _find_sweeps(args.root, catalog)]
+    for line in _run_parallel(_convert_task, tasks, args.processes, catalog = catalog):
+        print(line, flush = True)
+    return len(tasks)
+
+
+#* simulate
+
+def simulate(args):
+    """Writes a synthetic capture, sweep or two parameter sweep with `SyntheticData`, simulated on all cores."""
+    from BabyDTools import SyntheticData as SD
+    options = {'NumCaptures': args.frames, 'seed': args.seed, 'Photons': args.photons, 'PhotonEnergy': args.energy, 'processes': args.processes}
+    if args.sweep is None:
+        paths = SD.write_capture(args.output, test_name = args.name, **options)
+        print(f"{len(paths)} files of {args.frames} frames -> {args.output}")
+    elif args.secondary is None:
+        parameter, start, stop, step = args.sweep
+        values, paths = SD.write_sweep(args.output, SweptParameter = parameter, SweepValues = range(int(start), int(stop) + 1, int(step)), **options)
+        print(f"{len(values)} steps of {args.frames} frames -> {args.output}")
+    else:
+        parameter, start, stop, step = args.sweep
+        secondary, secstart, secstop, secstep = args.secondary
+        directories = SD.write_twoparamsweep(args.output, SecondaryParameter = secondary, SecondaryValues = range(int(secstart), int(secstop) + 1, int(secstep)),
+                                             SweptParameter = parameter, SweepValues = range(int(start), int(stop) + 1, int(step)), **options)
+        print(f"{len(directories)} sweeps of {parameter} -> {args.output}")
+    return 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog = 'babyd', description = 'Headless batch processing of BabyD SPI data.')
+    parser.add_argument('--profile', action = 'store_true', help = 'print a profile of the run (see BabyDTools.Instrumentation), work done in worker processes is not included')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    def add_common(command, output):
+        command.add_argument('-o', '--output', default = output, help = f'output directory (default {output})')
+        command.add_argument('-j', '--processes', type = int, default = None, help = 'worker processes (default all cores)')
+        command.add_argument('--ParamSweepStep', type = int, default = 1, help = 'step used in the sweep file names')
+
+    command = commands.add_parser('stats', help = stats.__doc__.split(',')[0])
+    command.add_argument('root', help = 'directory searched recursively for captures, or a single capture file (.npy or .h5)')
+    command.add_argument('--chunk-frames', dest = 'chunk_frames', type = int, default = 4096, help = 'frames read at a time (default 4096)')
+    add_common(command, 'babyd_stats')
+    command.set_defaults(run = stats)
+
+    command = commands.add_parser('histogram', help = 'coarse / fine histograms of every pixel of every capture')
+    command.add_argument('root', help = 'directory searched recursively for captures, or a single capture file (.npy or .h5)')
+    command.add_argument('--windows', type = int, default = None, help = 'number of equal time slices histogrammed separately')
+    command.add_argument('--plot', action = 'store_true', help = 'also save a histogram plot of each capture')
+    command.add_argument('--chunk-frames', dest = 'chunk_frames', type = int, default = 4096, help = 'frames read at a time (default 4096)')
+    add_common(command, 'babyd_histograms')
+    command.set_defaults(run = histogram)
+
+    command = commands.add_parser('sweep', help = 'average sweep cube of every parameter sweep folder')
+    command.add_argument('root', help = 'directory searched recursively for sweep folders, or an HDF5 sweep file')
+    command.add_argument('--fit', action = 'store_true', help = 'fit the threshold, gain and offset of every pixel')
+    command.add_argument('--plot', action = 'store_true', help = 'save a map of every sweep step')
+    add_common(command, 'babyd_sweeps')
+    command.set_defaults(run = sweep)
+
+    command = commands.add_parser('convert', help = 'convert every capture and sweep to HDF5 or packed .npy files')
+    command.add_argument('root', help = 'directory searched recursively for captures and sweep folders')
+    command.add_argument('--to', choices = ('hdf5', 'packed'), default = 'hdf5', help = 'output format (default hdf5)')
+    command.add_argument('--compression', choices = ('gzip', 'lzf'), default = None, help = 'HDF5 compression filter')
+    add_common(command, 'babyd_converted')
+    command.set_defaults(run = convert)
+
+    command = commands.add_parser('simulate', help = 'write a synthetic capture or sweep')
+    command.add_argument('output', help = 'directory to write to')
+    command.add_argument('--frames', type = int, default = 1000, help = 'frames per capture / sweep step')
+    command.add_argument('--name', default = 'Synthetic', help = 'test name of a capture')
+    command.add_argument('--photons', type = float, default = 1.0, help = 'mean photons per pixel per frame')
+    command.add_argument('--energy', type = float, default = 30, help = 'photon energy in keV')
+    command.add_argument('--seed', type = int, default = None, help = 'seed, the same seed writes the same data')
+    command.add_argument('--sweep', nargs = 4, metavar = ('PARAMETER', 'START', 'STOP', 'STEP'), default = None, help = 'write a sweep of PARAMETER, e.g. VoutTH2 1100 1200 10')
+    command.add_argument('--secondary', nargs = 4, metavar = ('PARAMETER', 'START', 'STOP', 'STEP'), default = None, help = 'with --sweep, write a two parameter sweep')
+    command.add_argument('-j', '--processes', type = int, default = None, help = 'worker processes (default all cores)')
+    command.set_defaults(run = simulate)
+    return parser
+
+
+def main(argv = None):
+    args = build_parser().parse_args(argv)
+    if args.profile is True:
+        from BabyDTools import Instrumentation
+        with Instrumentation.profile() as prof:
+            count = args.run(args)
+        print(prof.summary(), file = sys.stderr)
+    else:
+        count = args.run(args)
+    if count == 0:
+        print('Nothing found to process.', file = sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
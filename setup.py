@@ -9,5 +9,6 @@ setup(
     install_requires=['numpy', 'matplotlib', 'h5py', 'pandas', 'scipy'],
     author_email='mlarkin863@gmail.com',
     packages=find_packages(),
+    entry_points={'console_scripts': ['babyd = BabyDTools.cli:main']},
     zip_safe=False
 )